@@ -0,0 +1,70 @@
+"""Runs the passes of the native stages over chunks of a bam in separate processes.
+
+A chunk is the records between two virtual offsets, usually those of one contig, found
+with the bam's index. Passes that only collect something are mapped over the chunks.
+Passes that write records write each chunk to an intermediate as bgzf blocks without a
+header or eof marker, and the intermediates are appended to the output in chunk order.
+"""
+import concurrent.futures
+import os
+import shutil
+
+import bam_io
+import scratch
+
+def get_contig_chunks(index_fp, first_offset):
+    """Returns (start, end, ref_id) of the virtual offsets of the records of each
+    contig that has any, and (start, end, None) of the unplaced unmapped reads at the
+    end, or None if the index (.bai or .csi) has no metadata"""
+    references, _ = bam_io.read_bam_index(index_fp)
+    if any(r['bins'] and r['offsets'] is None for r in references):
+        return None
+    starts = sorted((r['offsets'][0], ref_id) for ref_id, r in enumerate(references)
+            if r['offsets'] is not None)
+    if not starts:
+        return [(first_offset, 1 << 64, None)]
+    tail = max(r['offsets'][1] for r in references if r['offsets'] is not None)
+    ends = [start for start, _ in starts[1:]] + [tail]
+    starts[0] = (first_offset, starts[0][1])
+    return [(start, end, ref_id) for (start, ref_id), end in zip(starts, ends)] + \
+            [(tail, 1 << 64, None)]
+
+def get_pool(threads, n):
+    """Process pool for n chunks, or a single thread if there is only one"""
+    if n > 1:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(threads, n)))
+    return concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+def map_chunks(function, input_fp, chunks, args, threads=1):
+    """Returns function(input_fp, start, end, *chunk_args) of every (start, end, _) of
+    chunks and chunk_args of args, in chunk order, run by up to threads processes"""
+    n = len(chunks)
+    with get_pool(threads, n) as pool:
+        return list(pool.map(function, [input_fp] * n, [start for start, _, _ in chunks],
+                [end for _, end, _ in chunks], *zip(*args)))
+
+def write_chunks(writer, function, input_fp, chunks, args, threads=1,
+        temp_files_dir=None, prefix='chunk'):
+    """Runs function(input_fp, output_fp, start, end, *chunk_args) for every chunk in
+    up to threads processes, each writing the records of its chunk to an intermediate
+    in temp_files_dir (the working directory by default). The intermediates are then
+    appended to writer in chunk order. Returns the results of function in chunk order.
+    """
+    temp_files_dir = temp_files_dir or os.getcwd()
+    n = len(chunks)
+    chunk_fps = [scratch.temp_path(temp_files_dir, f'{prefix}.chunk') for _ in chunks]
+    try:
+        with get_pool(threads, n) as pool:
+            results = list(pool.map(function, [input_fp] * n, chunk_fps,
+                    [start for start, _, _ in chunks], [end for _, end, _ in chunks],
+                    *zip(*args)))
+        scratch.check()
+        writer.flush()
+        for chunk_fp in chunk_fps:
+            with open(chunk_fp, 'rb') as f:
+                shutil.copyfileobj(f, writer.f)
+    finally:
+        for chunk_fp in chunk_fps:
+            scratch.consumed(chunk_fp)
+
+    return results
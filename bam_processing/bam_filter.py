@@ -0,0 +1,230 @@
+"""Vectorized flag, mapping quality and mate filtering of bam records.
+
+Records are read in batches and the fixed width fields of a whole batch are pulled
+into numpy arrays, so predicates are evaluated per batch instead of per record.
+Filtering keeps the order of the input, so it works on bams in any sort order.
+
+If the input has an index, it is split into chunks at record start offsets from the
+index's linear index and the chunks are filtered by separate processes. Otherwise
+the input is read by one process, with decompression and compression in threads.
+"""
+import logging
+import struct
+
+import numpy as np
+
+import bam_chunks
+import bam_io
+
+# decompressed bytes read per batch
+BATCH_SIZE = 4 * 1024 ** 2
+# offsets of fixed width fields from the start of a record, including block_size
+FIELDS = {
+    'ref_id': (4, '<i4'),
+    'pos': (8, '<i4'),
+    'mapping_quality': (13, 'u1'),
+    'flag': (18, '<u2'),
+    'next_ref_id': (24, '<i4'),
+    'next_pos': (28, '<i4'),
+    'template_length': (32, '<i4'),
+    }
+
+class RecordFilter(object):
+    """Keeps records that have every bit of require_flags set, no bit of exclude_flags
+    set, a mapping quality of at least min_mapping_quality and, if mate_same_reference
+    is True, a mate on the same reference"""
+    def __init__(self, require_flags=0, exclude_flags=0, min_mapping_quality=0,
+            mate_same_reference=False):
+        self.require_flags = require_flags
+        self.exclude_flags = exclude_flags
+        self.min_mapping_quality = min_mapping_quality
+        self.mate_same_reference = mate_same_reference
+
+    def combine(self, other):
+        """Returns a filter that only keeps records both filters keep"""
+        return RecordFilter(require_flags=self.require_flags | other.require_flags,
+                exclude_flags=self.exclude_flags | other.exclude_flags,
+                min_mapping_quality=max(self.min_mapping_quality, other.min_mapping_quality),
+                mate_same_reference=self.mate_same_reference or other.mate_same_reference)
+
+    def mask(self, fields):
+        """Returns boolean array of which records to keep"""
+        flag = fields['flag']
+        keep = (flag & self.require_flags) == self.require_flags
+        if self.exclude_flags:
+            keep &= (flag & self.exclude_flags) == 0
+        if self.min_mapping_quality:
+            keep &= fields['mapping_quality'] >= self.min_mapping_quality
+        if self.mate_same_reference:
+            keep &= fields['ref_id'] == fields['next_ref_id']
+        return keep
+
+    def __repr__(self):
+        return (f'require_flags={hex(self.require_flags)},'
+                f'exclude_flags={hex(self.exclude_flags)},'
+                f'min_mapping_quality={self.min_mapping_quality},'
+                f'mate_same_reference={self.mate_same_reference}')
+
+PRESETS = {
+    # samtools view -f 0x2 -F 0x4 -F 0x8 -F 0x100 -F 0x200 -F 0x800
+    'properly_paired': RecordFilter(require_flags=0x2,
+            exclude_flags=0x4 | 0x8 | 0x100 | 0x200 | 0x800),
+    'mapped': RecordFilter(exclude_flags=0x4),
+    'primary': RecordFilter(exclude_flags=0x100 | 0x800),
+    'pass_qc': RecordFilter(exclude_flags=0x200),
+    'no_duplicates': RecordFilter(exclude_flags=0x400),
+    }
+
+def parse_filter(spec):
+    """Parses a comma separated filter spec into a RecordFilter.
+
+    Each item is either a preset name or one of require_flags=, exclude_flags=,
+    min_mapping_quality= or mate_same_reference. i.e. 'properly_paired,min_mapping_quality=20'
+    """
+    if isinstance(spec, RecordFilter):
+        return spec
+    record_filter = RecordFilter()
+    for item in spec.split(','):
+        key, _, value = item.strip().partition('=')
+        if key in PRESETS and not value:
+            item_filter = PRESETS[key]
+        elif key in ('require_flags', 'exclude_flags'):
+            item_filter = RecordFilter(**{key: int(value, 0)})
+        elif key == 'min_mapping_quality':
+            item_filter = RecordFilter(min_mapping_quality=int(value))
+        elif key == 'mate_same_reference' and not value:
+            item_filter = RecordFilter(mate_same_reference=True)
+        else:
+            raise ValueError(f'unknown filter {item}, must be one of '
+                    f'{", ".join(PRESETS)} or a require_flags, exclude_flags, '
+                    'min_mapping_quality or mate_same_reference item')
+        record_filter = record_filter.combine(item_filter)
+
+    return record_filter
+
+def find_records(data):
+    """Returns start offsets of the whole records in data, and the offset where the
+    first incomplete record starts"""
+    offsets = []
+    offset = 0
+    while offset + 4 <= len(data):
+        end = offset + 4 + struct.unpack_from('<i', data, offset)[0]
+        if end > len(data):
+            break
+        offsets.append(offset)
+        offset = end
+    return offsets, offset
+
+def get_fields(data, offsets, fields=FIELDS):
+    """Returns dict of numpy arrays holding the fixed width fields (FIELDS by default)
+    of every record"""
+    view = np.frombuffer(data, dtype=np.uint8)
+    values = {}
+    for name, (offset, dtype) in fields.items():
+        width = np.dtype(dtype).itemsize
+        columns = view[offsets[:, None] + np.arange(offset, offset + width)]
+        values[name] = np.ascontiguousarray(columns).view(dtype).ravel()
+    return values
+
+def filter_batch(data, offsets, end, record_filter):
+    """Returns the bytes of the records in data[:end] that pass record_filter, and the
+    number kept"""
+    offsets = np.asarray(offsets, dtype=np.int64)
+    keep = record_filter.mask(get_fields(data, offsets))
+
+    # copy runs of consecutive kept records in one go
+    bounds = np.append(offsets, end)
+    edges = np.diff(np.concatenate(([0], keep.astype(np.int8), [0])))
+    starts = bounds[np.flatnonzero(edges == 1)]
+    stops = bounds[np.flatnonzero(edges == -1)]
+    view = memoryview(data)
+
+    return b''.join(view[a:b] for a, b in zip(starts, stops)), int(keep.sum())
+
+def filter_stream(read, writer, record_filter):
+    """Filters records read by read(n) into writer.
+
+    Returns
+        (n_records, n_kept)
+    """
+    n_records, n_kept = 0, 0
+    leftover = b''
+    while True:
+        chunk = read(BATCH_SIZE)
+        if not chunk:
+            break
+        data = leftover + chunk
+        offsets, end = find_records(data)
+        if offsets:
+            kept, n = filter_batch(data, offsets, end, record_filter)
+            writer.write(kept)
+            n_records += len(offsets)
+            n_kept += n
+        leftover = data[end:]
+    if leftover:
+        raise ValueError('bam ends with a truncated record')
+
+    return n_records, n_kept
+
+def filter_chunk(input_fp, output_fp, start, end, record_filter, compression_level=6):
+    """Filters records starting between virtual offsets start and end into output_fp
+    as bgzf blocks without a header or eof marker, so chunks can be concatenated"""
+    with bam_io.BgzfReader(input_fp) as reader, open(output_fp, 'wb') as f:
+        writer = bam_io.BgzfWriter(f, compression_level=compression_level)
+        reader.seek(start)
+        result = filter_stream(lambda n: reader.read_to(end, n), writer, record_filter)
+        writer.flush()
+
+    return result
+
+def get_chunk_offsets(index_fp, first_offset, n_chunks):
+    """Returns virtual offsets that split the records into about n_chunks chunks.
+
+    The linear index of a .bai holds the offset of the first record in every 16kb
+    window, and the chunks of every bin, which a .csi also has, start at records, so
+    all of these offsets are record starts.
+    """
+    references, _ = bam_io.read_bam_index(index_fp)
+    offsets = set()
+    for reference in references:
+        offsets.update(reference['intervals'])
+        offsets.update(start for chunks in reference['bins'].values() for start, _ in chunks)
+    offsets = sorted(offset for offset in offsets if offset > first_offset)
+    step = max(1, len(offsets) // n_chunks)
+    return [first_offset] + offsets[step::step][:n_chunks - 1]
+
+def filter_records(input_fp='/dev/stdin', output_fp='/dev/stdout', record_filter='properly_paired',
+        threads=1, compression_level=6, index_fp=None, temp_files_dir=None):
+    """Writes the records of input_fp that pass record_filter (a RecordFilter, preset name
+    or filter spec, see parse_filter) to output_fp.
+
+    Either can be a filepath or binary file object. If index_fp is given the input is
+    split into chunks filtered by up to threads processes, each into an intermediate in
+    temp_files_dir.
+
+    Returns
+        (n_records, n_kept)
+    """
+    record_filter = parse_filter(record_filter)
+    with bam_io.BgzfReader(input_fp, threads=1 if index_fp else threads) as reader, \
+            bam_io.BgzfWriter(output_fp, compression_level=compression_level,
+                    threads=threads) as writer:
+        header_text, references = bam_io.read_header(reader)
+        bam_io.write_header(writer, header_text, references)
+
+        if index_fp is None or threads <= 1:
+            n_records, n_kept = filter_stream(reader.read, writer, record_filter)
+        else:
+            # one chunk per process would leave processes idle behind a slow chunk
+            starts = get_chunk_offsets(index_fp, reader.tell(), 4 * threads)
+            ends = starts[1:] + [1 << 64]
+            chunks = [(start, end, None) for start, end in zip(starts, ends)]
+            results = bam_chunks.write_chunks(writer, filter_chunk, input_fp, chunks,
+                    [(record_filter, compression_level)] * len(chunks), threads=threads,
+                    temp_files_dir=temp_files_dir, prefix='filter')
+            n_records = sum(n for n, _ in results)
+            n_kept = sum(n for _, n in results)
+
+    logging.info(f'kept {n_kept} of {n_records} records ({record_filter})')
+
+    return n_records, n_kept
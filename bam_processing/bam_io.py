@@ -0,0 +1,472 @@
+import collections
+import concurrent.futures
+import struct
+import zlib
+
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+BAM_MAGIC = b'BAM\x01'
+# max amount of uncompressed data per bgzf block, leaves room for incompressible data
+MAX_BLOCK_DATA_SIZE = 0xff00
+# fixed length part of a bam record (not counting the leading block_size field)
+RECORD_FIXED_SIZE = 32
+# bin number of the bai pseudo-bin holding per reference metadata
+METADATA_BIN = 37450
+# bin levels of a bai, a csi has as many as its header says
+BAI_DEPTH = 5
+AUX_TYPE_SIZES = {'A': 1, 'c': 1, 'C': 1, 's': 2, 'S': 2, 'i': 4, 'I': 4, 'f': 4}
+AUX_TYPE_FORMATS = {'c': '<b', 'C': '<B', 's': '<h', 'S': '<H', 'i': '<i', 'I': '<I'}
+
+def read_raw_bgzf_block(f):
+    """Reads the next bgzf block from file object f without decompressing it.
+
+    Returns
+        raw - raw compressed block, or None at end of file
+    """
+    header = f.read(18)
+    if not header:
+        return None
+    if len(header) < 18 or header[:4] != BGZF_MAGIC:
+        raise ValueError('not a bgzf file')
+    xlen = struct.unpack_from('<H', header, 10)[0]
+    extra = header[12:] + f.read(xlen - 6)
+    i = 0
+    while i < xlen:
+        slen = struct.unpack_from('<H', extra, i + 2)[0]
+        if extra[i] == 66 and extra[i + 1] == 67:
+            block_size = struct.unpack_from('<H', extra, i + 4)[0] + 1
+            return header[:12] + extra + f.read(block_size - 12 - xlen)
+        i += 4 + slen
+    raise ValueError('bgzf block is missing BSIZE field')
+
+def decompress_block(raw):
+    """Decompresses a raw bgzf block"""
+    xlen = struct.unpack_from('<H', raw, 10)[0]
+    return zlib.decompress(raw[12 + xlen:-8], -15)
+
+def compress_block(data, compression_level=6):
+    """Compresses data (at most MAX_BLOCK_DATA_SIZE bytes) into a single bgzf block"""
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+            len(cdata) + 25)
+    trailer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+    return header + cdata + trailer
+
+class BgzfReader(object):
+    """Sequential reader over the decompressed contents of a bgzf file.
+
+    tell() returns bam style virtual offsets (compressed block offset << 16 | offset
+    within block).
+
+    If threads > 1 blocks are read ahead and decompressed in a thread pool.
+    """
+    def __init__(self, fp_or_fileobj, threads=1):
+        if isinstance(fp_or_fileobj, str):
+            self.f = open(fp_or_fileobj, 'rb')
+            self.owns_file = True
+        else:
+            self.f = fp_or_fileobj
+            self.owns_file = False
+        self.block_offset = 0
+        self.next_block_offset = 0
+        self.buffer = b''
+        self.position = 0
+        self.pool = None
+        self.pending = collections.deque()
+        self.read_ahead = 4 * threads
+        if threads > 1:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    def _next_block(self):
+        if self.pool is None:
+            raw = read_raw_bgzf_block(self.f)
+            return None if raw is None else (len(raw), decompress_block(raw))
+
+        while len(self.pending) < self.read_ahead:
+            raw = read_raw_bgzf_block(self.f)
+            if raw is None:
+                break
+            self.pending.append((len(raw), self.pool.submit(decompress_block, raw)))
+        if not self.pending:
+            return None
+        size, future = self.pending.popleft()
+        return size, future.result()
+
+    def _load_block(self):
+        self.block_offset = self.next_block_offset
+        block = self._next_block()
+        if block is None:
+            return False
+        size, self.buffer = block
+        self.next_block_offset += size
+        self.position = 0
+        return True
+
+    def read(self, n):
+        chunks = []
+        while n > 0:
+            if self.position >= len(self.buffer):
+                if not self._load_block():
+                    break
+                continue
+            chunk = self.buffer[self.position:self.position + n]
+            self.position += len(chunk)
+            n -= len(chunk)
+            chunks.append(chunk)
+
+        return b''.join(chunks)
+
+    def read_to(self, virtual_offset, n):
+        """Reads up to n bytes, stopping at virtual_offset"""
+        chunks = []
+        while n > 0:
+            if self.position >= len(self.buffer):
+                if (self.next_block_offset << 16) >= virtual_offset or not self._load_block():
+                    break
+                continue
+            stop = len(self.buffer)
+            if self.block_offset == virtual_offset >> 16:
+                stop = min(stop, virtual_offset & 0xffff)
+            if self.position >= stop:
+                break
+            chunk = self.buffer[self.position:min(stop, self.position + n)]
+            self.position += len(chunk)
+            n -= len(chunk)
+            chunks.append(chunk)
+
+        return b''.join(chunks)
+
+    def tell(self):
+        if self.position >= len(self.buffer):
+            return self.next_block_offset << 16
+        return (self.block_offset << 16) | self.position
+
+    def seek(self, virtual_offset):
+        for _, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.f.seek(virtual_offset >> 16)
+        self.next_block_offset = virtual_offset >> 16
+        self._load_block()
+        self.position = virtual_offset & 0xffff
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+        if self.owns_file:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class BgzfWriter(object):
+    """Writes data as bgzf blocks.
+
+    If threads > 1 blocks are compressed in a thread pool and written in order.
+    compression_level=0 produces uncompressed bam (i.e. samtools -u), useful for pipes.
+    If track_blocks is set, (compressed size, data size) of every block written is
+    appended to blocks, so offsets into the data can be turned into virtual offsets.
+    """
+    def __init__(self, fp_or_fileobj, compression_level=6, threads=1, track_blocks=False):
+        if isinstance(fp_or_fileobj, str):
+            self.f = open(fp_or_fileobj, 'wb')
+            self.owns_file = True
+        else:
+            self.f = fp_or_fileobj
+            self.owns_file = False
+        self.compression_level = compression_level
+        self.buffer = bytearray()
+        self.pool = None
+        self.pending = collections.deque()
+        self.max_pending = 4 * threads
+        self.blocks = [] if track_blocks else None
+        if threads > 1:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    def _write_raw(self, raw, size):
+        self.f.write(raw)
+        if self.blocks is not None:
+            self.blocks.append((len(raw), size))
+
+    def _write_block(self, data):
+        if self.pool is None:
+            self._write_raw(compress_block(data, self.compression_level), len(data))
+            return
+
+        self.pending.append((self.pool.submit(compress_block, data, self.compression_level),
+                len(data)))
+        while len(self.pending) > self.max_pending:
+            future, size = self.pending.popleft()
+            self._write_raw(future.result(), size)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= MAX_BLOCK_DATA_SIZE:
+            self._write_block(bytes(self.buffer[:MAX_BLOCK_DATA_SIZE]))
+            del self.buffer[:MAX_BLOCK_DATA_SIZE]
+
+    def _end_block(self):
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            future, size = self.pending.popleft()
+            self._write_raw(future.result(), size)
+
+    def flush(self):
+        """Ends the current block and writes out all pending blocks"""
+        self._end_block()
+        self.f.flush()
+
+    def write_raw_block(self, raw, size):
+        """Ends the current block and writes raw, an already compressed block of size
+        bytes of data, as is"""
+        self._end_block()
+        self._write_raw(raw, size)
+
+    def close(self):
+        self.flush()
+        self.f.write(BGZF_EOF)
+        self.f.flush()
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.owns_file:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_header(reader):
+    """Reads the bam header from a BgzfReader positioned at the start of the file.
+
+    Returns
+        (header_text, references) - sam header text and list of (name, length) tuples
+    """
+    if reader.read(4) != BAM_MAGIC:
+        raise ValueError('not a bam file')
+    l_text = struct.unpack('<i', reader.read(4))[0]
+    header_text = reader.read(l_text).rstrip(b'\x00').decode('utf-8')
+
+    n_ref = struct.unpack('<i', reader.read(4))[0]
+    references = []
+    for _ in range(n_ref):
+        l_name = struct.unpack('<i', reader.read(4))[0]
+        name = reader.read(l_name)[:-1].decode('utf-8')
+        l_ref = struct.unpack('<i', reader.read(4))[0]
+        references.append((name, l_ref))
+
+    return header_text, references
+
+def write_header(writer, header_text, references):
+    """Writes the bam header. references is a list of (name, length) tuples"""
+    text = header_text.encode('utf-8')
+    data = BAM_MAGIC + struct.pack('<i', len(text)) + text + struct.pack('<i', len(references))
+    for name, length in references:
+        name = name.encode('utf-8') + b'\x00'
+        data += struct.pack('<i', len(name)) + name + struct.pack('<i', length)
+    writer.write(data)
+    # header gets its own block(s)
+    writer.flush()
+
+def iter_records(reader):
+    """Yields raw bam records (without the leading block_size field)"""
+    while True:
+        size = reader.read(4)
+        if len(size) < 4:
+            return
+        block_size = struct.unpack('<i', size)[0]
+        yield reader.read(block_size)
+
+def get_header_tag(header_text, record_type, tag):
+    """Returns value of tag for the first header line of record_type (i.e. 'HD', 'SO')"""
+    for line in header_text.split('\n'):
+        if line.startswith('@' + record_type + '\t'):
+            for field in line.split('\t')[1:]:
+                if field.startswith(tag + ':'):
+                    return field[len(tag) + 1:]
+    return None
+
+def get_header_records(header_text, record_type):
+    """Returns list of dicts of the tags of every header line of record_type (i.e. 'RG'),
+    in header order"""
+    records = []
+    for line in header_text.split('\n'):
+        if line.startswith('@' + record_type + '\t'):
+            records.append(dict(field.split(':', 1) for field in line.split('\t')[1:]
+                    if ':' in field))
+    return records
+
+def write_record(writer, record):
+    """Writes a raw bam record (without the leading block_size field)"""
+    writer.write(struct.pack('<i', len(record)) + record)
+
+def get_aux_offset(record):
+    """Returns offset of the first aux field in a raw bam record"""
+    l_read_name = record[8]
+    n_cigar_op, _, l_seq = struct.unpack_from('<HHi', record, 12)
+    return RECORD_FIXED_SIZE + l_read_name + 4 * n_cigar_op + (l_seq + 1) // 2 + l_seq
+
+def iter_aux(record, offset=None):
+    """Yields (tag, value_type, value_offset, value_size) for each aux field of a raw bam
+    record. Values are not decoded."""
+    if offset is None:
+        offset = get_aux_offset(record)
+    while offset < len(record):
+        tag = record[offset:offset + 2].decode('ascii')
+        value_type = chr(record[offset + 2])
+        value_offset = offset + 3
+        if value_type in AUX_TYPE_SIZES:
+            size = AUX_TYPE_SIZES[value_type]
+        elif value_type in ('Z', 'H'):
+            size = record.index(b'\x00', value_offset) - value_offset + 1
+        elif value_type == 'B':
+            subtype = chr(record[value_offset])
+            count = struct.unpack_from('<i', record, value_offset + 1)[0]
+            size = 5 + AUX_TYPE_SIZES[subtype] * count
+        else:
+            raise ValueError(f'unknown aux type {value_type}')
+        yield tag, value_type, value_offset, size
+        offset = value_offset + size
+
+def get_read_group(record, aux_offset=None):
+    """Returns the RG tag of a raw bam record, or None if it has none"""
+    for tag, value_type, value_offset, size in iter_aux(record, aux_offset):
+        if tag == 'RG' and value_type == 'Z':
+            return record[value_offset:value_offset + size - 1].decode('ascii')
+    return None
+
+def reg2bin(beg, end):
+    """Returns the bai bin of a record spanning [beg, end), see the SAM spec"""
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+def read_index_references(data, offset, n_ref, depth=None):
+    """Reads the per reference bins and linear index of n_ref references, laid out as
+    in a .bai or .tbi, or as in a .csi of depth bin levels if depth is given, from data
+    starting at offset. A csi has no linear index, its references get no intervals.
+
+    Returns
+        (references, offset) - references as described in read_bai, and the offset
+            just past them
+    """
+    metadata_bin = METADATA_BIN
+    if depth is not None:
+        metadata_bin = ((1 << 3 * (depth + 1)) - 1) // 7 + 1
+    references = []
+    for _ in range(n_ref):
+        reference = {'bins': {}, 'intervals': [], 'offsets': None, 'mapped': None,
+                'unmapped': None}
+        n_bin = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+        for _ in range(n_bin):
+            bin_id = struct.unpack_from('<I', data, offset)[0]
+            # csi bins start with the offset of their first record
+            offset += 4 if depth is None else 12
+            n_chunk = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+            chunks = [struct.unpack_from('<QQ', data, offset + 16 * i) for i in range(n_chunk)]
+            offset += 16 * n_chunk
+            if bin_id == metadata_bin:
+                reference['offsets'] = chunks[0]
+                reference['mapped'], reference['unmapped'] = chunks[1]
+            else:
+                reference['bins'][bin_id] = chunks
+        if depth is None:
+            n_intv = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+            reference['intervals'] = list(struct.unpack_from(f'<{n_intv}Q', data, offset))
+            offset += 8 * n_intv
+        references.append(reference)
+
+    return references, offset
+
+def read_bai(index_fp):
+    """Reads a .bai index.
+
+    Returns
+        (references, n_no_coordinate) - references is a list with one dict per
+            reference containing bins ({bin: [(chunk_beg, chunk_end)]}), linear index
+            offsets, the (start, end) virtual offsets of its reads and mapped/unmapped
+            read counts (the last two are None if the index has no metadata
+            pseudo-bin). n_no_coordinate is the number of unplaced unmapped reads, or
+            None if not recorded.
+    """
+    with open(index_fp, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'BAI\x01':
+        raise ValueError('not a bai index')
+
+    n_ref = struct.unpack_from('<i', data, 4)[0]
+    references, offset = read_index_references(data, 8, n_ref)
+
+    n_no_coordinate = None
+    if len(data) >= offset + 8:
+        n_no_coordinate = struct.unpack_from('<Q', data, offset)[0]
+
+    return references, n_no_coordinate
+
+def read_tbi(index_fp):
+    """Reads a .tbi index.
+
+    Returns
+        (names, references) - names of the indexed sequences, and a list with one dict
+            per sequence as described in read_bai
+    """
+    with BgzfReader(index_fp) as reader:
+        data = b''.join(iter(lambda: reader.read(1 << 20), b''))
+    if data[:4] != b'TBI\x01':
+        raise ValueError('not a tabix index')
+
+    n_ref = struct.unpack_from('<i', data, 4)[0]
+    l_nm = struct.unpack_from('<i', data, 32)[0]
+    names = [name.decode('utf-8') for name in data[36:36 + l_nm].split(b'\x00')[:n_ref]]
+    references, _ = read_index_references(data, 36 + l_nm, n_ref)
+
+    return names, references
+
+def read_csi(index_fp):
+    """Reads a .csi index of a bam.
+
+    Returns
+        (references, n_no_coordinate) - as read_bai, without linear index intervals
+    """
+    with BgzfReader(index_fp) as reader:
+        data = b''.join(iter(lambda: reader.read(1 << 20), b''))
+    if data[:4] != b'CSI\x01':
+        raise ValueError('not a csi index')
+
+    depth, l_aux = struct.unpack_from('<ii', data, 8)
+    n_ref = struct.unpack_from('<i', data, 16 + l_aux)[0]
+    references, offset = read_index_references(data, 20 + l_aux, n_ref, depth=depth)
+
+    n_no_coordinate = None
+    if len(data) >= offset + 8:
+        n_no_coordinate = struct.unpack_from('<Q', data, offset)[0]
+
+    return references, n_no_coordinate
+
+def read_bam_index(index_fp):
+    """Reads a .bai or .csi index, see read_bai"""
+    with open(index_fp, 'rb') as f:
+        magic = f.read(4)
+    if magic == b'BAI\x01':
+        return read_bai(index_fp)
+    return read_csi(index_fp)
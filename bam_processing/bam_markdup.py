@@ -0,0 +1,683 @@
+"""Native duplicate marking of coordinate sorted bams, following picard MarkDuplicates.
+
+Like picard, every primary mapped read has a fragment signature (library, reference,
+unclipped 5' position, strand) and every pair with both reads mapped a pair signature
+(library, both ends' references and unclipped 5' positions, and orientation).
+Duplicates are then decided per group of equal signatures:
+    pairs - every pair except the one with the highest sum of base qualities >= 15
+    fragments - every read that isn't part of a mapped pair if the group has one,
+        otherwise every read except the best scoring one
+Ties go to the first read by tile/x/y (parsed from illumina read names) and then file
+order, as in picard. Secondary, supplementary and unmapped reads are never marked, and
+existing duplicate flags are cleared.
+
+The first pass streams records and keeps signatures in flat integer columns. A group
+can only gain members while the stream is within window bases of its signature, so
+groups are decided and dropped once the stream has moved past them. The second pass
+rewrites the flags.
+
+With an index, contigs are processed by separate processes. Pairs with reads on two
+contigs are joined and decided after all contigs are done.
+
+Reads wait for their mate in memory only while the mate is on the same contig. A read
+whose mate is on another contig waits with the later contig of the two and is spilled to
+an intermediate when too many are waiting, like picard's disk based read ends map, so
+only the reads waiting on one contig are loaded at a time.
+"""
+import array
+import logging
+import os
+import pickle
+import struct
+import time
+
+import numpy as np
+
+import bam_chunks
+import bam_filter
+import bam_io
+import bam_recal
+import genome_access
+import scratch
+
+DUPLICATE_FLAG = 0x400
+# picard scores reads by the sum of base qualities of at least this
+MIN_BASE_QUALITY = 15
+QUALITY_TABLE = bytes(q if q >= MIN_BASE_QUALITY else 0 for q in range(256))
+MAX_READ_SCORE = 32767 // 2
+# reads with the same unclipped 5' position start at most this far apart
+DEFAULT_WINDOW = 100000
+# drain finished groups every this many records
+DRAIN_INTERVAL = 100000
+# spill reads waiting on a mate on another contig once there are more than this
+MAX_PENDING = 500000
+# reads of a duplicate set closer than this on a tile are optical duplicates
+OPTICAL_DISTANCE = 100
+# picard skips optical duplicate detection for bigger duplicate sets
+MAX_OPTICAL_SET_SIZE = 300000
+UNKNOWN_LIBRARY = 'Unknown Library'
+# cigar ops that consume reference, and soft and hard clips
+REFERENCE_OPS = {0, 2, 3, 7, 8}
+CLIP_OPS = {4, 5}
+# picard orientation codes
+F, R, FF, FR, RR, RF = 0, 1, 2, 3, 4, 5
+FRAGMENT_COLUMNS = ('library', 'ref', 'pos', 'orientation', 'paired', 'score', 'tile', 'x',
+        'y', 'index')
+PAIR_COLUMNS = ('library', 'ref', 'pos', 'orientation', 'ref2', 'pos2', 'score', 'tile', 'x',
+        'y', 'read_group', 'index', 'index2')
+# per library counters, see DuplicationMetrics
+METRICS = ('UNPAIRED_READS_EXAMINED', 'READ_PAIRS_EXAMINED', 'SECONDARY_OR_SUPPLEMENTARY_RDS',
+        'UNMAPPED_READS', 'UNPAIRED_READ_DUPLICATES', 'READ_PAIR_DUPLICATES',
+        'READ_PAIR_OPTICAL_DUPLICATES')
+
+class SignatureTable(object):
+    """Rows of integer columns kept as flat arrays instead of python objects"""
+    def __init__(self, columns):
+        self.columns = columns
+        self.data = [array.array('q') for _ in columns]
+
+    def append(self, *values):
+        for column, value in zip(self.data, values):
+            column.append(value)
+
+    def __len__(self):
+        return len(self.data[0])
+
+    def drain(self, is_done=None):
+        """Removes the rows is_done(rows) selects (all rows by default) and returns
+        them as a dict of numpy arrays"""
+        rows = {name: np.array(column, dtype=np.int64)
+                for name, column in zip(self.columns, self.data)}
+        if is_done is None:
+            self.data = [array.array('q') for _ in self.columns]
+            return rows
+
+        done = is_done(rows)
+        self.data = [array.array('q', rows[name][~done].tobytes()) for name in self.columns]
+        return {name: values[done] for name, values in rows.items()}
+
+class PendingReads(object):
+    """Reads waiting on a mate on another contig, as (read group, name, library, read)
+    kept by contig. With a spill_fp they are appended to it once there are more than
+    MAX_PENDING in memory, and only pickled offsets into it are kept."""
+    def __init__(self, spill_fp=None):
+        self.spill_fp = spill_fp
+        self.reads = {}
+        self.n_reads = 0
+        self.spilled = {}
+
+    def add(self, ref_id, read):
+        self.reads.setdefault(ref_id, []).append(read)
+        self.n_reads += 1
+        if self.n_reads > MAX_PENDING:
+            self.spill()
+
+    def spill(self):
+        """Moves the reads in memory to spill_fp, if there is one"""
+        if self.spill_fp is None or not self.reads:
+            return
+        with open(self.spill_fp, 'ab') as f:
+            for ref_id, reads in self.reads.items():
+                self.spilled.setdefault(ref_id, []).append(f.tell())
+                pickle.dump(reads, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.reads = {}
+        self.n_reads = 0
+
+    def get_contigs(self):
+        return sorted(set(self.reads) | set(self.spilled))
+
+    def pop(self, ref_id):
+        """Removes and returns the reads of a contig, in the order they were added"""
+        reads = []
+        if ref_id in self.spilled:
+            with open(self.spill_fp, 'rb') as f:
+                for offset in self.spilled.pop(ref_id):
+                    f.seek(offset)
+                    reads.extend(pickle.load(f))
+        in_memory = self.reads.pop(ref_id, [])
+        self.n_reads -= len(in_memory)
+        return reads + in_memory
+
+def get_libraries(header_text):
+    """Returns (libraries, read_group_libraries), the list of library names and a dict
+    of read group id -> index in libraries. Reads without a read group belong to the
+    last library."""
+    libraries = []
+    read_group_libraries = {}
+    for line in header_text.split('\n'):
+        if not line.startswith('@RG\t'):
+            continue
+        fields = dict(field.split(':', 1) for field in line.split('\t')[1:] if ':' in field)
+        library = fields.get('LB', UNKNOWN_LIBRARY)
+        if library not in libraries:
+            libraries.append(library)
+        read_group_libraries[fields.get('ID')] = libraries.index(library)
+    libraries.append(UNKNOWN_LIBRARY)
+
+    return libraries, read_group_libraries
+
+def parse_location(name):
+    """Returns (tile, x, y) of an illumina read name, or (-1, -1, -1). Like picard's
+    default parser, names with 5 or 7 colon separated fields end in tile:x:y"""
+    fields = name.split(b':')
+    if len(fields) in (5, 7):
+        try:
+            return int(fields[-3]), int(fields[-2]), int(fields[-1])
+        except ValueError:
+            pass
+    return -1, -1, -1
+
+def get_orientation(read1_reverse, read2_reverse):
+    if read1_reverse:
+        return RR if read2_reverse else RF
+    return FR if read2_reverse else FF
+
+def decide_fragments(rows):
+    """Returns boolean array of which rows are duplicates"""
+    order = np.lexsort((rows['index'], rows['y'], rows['x'], rows['tile'], -rows['score'],
+            rows['orientation'], rows['pos'], rows['ref'], rows['library']))
+    keys = np.stack([rows[name][order] for name in ('library', 'ref', 'pos', 'orientation')])
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (keys[:, 1:] != keys[:, :-1]).any(axis=0)
+    group = np.cumsum(first) - 1
+    paired = rows['paired'][order].astype(bool)
+    group_has_pair = np.bitwise_or.reduceat(paired, np.flatnonzero(first)) \
+            if len(order) else paired
+
+    duplicate = np.empty(len(order), dtype=bool)
+    duplicate[order] = np.where(group_has_pair[group], ~paired, ~first)
+    return duplicate
+
+def count_optical_duplicates(rows, members):
+    """Counts pairs of a duplicate set within OPTICAL_DISTANCE of an earlier pair from
+    the same read group and tile"""
+    if len(members) > MAX_OPTICAL_SET_SIZE:
+        return 0
+    n = 0
+    located = [i for i in members if rows['tile'][i] >= 0]
+    for j, b in enumerate(located):
+        for a in located[:j]:
+            if rows['read_group'][a] == rows['read_group'][b] and \
+                    rows['tile'][a] == rows['tile'][b] and \
+                    abs(rows['x'][a] - rows['x'][b]) <= OPTICAL_DISTANCE and \
+                    abs(rows['y'][a] - rows['y'][b]) <= OPTICAL_DISTANCE:
+                n += 1
+                break
+    return n
+
+def decide_pairs(rows, n_libraries):
+    """Returns (duplicate, optical), a boolean array of which rows are duplicates and
+    the number of optical duplicate pairs per library"""
+    order = np.lexsort((rows['index2'], rows['index'], rows['y'], rows['x'], rows['tile'],
+            -rows['score'], rows['pos2'], rows['ref2'], rows['orientation'], rows['pos'],
+            rows['ref'], rows['library']))
+    keys = np.stack([rows[name][order]
+            for name in ('library', 'ref', 'pos', 'orientation', 'ref2', 'pos2')])
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (keys[:, 1:] != keys[:, :-1]).any(axis=0)
+
+    duplicate = np.empty(len(order), dtype=bool)
+    duplicate[order] = ~first
+
+    optical = np.zeros(n_libraries, dtype=np.int64)
+    starts = np.flatnonzero(first)
+    sizes = np.diff(np.append(starts, len(order)))
+    for start, size in zip(starts[sizes > 1], sizes[sizes > 1]):
+        members = order[start:start + size]
+        if (rows['tile'][members] >= 0).sum() > 1:
+            optical[rows['library'][members[0]]] += count_optical_duplicates(rows, members)
+    return duplicate, optical
+
+class DuplicateFinder(object):
+    """First pass over a stream of records, collecting the file index (in the stream)
+    of every duplicate"""
+    def __init__(self, header_text, window=DEFAULT_WINDOW, spill_fp=None):
+        self.libraries, self.read_group_libraries = get_libraries(header_text)
+        self.read_group_ids = {read_group: i
+                for i, read_group in enumerate(self.read_group_libraries)}
+        # only look up read groups when they can change the library or pair key
+        self.use_read_groups = len(self.read_group_libraries) > 1
+        self.window = window
+        self.fragments = SignatureTable(FRAGMENT_COLUMNS)
+        self.pairs = SignatureTable(PAIR_COLUMNS)
+        # (read group, name) -> first seen read of a pair whose mate is still to come on
+        # the current contig
+        self.pending = {}
+        # reads whose mate is on another contig, by the later contig of the two
+        self.other_contig = PendingReads(spill_fp)
+        self.duplicates = []
+        self.metrics = np.zeros((len(self.libraries), len(METRICS)), dtype=np.int64)
+        self.index = 0
+        self.n_since_drain = 0
+        self.position = (-1, -1)
+
+    def add(self, record):
+        """Adds the next record of the stream (without the block_size field)"""
+        index = self.index
+        self.index += 1
+        ref_id, pos, l_read_name, _, _, n_cigar_op, flag, l_seq = \
+                struct.unpack_from('<iiBBHHHi', record, 0)
+
+        read_group = None
+        library = len(self.libraries) - 1
+        if self.use_read_groups or self.read_group_libraries:
+            offset = bam_io.RECORD_FIXED_SIZE + l_read_name + 4 * n_cigar_op + \
+                    (l_seq + 1) // 2 + l_seq
+            read_group = bam_io.get_read_group(record, offset) if self.use_read_groups else \
+                    next(iter(self.read_group_libraries))
+            library = self.read_group_libraries.get(read_group, library)
+
+        if flag & 0x4:
+            self.metrics[library, 3] += 1
+            return
+        if flag & 0x900:
+            self.metrics[library, 2] += 1
+            return
+
+        if (ref_id, pos) < self.position:
+            raise ValueError('bam is not coordinate sorted')
+        self.n_since_drain += 1
+        if ref_id != self.position[0] or self.n_since_drain >= DRAIN_INTERVAL:
+            self.drain(ref_id, pos)
+            self.n_since_drain = 0
+        if ref_id != self.position[0]:
+            self.start_contig(ref_id)
+        self.position = (ref_id, pos)
+
+        cigar_offset = bam_io.RECORD_FIXED_SIZE + l_read_name
+        cigar = struct.unpack_from(f'<{n_cigar_op}I', record, cigar_offset)
+        reverse = bool(flag & 0x10)
+        if reverse:
+            end = pos + sum(c >> 4 for c in cigar if c & 0xf in REFERENCE_OPS)
+            clip = 0
+            for c in reversed(cigar):
+                if c & 0xf not in CLIP_OPS:
+                    break
+                clip += c >> 4
+            five_prime = end - 1 + clip
+        else:
+            clip = 0
+            for c in cigar:
+                if c & 0xf not in CLIP_OPS:
+                    break
+                clip += c >> 4
+            five_prime = pos - clip
+
+        quality_offset = cigar_offset + 4 * n_cigar_op + (l_seq + 1) // 2
+        score = 0
+        if l_seq and record[quality_offset] != 0xff:
+            score = min(MAX_READ_SCORE,
+                    sum(record[quality_offset:quality_offset + l_seq].translate(QUALITY_TABLE)))
+
+        name = record[bam_io.RECORD_FIXED_SIZE:bam_io.RECORD_FIXED_SIZE + l_read_name - 1]
+        tile, x, y = parse_location(name)
+        paired = flag & 0x1 and not flag & 0x8
+        self.fragments.append(library, ref_id, five_prime, R if reverse else F, int(bool(paired)),
+                score, tile, x, y, index)
+        if not paired:
+            self.metrics[library, 0] += 1
+            return
+
+        self.metrics[library, 1] += 1
+        key = (read_group, name)
+        mate = self.pending.pop(key, None)
+        if mate is None:
+            read = (ref_id, five_prime, reverse, index, score)
+            mate_ref_id = struct.unpack_from('<i', record, 20)[0]
+            if mate_ref_id == ref_id or mate_ref_id < 0:
+                self.pending[key] = read
+            else:
+                self.other_contig.add(max(ref_id, mate_ref_id),
+                        (read_group, name, library, read))
+            return
+        self.add_pair(library, read_group, mate, (ref_id, five_prime, reverse, index, score),
+                tile, x, y)
+
+    def start_contig(self, ref_id):
+        """Sets aside the reads of the last contig whose mate never came, and loads those
+        waiting on a mate on contig ref_id"""
+        self.set_aside_pending()
+        for read_group, name, _, read in self.other_contig.pop(ref_id):
+            self.pending[(read_group, name)] = read
+
+    def set_aside_pending(self):
+        for (read_group, name), read in self.pending.items():
+            library = self.read_group_libraries.get(read_group, len(self.libraries) - 1)
+            self.other_contig.add(read[0], (read_group, name, library, read))
+        self.pending = {}
+
+    def add_pair(self, library, read_group, first, second, tile, x, y):
+        """Adds a pair signature for two reads given as (ref, five_prime, reverse, index,
+        score). Like picard, read 1 of the signature is the lower end, or the first read
+        in file order on a tie, and opposite reads at the same position are FR"""
+        if first[:2] > second[:2]:
+            read1, read2 = second, first
+        else:
+            read1, read2 = first, second
+        orientation = get_orientation(read1[2], read2[2])
+        if orientation == RF and read1[:2] == read2[:2]:
+            orientation = FR
+        self.pairs.append(library, read1[0], read1[1], orientation,
+                read2[0], read2[1], first[4] + second[4], tile, x, y,
+                self.read_group_ids.get(read_group, -1), read1[3], read2[3])
+
+    def drain(self, ref_id=None, pos=None):
+        """Decides every group the stream has moved past (all of them if ref_id is None)"""
+        if ref_id is None:
+            fragments, pairs = self.fragments.drain(), self.pairs.drain()
+        else:
+            threshold = pos - self.window
+            fragments = self.fragments.drain(lambda rows: (rows['ref'] != ref_id) |
+                    (rows['pos'] < threshold))
+            pairs = self.pairs.drain(lambda rows: (rows['ref2'] != ref_id) |
+                    (rows['pos2'] < threshold))
+
+        if len(fragments['index']):
+            duplicate = decide_fragments(fragments)
+            self.duplicates.append(fragments['index'][duplicate])
+            unpaired = duplicate & (fragments['paired'] == 0)
+            self.metrics[:, 4] += np.bincount(fragments['library'][unpaired],
+                    minlength=len(self.libraries))
+        if len(pairs['index']):
+            duplicate, optical = decide_pairs(pairs, len(self.libraries))
+            self.duplicates.extend((pairs['index'][duplicate], pairs['index2'][duplicate]))
+            # pair metrics are counted per read until get_metrics
+            self.metrics[:, 5] += 2 * np.bincount(pairs['library'][duplicate],
+                    minlength=len(self.libraries))
+            self.metrics[:, 6] += optical
+
+    def finish(self):
+        """Decides the remaining groups.
+
+        Returns
+            (duplicates, pending, metrics) - sorted stream indices of duplicates, the
+                PendingReads whose mate never came and per library metric counts
+        """
+        self.drain()
+        self.set_aside_pending()
+        duplicates = np.sort(np.concatenate(self.duplicates)) if self.duplicates else \
+                np.zeros(0, dtype=np.int64)
+        return duplicates, self.other_contig, self.metrics
+
+def iter_stream_records(read):
+    """Yields records (without block_size) read by read(n) until it returns nothing"""
+    leftover = b''
+    while True:
+        chunk = read(bam_filter.BATCH_SIZE)
+        if not chunk:
+            break
+        data = leftover + chunk
+        offsets, end = bam_filter.find_records(data)
+        view = memoryview(data)
+        for offset in offsets:
+            size = struct.unpack_from('<i', data, offset)[0]
+            yield view[offset + 4:offset + 4 + size].tobytes()
+        leftover = data[end:]
+    if leftover:
+        raise ValueError('bam ends with a truncated record')
+
+def find_chunk_duplicates(input_fp, start, end, header_text, window=DEFAULT_WINDOW,
+        spill_fp=None):
+    """First pass over the records between virtual offsets start and end, see
+    DuplicateFinder.finish. Reads whose mate never came are spilled to spill_fp, so
+    only where to find them is sent back."""
+    finder = DuplicateFinder(header_text, window=window, spill_fp=spill_fp)
+    with bam_io.BgzfReader(input_fp) as reader:
+        reader.seek(start)
+        for record in iter_stream_records(lambda n: reader.read_to(end, n)):
+            finder.add(record)
+    duplicates, pending, metrics = finder.finish()
+    pending.spill()
+    return duplicates, pending, metrics
+
+def set_flags(data, offsets, indices, duplicates):
+    """Sets the duplicate flag of records at offsets in data whose stream index is in
+    duplicates and clears it on the rest"""
+    view = np.frombuffer(data, dtype=np.uint8)
+    flag_offsets = np.asarray(offsets, dtype=np.int64) + 4 + 15
+    is_duplicate = np.isin(indices, duplicates, assume_unique=True)
+    # the duplicate flag is in the high byte of the little endian flag field
+    high = DUPLICATE_FLAG >> 8
+    view[flag_offsets] = np.where(is_duplicate, view[flag_offsets] | high,
+            view[flag_offsets] & (0xff ^ high))
+
+def write_stream(read, writer, duplicates, collector=None):
+    """Second pass, copies records read by read(n) into writer with duplicate flags set.
+    If collector is given the records are also added to it, see
+    bam_recal.CovariateCollector. Returns number of records"""
+    index = 0
+    leftover = b''
+    while True:
+        chunk = read(bam_filter.BATCH_SIZE)
+        if not chunk:
+            break
+        data = bytearray(leftover + chunk)
+        offsets, end = bam_filter.find_records(data)
+        if offsets:
+            indices = np.arange(index, index + len(offsets))
+            lo, hi = np.searchsorted(duplicates, (indices[0], indices[-1] + 1))
+            set_flags(data, offsets, indices, duplicates[lo:hi])
+            if collector is not None:
+                collector.add_batch(data, offsets)
+            index += len(offsets)
+            writer.write(bytes(data[:end]))
+        leftover = bytes(data[end:])
+    if leftover:
+        raise ValueError('bam ends with a truncated record')
+    return index
+
+def write_chunk(input_fp, output_fp, start, end, duplicates, compression_level=6,
+        collector=None):
+    """Writes the records between virtual offsets start and end to output_fp as bgzf
+    blocks without a header or eof marker, so chunks can be concatenated.
+
+    Returns the counts of collector if one is given, else None
+    """
+    with bam_io.BgzfReader(input_fp) as reader, open(output_fp, 'wb') as f:
+        writer = bam_io.BgzfWriter(f, compression_level=compression_level)
+        reader.seek(start)
+        write_stream(lambda n: reader.read_to(end, n), writer, duplicates,
+                collector=collector)
+        writer.flush()
+    return collector.counts if collector is not None else None
+
+def join_pending(pending, n_libraries, window=DEFAULT_WINDOW):
+    """Decides pairs whose reads were seen by different chunks.
+
+    pending is a list, per chunk, of the PendingReads whose mate wasn't in the chunk.
+    They are joined one contig at a time, as pairs waiting on different contigs never
+    have the same signature.
+
+    Returns
+        (duplicates, metrics) - duplicates is a list, per chunk, of stream indices
+    """
+    finder = DuplicateFinder('', window=window)
+    finder.libraries = [None] * n_libraries
+    finder.metrics = np.zeros((n_libraries, len(METRICS)), dtype=np.int64)
+    for ref_id in sorted(set().union(*(reads.get_contigs() for reads in pending))):
+        first_reads = {}
+        for chunk, reads in enumerate(pending):
+            for read_group, name, library, read in reads.pop(ref_id):
+                # chunk goes in the index so duplicates can be routed back to their chunk
+                read = read[:3] + (chunk << 40 | read[3], read[4])
+                key = (read_group, name)
+                if key in first_reads:
+                    finder.read_group_ids.setdefault(read_group, len(finder.read_group_ids))
+                    finder.add_pair(library, read_group, first_reads.pop(key), read,
+                            *parse_location(name))
+                else:
+                    first_reads[key] = read
+        finder.drain()
+
+    duplicates = [[] for _ in pending]
+    for index in (np.concatenate(finder.duplicates) if finder.duplicates else []):
+        duplicates[int(index) >> 40].append(int(index) & ((1 << 40) - 1))
+    return [np.array(d, dtype=np.int64) for d in duplicates], finder.metrics
+
+def add_program(header_text, command_line, program='bam_markdup'):
+    """Returns header_text with a @PG line for this run of program chained after the
+    last one"""
+    lines = header_text.rstrip('\n').split('\n')
+    ids = [bam_io.get_header_tag(line, 'PG', 'ID') for line in lines]
+    ids = [i for i in ids if i is not None]
+    program_id = program
+    n = 1
+    while program_id in ids:
+        program_id = f'{program}.{n}'
+        n += 1
+    line = f'@PG\tID:{program_id}\tPN:{program}'
+    if ids:
+        line += f'\tPP:{ids[-1]}'
+    line += f'\tCL:{command_line}'
+    return '\n'.join(lines + [line]) + '\n'
+
+def estimate_library_size(read_pairs, unique_read_pairs):
+    """picard's Lander-Waterman library size estimate, or None"""
+    if read_pairs <= 0 or read_pairs - unique_read_pairs <= 0:
+        return None
+
+    def f(x, c, n):
+        return c / x - 1 + np.exp(-n / x)
+
+    m, M = 1.0, 100.0
+    c, n = unique_read_pairs, read_pairs
+    if c >= n or f(m * c, c, n) < 0:
+        return None
+    while f(M * c, c, n) > 0:
+        M *= 10.0
+    for _ in range(40):
+        r = (m + M) / 2.0
+        u = f(r * c, c, n)
+        if u == 0:
+            break
+        elif u > 0:
+            m = r
+        else:
+            M = r
+    return int(c * (m + M) / 2.0)
+
+def get_metrics(libraries, counts):
+    """Returns list of dicts of picard DuplicationMetrics, one per library with reads"""
+    metrics = []
+    for library, row in zip(libraries, counts):
+        if not row.any():
+            continue
+        metric = dict(zip(METRICS, (int(v) for v in row)))
+        # pairs are counted per read
+        metric['READ_PAIRS_EXAMINED'] //= 2
+        metric['READ_PAIR_DUPLICATES'] //= 2
+        examined = metric['UNPAIRED_READS_EXAMINED'] + 2 * metric['READ_PAIRS_EXAMINED']
+        duplicates = metric['UNPAIRED_READ_DUPLICATES'] + 2 * metric['READ_PAIR_DUPLICATES']
+        metric['PERCENT_DUPLICATION'] = duplicates / examined if examined else 0.0
+        metric['ESTIMATED_LIBRARY_SIZE'] = estimate_library_size(
+                metric['READ_PAIRS_EXAMINED'] - metric['READ_PAIR_OPTICAL_DUPLICATES'],
+                metric['READ_PAIRS_EXAMINED'] - metric['READ_PAIR_DUPLICATES'])
+        metrics.append(dict(LIBRARY=library, **metric))
+    return metrics
+
+def write_metrics(metrics, metrics_fp, command_line):
+    """Writes metrics in picard's metrics file format"""
+    columns = ['LIBRARY'] + list(METRICS) + ['PERCENT_DUPLICATION', 'ESTIMATED_LIBRARY_SIZE']
+    with open(metrics_fp, 'w') as f:
+        f.write('## htsjdk.samtools.metrics.StringHeader\n')
+        f.write(f'# {command_line}\n')
+        f.write('## htsjdk.samtools.metrics.StringHeader\n')
+        f.write(f'# Started on: {time.ctime()}\n\n')
+        f.write('## METRICS CLASS\tpicard.sam.DuplicationMetrics\n')
+        f.write('\t'.join(columns) + '\n')
+        for metric in metrics:
+            values = []
+            for column in columns:
+                value = metric[column]
+                if value is None:
+                    value = ''
+                elif isinstance(value, float):
+                    value = f'{value:.6f}'
+                values.append(str(value))
+            f.write('\t'.join(values) + '\n')
+        f.write('\n')
+
+def mark_duplicates(input_fp, output_fp, metrics_fp=None, threads=1, index_fp=None,
+        compression_level=6, window=DEFAULT_WINDOW, reference_fp=None, known_sites_fp=None,
+        recal_table_fp=None, temp_files_dir=None):
+    """Sets the duplicate flag on duplicate reads of coordinate sorted input_fp.
+
+    If index_fp is given and threads > 1 each contig is processed by a separate
+    process, into an intermediate in temp_files_dir. Reads waiting on a mate on another
+    contig are spilled to intermediates there too. If metrics_fp is given picard style
+    duplication metrics are written to it.
+    If recal_table_fp is given the base recalibration table of the output is collected
+    while the flags are written, against reference_fp and the known sites vcf
+    known_sites_fp, and written to it.
+
+    Returns
+        metrics - list of dicts of duplication metrics, one per library
+    """
+    command_line = f'bam_markdup input={input_fp} output={output_fp}'
+    with bam_io.BgzfReader(input_fp) as reader:
+        header_text, references = bam_io.read_header(reader)
+        first_offset = reader.tell()
+    if bam_io.get_header_tag(header_text, 'HD', 'SO') not in (None, 'coordinate'):
+        raise ValueError(f'{input_fp} must be coordinate sorted to mark duplicates')
+    libraries, _ = get_libraries(header_text)
+
+    chunks = None
+    if index_fp is not None and threads > 1:
+        chunks = bam_chunks.get_contig_chunks(index_fp, first_offset)
+    if chunks is None:
+        chunks = [(first_offset, 1 << 64, None)]
+
+    # first pass, find duplicates
+    n = len(chunks)
+    spill_fps = [scratch.temp_path(temp_files_dir or os.getcwd(), 'markdup', '.pending')
+            for _ in chunks]
+    try:
+        results = bam_chunks.map_chunks(find_chunk_duplicates, input_fp, chunks,
+                [(header_text, window, spill_fp) for spill_fp in spill_fps],
+                threads=threads)
+        duplicates = [result[0] for result in results]
+        counts = sum(result[2] for result in results)
+        if n > 1:
+            cross_duplicates, cross_counts = join_pending(
+                    [result[1] for result in results], len(libraries), window=window)
+            duplicates = [np.union1d(d, c) for d, c in zip(duplicates, cross_duplicates)]
+            counts = counts + cross_counts
+    finally:
+        for spill_fp in spill_fps:
+            scratch.consumed(spill_fp)
+
+    # known sites are loaded by each chunk for its own contig, from the .tbi if there
+    # is one
+    collectors = [None] * n
+    if recal_table_fp is not None:
+        known_sites = genome_access.KnownSites([known_sites_fp])
+        collectors = [bam_recal.CovariateCollector(header_text, references, reference_fp,
+                known_sites) for _ in chunks]
+
+    # second pass, rewrite flags
+    with bam_io.BgzfWriter(output_fp, compression_level=compression_level,
+            threads=threads) as writer:
+        bam_io.write_header(writer, add_program(header_text, command_line), references)
+        if n == 1:
+            with bam_io.BgzfReader(input_fp, threads=threads) as reader:
+                reader.seek(first_offset)
+                write_stream(reader.read, writer, duplicates[0], collector=collectors[0])
+        else:
+            collector_counts = bam_chunks.write_chunks(writer, write_chunk, input_fp, chunks,
+                    [(d, compression_level, c) for d, c in zip(duplicates, collectors)],
+                    threads=threads, temp_files_dir=temp_files_dir, prefix='markdup')
+            if recal_table_fp is not None:
+                for chunk_counts in collector_counts:
+                    collectors[0].merge(chunk_counts)
+
+    metrics = get_metrics(libraries, counts)
+    for metric in metrics:
+        logging.info(f'marked {metric["UNPAIRED_READ_DUPLICATES"]} unpaired and '
+                f'{metric["READ_PAIR_DUPLICATES"]} paired duplicates in library '
+                f'{metric["LIBRARY"]} ({metric["PERCENT_DUPLICATION"]:.2%})')
+    if metrics_fp is not None:
+        write_metrics(metrics, metrics_fp, command_line)
+    if recal_table_fp is not None:
+        bam_recal.write_report(collectors[0], recal_table_fp)
+
+    return metrics
@@ -0,0 +1,358 @@
+"""Merges coordinate sorted bams, i.e. the shards of a sharded step, into one coordinate
+sorted bam and builds its .bai in the same pass.
+
+When every contig has records in at most one input, as with shards of whole contigs,
+the inputs are concatenated a contig at a time at the bgzf block level: blocks that
+lie wholly inside a contig's records are copied without being recompressed, only the
+blocks where one contig's records end and the next's begin are. Otherwise records are
+merged through a heap. Either way the output only depends on the inputs and their
+order, records at the same position come in input order.
+
+The index is built from the positions records are written at in the uncompressed
+stream, turned into virtual offsets once the writer has reported the size of every
+block, so it needs no second read of the output.
+"""
+import heapq
+import logging
+import struct
+
+import numpy as np
+
+import bam_chunks
+import bam_filter
+import bam_io
+import bam_markdup
+import bam_metadata
+import bam_recal
+
+# bai linear index window size
+LINEAR_SHIFT = 14
+# (shift, first bin) of each bai bin level, smallest bins first
+BIN_LEVELS = tuple((14 + 3 * i, ((1 << 15 - 3 * i) - 1) // 7) for i in range(5))
+
+def get_bins(beg, end):
+    """Returns bai bins of records spanning [beg, end), a vectorized reg2bin"""
+    end = end - 1
+    bins = np.zeros(len(beg), dtype=np.int64)
+    done = np.zeros(len(beg), dtype=bool)
+    for shift, first_bin in BIN_LEVELS:
+        same = ~done & (beg >> shift == end >> shift)
+        bins[same] = first_bin + (beg[same] >> shift)
+        done |= same
+    return bins
+
+def get_reference_lengths(data, offsets, fields):
+    """Returns number of reference bases the cigar of each record covers"""
+    view = np.frombuffer(data, dtype=np.uint8)
+    n_cigar_op = fields['n_cigar_op'].astype(np.int64)
+    cigar_offsets = offsets + 4 + bam_io.RECORD_FIXED_SIZE + fields['l_read_name']
+    op_record, op_index = bam_recal.expand(np.arange(len(offsets)), n_cigar_op)
+    cigar = view[(cigar_offsets[op_record] + 4 * op_index)[:, None] + np.arange(4)] \
+            .copy().view('<u4').ravel()
+    covered = np.where(np.isin(cigar & 0xf, bam_recal.REFERENCE_OPS), cigar >> 4, 0)
+    return np.bincount(op_record, weights=covered, minlength=len(offsets)).astype(np.int64)
+
+class BlockTable(object):
+    """Turns offsets into the uncompressed data of a bgzf file into virtual offsets,
+    from the (compressed size, data size) of each of its blocks"""
+    def __init__(self, blocks):
+        sizes = np.array(blocks, dtype=np.int64).reshape(-1, 2)
+        compressed = np.concatenate(([0], np.cumsum(sizes[:, 0])))
+        uncompressed = np.concatenate(([0], np.cumsum(sizes[:, 1])))
+        # empty blocks hold no offsets, the end of the data is the start of the next block
+        keep = np.append(sizes[:, 1] > 0, True)
+        self.compressed = compressed[keep]
+        self.uncompressed = uncompressed[keep]
+
+    def to_virtual(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        i = np.searchsorted(self.uncompressed, positions, side='right') - 1
+        return (self.compressed[i] << 16) | (positions - self.uncompressed[i])
+
+class IndexBuilder(object):
+    """Builds the .bai of a coordinate sorted bam from its records as they are written.
+
+    add is given the data written after the header, in order, in pieces of any size.
+    Offsets are kept as positions in the uncompressed data, starting at position, the
+    size of the header, and turned into virtual offsets by write.
+    """
+    def __init__(self, n_ref, position=0):
+        self.n_ref = n_ref
+        self.position = position
+        self.pending = []
+        self.pending_size = 0
+        self.bins = [{} for _ in range(n_ref)]
+        self.linear = [{} for _ in range(n_ref)]
+        # first record start, last record end, mapped and unmapped reads per contig
+        self.metadata = [None] * n_ref
+        self.n_no_coordinate = 0
+        self.last_key = -1
+
+    def add(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= bam_filter.BATCH_SIZE:
+            self.index_pending()
+
+    def index_pending(self):
+        data = b''.join(self.pending)
+        offsets, end = bam_filter.find_records(data)
+        if offsets:
+            self.index_batch(data, np.asarray(offsets, dtype=np.int64), end)
+        self.position += end
+        self.pending = [data[end:]] if end < len(data) else []
+        self.pending_size = len(data) - end
+
+    def index_batch(self, data, offsets, end):
+        fields = bam_filter.get_fields(data, offsets, fields=bam_recal.RECORD_FIELDS)
+        ref_id, pos = fields['ref_id'].astype(np.int64), fields['pos'].astype(np.int64)
+        starts = self.position + offsets
+        ends = self.position + np.append(offsets[1:], end)
+
+        # unplaced reads go last, with no position
+        keys = np.where(ref_id < 0, self.n_ref, ref_id) << 32 | np.where(ref_id < 0, 0, pos)
+        if keys[0] < self.last_key or np.any(keys[1:] < keys[:-1]):
+            raise ValueError('records must be coordinate sorted to be indexed')
+        self.last_key = int(keys[-1])
+
+        placed = ref_id >= 0
+        self.n_no_coordinate += int((~placed).sum())
+        if not placed.any():
+            return
+        offsets, ref_id, pos = offsets[placed], ref_id[placed], pos[placed]
+        starts, ends = starts[placed], ends[placed]
+        unmapped = (fields['flag'][placed] & 0x4) != 0
+        lengths = get_reference_lengths(data, offsets,
+                {name: values[placed] for name, values in fields.items()})
+        reference_ends = pos + np.where(unmapped | (lengths == 0), 1, lengths)
+        bins = get_bins(pos, reference_ends)
+
+        # chunks are runs of records in the same bin
+        change = np.flatnonzero((ref_id[1:] != ref_id[:-1]) | (bins[1:] != bins[:-1])) + 1
+        run_starts = np.concatenate(([0], change))
+        run_ends = np.append(change, len(ref_id))
+        for i, j in zip(run_starts.tolist(), run_ends.tolist()):
+            chunks = self.bins[ref_id[i]].setdefault(int(bins[i]), [])
+            if chunks and chunks[-1][1] == starts[i]:
+                chunks[-1][1] = int(ends[j - 1])
+            else:
+                chunks.append([int(starts[i]), int(ends[j - 1])])
+
+        # each linear index window holds the start of the first record overlapping it
+        first_windows = pos >> LINEAR_SHIFT
+        counts = ((reference_ends - 1) >> LINEAR_SHIFT) - first_windows + 1
+        record, within = bam_recal.expand(np.arange(len(pos)), counts)
+        windows = ref_id[record] << 32 | (first_windows[record] + within)
+        windows, first = np.unique(windows, return_index=True)
+        for window, i in zip(windows.tolist(), record[first].tolist()):
+            self.linear[window >> 32].setdefault(window & 0xffffffff, int(starts[i]))
+
+        for contig in np.unique(ref_id).tolist():
+            on_contig = ref_id == contig
+            n_unmapped = int(unmapped[on_contig].sum())
+            metadata = self.metadata[contig]
+            if metadata is None:
+                metadata = self.metadata[contig] = [int(starts[on_contig][0]), 0, 0, 0]
+            metadata[1] = int(ends[on_contig][-1])
+            metadata[2] += int(on_contig.sum()) - n_unmapped
+            metadata[3] += n_unmapped
+
+    def write(self, index_fp, blocks):
+        """Writes the .bai, blocks are the (compressed size, data size) of every block of
+        the bam, see bam_io.BgzfWriter"""
+        self.index_pending()
+        if self.pending_size:
+            raise ValueError('bam ends with a truncated record')
+        table = BlockTable(blocks)
+
+        data = bytearray(b'BAI\x01' + struct.pack('<i', self.n_ref))
+        for bins, linear, metadata in zip(self.bins, self.linear, self.metadata):
+            data += struct.pack('<i', len(bins) + (metadata is not None))
+            for bin_id in sorted(bins):
+                chunks = table.to_virtual(bins[bin_id]).reshape(-1)
+                data += struct.pack(f'<Ii{len(chunks)}Q', bin_id, len(chunks) // 2, *chunks)
+            if metadata is not None:
+                start, end = table.to_virtual(metadata[:2]).tolist()
+                data += struct.pack('<Ii4Q', bam_io.METADATA_BIN, 2, start, end, *metadata[2:])
+
+            # windows no record overlaps point at the next record before them
+            intervals = []
+            if linear:
+                offsets = np.full(max(linear) + 1, -1, dtype=np.int64)
+                offsets[list(linear)] = list(linear.values())
+                offsets[0] = offsets[0] if offsets[0] >= 0 else metadata[0]
+                offsets = np.maximum.accumulate(offsets)
+                intervals = table.to_virtual(offsets).tolist()
+            data += struct.pack(f'<i{len(intervals)}Q', len(intervals), *intervals)
+        data += struct.pack('<Q', self.n_no_coordinate)
+
+        with open(index_fp, 'wb') as f:
+            f.write(data)
+
+def get_header_length(fp):
+    """Returns the size of the header of the bam in its uncompressed data"""
+    with bam_io.BgzfReader(fp) as reader:
+        bam_io.read_header(reader)
+        virtual_offset = reader.tell()
+    with open(fp, 'rb') as f:
+        compressed, uncompressed = 0, 0
+        while compressed < virtual_offset >> 16:
+            raw = bam_io.read_raw_bgzf_block(f)
+            compressed += len(raw)
+            uncompressed += len(bam_io.decompress_block(raw))
+    return uncompressed + (virtual_offset & 0xffff)
+
+def iter_data(fp, blocks):
+    """Yields the data of each block of a bgzf file, appending (compressed size, data
+    size) of each to blocks"""
+    with open(fp, 'rb') as f:
+        for raw in iter(lambda: bam_io.read_raw_bgzf_block(f), None):
+            data = bam_io.decompress_block(raw)
+            blocks.append((len(raw), len(data)))
+            yield data
+
+def scan_segments(fp):
+    """Returns (ref_id, start, end) virtual offsets of each run of records on one contig
+    in the bam, by reading it through. ref_id is None for unplaced reads. Returns None
+    if a contig has more than one run, the bam isn't sorted then"""
+    blocks, runs = [], []
+    position = skip = get_header_length(fp)
+    buffer = bytearray()
+    data = iter_data(fp, blocks)
+    while True:
+        block = next(data, None)
+        if block is not None:
+            cut = min(skip, len(block))
+            skip -= cut
+            buffer += block[cut:]
+            if len(buffer) < bam_filter.BATCH_SIZE:
+                continue
+        batch = bytes(buffer)
+        offsets, end = bam_filter.find_records(batch)
+        if offsets:
+            offsets = np.asarray(offsets, dtype=np.int64)
+            ref_ids = bam_filter.get_fields(batch, offsets,
+                    fields={'ref_id': bam_filter.FIELDS['ref_id']})['ref_id']
+            change = np.flatnonzero(ref_ids[1:] != ref_ids[:-1]) + 1
+            for i in np.concatenate(([0], change)).tolist():
+                if not runs or runs[-1][0] != ref_ids[i]:
+                    runs.append((int(ref_ids[i]), position + int(offsets[i])))
+        position += end
+        del buffer[:end]
+        if block is None:
+            break
+    if buffer:
+        raise ValueError(f'{fp} ends with a truncated record')
+
+    ref_ids = [ref_id for ref_id, _ in runs]
+    if len(set(ref_ids)) != len(ref_ids):
+        return None
+    bounds = BlockTable(blocks).to_virtual([start for _, start in runs] + [position]).tolist()
+    return [(ref_id if ref_id >= 0 else None, start, end)
+            for ref_id, start, end in zip(ref_ids, bounds[:-1], bounds[1:])]
+
+def get_segments(fp, first_offset):
+    """Returns (ref_id, start, end) virtual offsets of the records of each contig in the
+    bam that has any, in file order, with ref_id None for the unplaced reads at the end.
+    Comes from the index if there is one with metadata, otherwise from reading the bam
+    through. Returns None if the bam turns out not to be sorted"""
+    index_fp = bam_metadata.find_index(fp)
+    chunks = None
+    if index_fp is not None:
+        chunks = bam_chunks.get_contig_chunks(index_fp, first_offset)
+    if chunks is not None:
+        return [(ref_id, start, end) for start, end, ref_id in chunks]
+    return scan_segments(fp)
+
+def copy_segment(fp, start, end, writer, builder):
+    """Writes the data of the bgzf file between virtual offsets start and end, copying
+    the blocks wholly inside as they are"""
+    with open(fp, 'rb') as f:
+        f.seek(start >> 16)
+        offset = start >> 16
+        while offset < end >> 16 or (offset == end >> 16 and end & 0xffff):
+            raw = bam_io.read_raw_bgzf_block(f)
+            if raw is None:
+                break
+            data = bam_io.decompress_block(raw)
+            lo = start & 0xffff if offset == start >> 16 else 0
+            hi = end & 0xffff if offset == end >> 16 else len(data)
+            if lo == 0 and hi == len(data):
+                if data:
+                    writer.write_raw_block(raw, len(data))
+            else:
+                writer.write(data[lo:hi])
+            builder.add(data[lo:hi])
+            offset += len(raw)
+
+def iter_keyed_records(fp, n_ref):
+    """Yields ((contig, position), record) of the records of the bam, keyed so unplaced
+    reads go last"""
+    with bam_io.BgzfReader(fp) as reader:
+        bam_io.read_header(reader)
+        for record in bam_io.iter_records(reader):
+            ref_id, pos = struct.unpack_from('<ii', record, 0)
+            yield (ref_id if ref_id >= 0 else n_ref, pos if ref_id >= 0 else 0), record
+
+def heap_merge(input_fps, n_ref, writer, builder):
+    """Writes the records of the inputs merged by position, ties in input order"""
+    batch = bytearray()
+    records = heapq.merge(*[iter_keyed_records(fp, n_ref) for fp in input_fps],
+            key=lambda keyed: keyed[0])
+    for _, record in records:
+        batch += struct.pack('<i', len(record)) + record
+        if len(batch) >= bam_filter.BATCH_SIZE:
+            writer.write(bytes(batch))
+            builder.add(bytes(batch))
+            batch = bytearray()
+    writer.write(bytes(batch))
+    builder.add(bytes(batch))
+
+def merge_bams(input_fps, output_fp, index_fp=None, threads=1, compression_level=6):
+    """Merges coordinate sorted input_fps into output_fp, and writes its .bai to
+    index_fp (output.bam.bai by default). The header is that of the first input.
+
+    Returns
+        method - 'concatenate' if the inputs were concatenated at the block level,
+            'merge' if records were merged through a heap
+    """
+    if index_fp is None:
+        index_fp = f'{output_fp}.bai'
+    headers, segments = [], []
+    for input_fp in input_fps:
+        with bam_io.BgzfReader(input_fp) as reader:
+            headers.append(bam_io.read_header(reader))
+            first_offset = reader.tell()
+        segments.append(get_segments(input_fp, first_offset))
+    header_text, references = headers[0]
+    for input_fp, (_, input_references) in zip(input_fps, headers):
+        if input_references != references:
+            raise ValueError(f'{input_fp} has different contigs than {input_fps[0]}')
+
+    placed = [ref_id for shard in segments if shard is not None
+            for ref_id, _, _ in shard if ref_id is not None]
+    method = 'merge'
+    if all(shard is not None for shard in segments) and len(set(placed)) == len(placed):
+        method = 'concatenate'
+
+    command_line = f'bam_merge {" ".join(input_fps)} output={output_fp}'
+    with bam_io.BgzfWriter(output_fp, compression_level=compression_level, threads=threads,
+            track_blocks=True) as writer:
+        bam_io.write_header(writer, bam_markdup.add_program(header_text, command_line,
+                program='bam_merge'), references)
+        builder = IndexBuilder(len(references),
+                position=sum(size for _, size in writer.blocks))
+        if method == 'concatenate':
+            # contigs in reference order, then the unplaced reads of every input
+            order = sorted((ref_id, i, start, end) for i, shard in enumerate(segments)
+                    for ref_id, start, end in shard if ref_id is not None)
+            order += [(None, i, start, end) for i, shard in enumerate(segments)
+                    for ref_id, start, end in shard if ref_id is None]
+            for _, i, start, end in order:
+                copy_segment(input_fps[i], start, end, writer, builder)
+        else:
+            heap_merge(input_fps, len(references), writer, builder)
+    builder.write(index_fp, writer.blocks)
+    logging.info(f'merged {len(input_fps)} bams into {output_fp} by {method}')
+
+    return method
@@ -0,0 +1,85 @@
+"""Reads what there is to know about a bam without reading its records: the header for
+sort order, read groups, @PG chain and contigs, and the .bai or .csi for per contig
+mapped and unmapped read counts.
+
+Only the first bgzf blocks of the bam and its index are read, so this takes
+milliseconds even for bams on network storage.
+"""
+import os
+import re
+
+import bam_io
+
+def find_index(bam_fp):
+    """Returns filepath of an up to date .bai or .csi for the bam, or None if there isn't
+    one"""
+    for suffix in ('.bai', '.csi'):
+        for index_fp in (f'{bam_fp}{suffix}', re.sub(r'\.bam$', suffix, bam_fp)):
+            if index_fp != bam_fp and os.path.isfile(index_fp) and \
+                    os.path.getmtime(index_fp) >= os.path.getmtime(bam_fp):
+                return index_fp
+    return None
+
+def get_program_chain(programs):
+    """Returns the @PG records of the last program and the programs before it, found by
+    following PP tags, first program first"""
+    by_id = {program.get('ID'): program for program in programs}
+    previous = {program.get('PP') for program in programs}
+    # the last program is the last one that no other program comes after
+    lasts = [program for program in programs if program.get('ID') not in previous]
+    if not lasts:
+        return []
+    chain = [lasts[-1]]
+    while chain[-1].get('PP') in by_id and by_id[chain[-1]['PP']] not in chain:
+        chain.append(by_id[chain[-1]['PP']])
+    return chain[::-1]
+
+def read_index_counts(index_fp):
+    """Returns (counts, n_no_coordinate), a list of (mapped, unmapped) per contig and the
+    number of unplaced unmapped reads. Counts the index doesn't have are None"""
+    references, n_no_coordinate = bam_io.read_bam_index(index_fp)
+    return [(r['mapped'], r['unmapped']) for r in references], n_no_coordinate
+
+def count_records(bam_fp, index_fp=None):
+    """Returns number of records in the bam according to its index, or None if it has
+    no index or the index has no counts"""
+    index_fp = index_fp or find_index(bam_fp)
+    if index_fp is None:
+        return None
+    counts, n_no_coordinate = read_index_counts(index_fp)
+    if any(mapped is None for mapped, _ in counts):
+        return None
+    return sum(mapped + unmapped for mapped, unmapped in counts) + (n_no_coordinate or 0)
+
+def read_metadata(bam_fp, index_fp=None):
+    """Returns dict of metadata of the bam
+        sort_order - @HD SO: tag, or None
+        read_groups - list of dicts of the tags of each @RG line
+        programs - @PG chain, see get_program_chain
+        contigs - list of dicts of name, length and, if the index has them, mapped and
+            unmapped read counts
+        index_fp - the index the counts come from, the up to date .bai or .csi next to
+            the bam if none is given, or None
+        n_no_coordinate - unplaced unmapped reads, None if unknown
+    """
+    with bam_io.BgzfReader(bam_fp) as reader:
+        header_text, references = bam_io.read_header(reader)
+    header = bam_io.get_header_records(header_text, 'HD')
+
+    index_fp = index_fp or find_index(bam_fp)
+    counts, n_no_coordinate = [(None, None)] * len(references), None
+    if index_fp is not None:
+        counts, n_no_coordinate = read_index_counts(index_fp)
+        if len(counts) != len(references):
+            raise ValueError(f'{index_fp} has {len(counts)} contigs, {bam_fp} has '
+                    f'{len(references)}')
+
+    return {
+        'sort_order': header[0].get('SO') if header else None,
+        'read_groups': bam_io.get_header_records(header_text, 'RG'),
+        'programs': get_program_chain(bam_io.get_header_records(header_text, 'PG')),
+        'contigs': [{'name': name, 'length': length, 'mapped': mapped, 'unmapped': unmapped}
+                for (name, length), (mapped, unmapped) in zip(references, counts)],
+        'index_fp': index_fp,
+        'n_no_coordinate': n_no_coordinate,
+        }
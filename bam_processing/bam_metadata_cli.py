@@ -0,0 +1,47 @@
+import argparse
+import concurrent.futures
+import json
+import sys
+
+import bam_metadata
+
+parser = argparse.ArgumentParser(description='print sort order, read groups, @PG chain \
+and per contig read counts of bams from their headers and indexes, without reading any \
+records')
+
+parser.add_argument('bams', type=str, nargs='+',
+        help='bams to describe. One json object is printed per bam, in the order given.')
+
+parser.add_argument('--threads', type=int,
+        default=8, help='number of bams read at once, worth raising for bams on network \
+storage')
+parser.add_argument('--no-contigs', action='store_true',
+        help='leave out the per contig list and print only the total read counts')
+
+args = parser.parse_args()
+
+def describe(bam_fp):
+    try:
+        metadata = bam_metadata.read_metadata(bam_fp)
+    except (OSError, ValueError) as e:
+        return {'bam': bam_fp, 'error': str(e)}
+
+    contigs = metadata['contigs']
+    if contigs and all(contig['mapped'] is not None for contig in contigs):
+        metadata['mapped'] = sum(contig['mapped'] for contig in contigs)
+        metadata['unmapped'] = sum(contig['unmapped'] for contig in contigs)
+    if args.no_contigs:
+        del metadata['contigs']
+    return dict(bam=bam_fp, **metadata)
+
+def main():
+    failed = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as pool:
+        for metadata in pool.map(describe, args.bams):
+            failed = failed or 'error' in metadata
+            print(json.dumps(metadata), flush=True)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
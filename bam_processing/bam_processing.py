@@ -1,135 +1,604 @@
 import logging
 import os
+import concurrent.futures
+import contextvars
+import functools
 import re
 import shutil
+import signal
 import subprocess
+import tempfile
+import threading
 import uuid
 
+import numpy as np
+
+import bam_filter
+import bam_io
+import bam_markdup
+import bam_merge
+import bam_metadata
+import bam_splitn
+import bam_sharding
+import bam_stages
+import dag
+import instrumentation
+import jvm_executor
+import scratch
+import step_cache
+
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
 
+# sort order verdicts keyed by (filepath, size, mtime) so repeated checks are free
+SORT_ORDER_CACHE = {}
+# records get_sort_order checks in python before leaving the rest of the bam to samtools
+MAX_SCAN_RECORDS = 1000000
+# duplicate markers and the tools each depends on
+DUPLICATE_MARKERS = {'picard': ('samtools', 'picard'), 'native': ('samtools',)}
+SPLITTERS = {'gatk': ('samtools', 'gatk'), 'native': ('samtools',)}
+
+def get_bam_index_fp(bam_fp):
+    """Returns filepath of an up to date .bai for the bam, or None if there isn't one"""
+    for index_fp in (f'{bam_fp}.bai', re.sub(r'\.bam$', '.bai', bam_fp)):
+        if index_fp != bam_fp and os.path.isfile(index_fp) and \
+                os.path.getmtime(index_fp) >= os.path.getmtime(bam_fp):
+            return index_fp
+    return None
+
+def scan_is_coordinate_sorted(reader, max_records=MAX_SCAN_RECORDS):
+    """Streams records a batch at a time and stops at the first one that is out of
+    coordinate order. Returns None if the first max_records are in order, leaving the
+    rest to samtools_is_coordinate_sorted"""
+    previous = -1
+    n_records = 0
+    leftover = b''
+    while n_records < max_records:
+        chunk = reader.read(bam_filter.BATCH_SIZE)
+        if not chunk:
+            return True
+        data = leftover + chunk
+        offsets, end = bam_filter.find_records(data)
+        leftover = data[end:]
+        if not offsets:
+            continue
+        fields = bam_filter.get_fields(data, np.asarray(offsets, dtype=np.int64),
+                {name: bam_filter.FIELDS[name] for name in ('ref_id', 'pos')})
+        # unmapped reads without a reference go at the end
+        ref_ids = fields['ref_id'].astype(np.int64) & 0xffffffff
+        keys = ref_ids << 32 | (fields['pos'].astype(np.int64) + 1)
+        if keys[0] < previous or (np.diff(keys) < 0).any():
+            return False
+        previous = int(keys[-1])
+        n_records += len(offsets)
+    return None
+
+def samtools_is_coordinate_sorted(bam_fp):
+    """samtools index only indexes coordinate sorted bams, so try indexing into a
+    temporary file"""
+    index_dir = tempfile.mkdtemp(prefix='sort_order.')
+    try:
+        instrumentation.execute(('samtools', 'index', '-o',
+                os.path.join(index_dir, 'index.bai'), bam_fp))
+        return True
+    except subprocess.CalledProcessError:
+        return False
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+def get_sort_order(bam_fp):
+    """Returns sort order of the bam: 'coordinate', 'queryname' or 'unsorted'.
+
+    Uses the @HD SO: header tag and any existing index, and only falls back to
+    scanning records when those are not conclusive. The scan stops at the first out
+    of order record, and leaves bams with more than MAX_SCAN_RECORDS records to
+    samtools. Verdicts are cached per (filepath, size, mtime).
+    """
+    stat = os.stat(bam_fp)
+    key = (os.path.realpath(bam_fp), stat.st_size, stat.st_mtime_ns)
+    if key in SORT_ORDER_CACHE:
+        return SORT_ORDER_CACHE[key]
+
+    with bam_io.BgzfReader(bam_fp) as reader:
+        header_text, _ = bam_io.read_header(reader)
+        header_sort_order = bam_io.get_header_tag(header_text, 'HD', 'SO')
+
+        if header_sort_order in ('coordinate', 'queryname'):
+            sort_order = header_sort_order
+        elif bam_metadata.find_index(bam_fp) is not None:
+            # samtools index will only index coordinate sorted bams
+            sort_order = 'coordinate'
+        else:
+            in_order = scan_is_coordinate_sorted(reader, max_records=MAX_SCAN_RECORDS)
+            if in_order is None:
+                in_order = samtools_is_coordinate_sorted(bam_fp)
+            sort_order = 'coordinate' if in_order else 'unsorted'
+
+    SORT_ORDER_CACHE[key] = sort_order
+
+    return sort_order
+
+def parse_memory(memory):
+    """Converts a memory string (i.e. '10G', '512m') to bytes"""
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+    memory = str(memory).strip()
+    if memory[-1].lower() in units:
+        return int(float(memory[:-1]) * units[memory[-1].lower()])
+    return int(memory)
+
+def split_memory(memory, n):
+    """Splits a memory budget n ways. Returns the per share amount as a samtools/java
+    style memory string in megabytes"""
+    return f'{max(1, parse_memory(memory) // n // 1024 ** 2)}M'
+
+def split_threads(threads, n):
+    """Splits a thread budget n ways, giving each share at least one thread"""
+    return max(1, threads // n)
+
+def samtools_thread_args(threads):
+    """samtools -@ is the number of additional threads"""
+    if threads > 1:
+        return ('-@', str(threads - 1))
+    return ()
+
+def picard_args(tool, max_mem=None):
+    if max_mem is None:
+        return ('picard', tool)
+    return ('picard', f'-Xmx{max_mem}', tool)
+
+def gatk_args(tool, max_mem=None):
+    if max_mem is None:
+        return ('gatk', tool)
+    return ('gatk', '--java-options', f'-Xmx{max_mem}', tool)
+
+def gatk_interval_args(intervals):
+    if intervals is None:
+        return ()
+    return ('-L', intervals)
+
 def create_sorted_bam(bam_fp, output_fp=None, name_sorted=False, max_memory='10G',
-        temp_files_dir=os.getcwd(), use_temp_for_output=True):
+        temp_files_dir=os.getcwd(), use_temp_for_output=True, threads=1):
     """Creates sorted bam and returns the filepath.
 
     If no filepath given then default is used.
 
     If bam is already sorted then original filepath is returned
 
+    max_memory is the total sort buffer and is split evenly between threads.
+
     Returns
         fp - filepath for sorted bam
     """
-    tool_args = ('samtools', 'stats', bam_fp)
-    output = subprocess.check_output(tool_args).decode('utf-8')
- 
     # if already sorted then return input filepath
-    # ignore this if trying to name sort
-    if 'is sorted:\t1' in output and not name_sorted:
+    sort_order = get_sort_order(bam_fp)
+    if sort_order == ('queryname' if name_sorted else 'coordinate'):
         return bam_fp
 
     if output_fp is None:
         if use_temp_for_output:
-            output_fp = os.path.join(temp_files_dir, f'sorted.{str(uuid.uuid4())}.bam')
+            output_fp = scratch.temp_path(temp_files_dir, 'sorted', '.bam')
         else:
             output_fp = f'sorted.{str(uuid.uuid4())}.bam'
 
+    sort_prefix = scratch.temp_path(temp_files_dir, 'sort')
+    tool_args = ('samtools', 'sort')
     if name_sorted:
-        tool_args = ('samtools', 'sort', '-n', '-m', max_memory, '-T',
-                os.path.join(temp_files_dir, str(uuid.uuid4())), '-o', output_fp, bam_fp)
-    else:
-        tool_args = ('samtools', 'sort', '-m', max_memory, '-T',
-                os.path.join(temp_files_dir, str(uuid.uuid4())), '-o', output_fp, bam_fp)
+        tool_args += ('-n',)
+    tool_args += samtools_thread_args(threads) + ('-m', split_memory(max_memory, threads),
+            '-T', sort_prefix, '-o', output_fp, bam_fp)
 
-    subprocess.check_output(tool_args)
+    instrumentation.execute(tool_args)
+    scratch.consumed(sort_prefix)
 
     return output_fp
 
-def index_bam(bam_fp):
-    """index the given bam if it is not already"""
-    if not os.path.isfile(f'{bam_fp}.bai'):
+def is_broken_pipe(error):
+    """Returns True if a stage failed only because the stage reading its output ended"""
+    if isinstance(error, subprocess.CalledProcessError):
+        return error.returncode == -signal.SIGPIPE
+    return isinstance(error, BrokenPipeError)
+
+def run_python_stage(stage, input_f, output_f, close_output, errors, i):
+    try:
+        # the first stage reads its own input, which progress can follow
+        input_fp = getattr(stage, 'input_fp', None) if input_f is None else None
+        instrumentation.run_python_stage(getattr(stage, '__qualname__', str(stage)), stage,
+                input_f, output_f,
+                input_fp=input_fp if input_fp and os.path.isfile(input_fp) else None)
+    except BaseException as e:
+        errors[i] = e
+    finally:
+        if input_f is not None:
+            input_f.close()
+        if close_output:
+            output_f.close()
+
+def run_pipeline(stages, output_fp=None):
+    """Runs a list of stages as a single chain of OS pipes.
+
+    A stage is either tool_args for a subprocess, or a python callable
+    stage(input_f, output_f) that is run in a thread. input_f is None for the first
+    stage and output_f is None for the last stage when no output_fp is given, in which
+    case the stage uses its own input/output.
+
+    stdout of each stage is connected to stdin of the next stage. stdout of the final
+    stage is written to output_fp if given, otherwise it is left for the tool to handle
+    (i.e. the final stage writes to its own output file).
+
+    Raises subprocess.CalledProcessError if any subprocess stage exits non-zero, or
+    the exception raised by a failed python stage. When several stages fail the
+    earliest is reported, skipping those that only hit a broken pipe because a later
+    stage stopped reading. If a stage can't be started the stages already running are
+    stopped and the error is raised.
+    """
+    processes = []
+    threads = []
+    errors = {}
+    output_f = open(output_fp, 'wb') if output_fp is not None else None
+    stdin = None
+    try:
+        for i, stage in enumerate(stages):
+            is_last = i == len(stages) - 1
+            if callable(stage):
+                if is_last:
+                    stage_output, next_stdin = output_f, None
+                else:
+                    read_fd, write_fd = os.pipe()
+                    stage_output = os.fdopen(write_fd, 'wb')
+                    next_stdin = os.fdopen(read_fd, 'rb')
+                logging.info(f'executing python stage: {stage}')
+                t = threading.Thread(target=contextvars.copy_context().run,
+                        args=(run_python_stage, stage, stdin, stage_output, not is_last,
+                                errors, i))
+                t.start()
+                threads.append(t)
+                stdin = next_stdin
+                continue
+
+            if is_last:
+                stdout = output_f
+            else:
+                stdout = subprocess.PIPE
+            logging.info(f'executing command: {stage}')
+            monitor = instrumentation.launch(stage, stdin=stdin, stdout=stdout)
+            # close our copy of the upstream pipe so SIGPIPE propagates correctly
+            if stdin is not None:
+                stdin.close()
+            stdin = monitor.process.stdout
+            processes.append((i, stage, monitor))
+    except BaseException:
+        # nothing will read the pipe the failed stage was to get, and the stages
+        # already started would wait on it forever
+        if stdin is not None:
+            stdin.close()
+        for _, _, monitor in processes:
+            if monitor.process.returncode is None:
+                monitor.process.terminate()
+        raise
+    finally:
+        for _, _, monitor in processes:
+            monitor.wait()
+        for t in threads:
+            t.join()
+        if output_f is not None:
+            output_f.close()
+
+    for i, tool_args, monitor in processes:
+        if monitor.process.returncode != 0:
+            errors[i] = subprocess.CalledProcessError(monitor.process.returncode, tool_args)
+    # a stage whose reader failed gets a broken pipe, report what failed instead
+    failures = {i: e for i, e in errors.items() if not is_broken_pipe(e)} or errors
+    if failures:
+        raise failures[min(failures)]
+
+def index_bam(bam_fp, threads=1):
+    """index the given bam if it doesn't already have an up to date index"""
+    if get_bam_index_fp(bam_fp) is None:
         logging.info('indexing bam')
-        tool_args = ('samtools', 'index', bam_fp)
-        subprocess.check_output(tool_args)
+        tool_args = ('samtools', 'index') + samtools_thread_args(threads) + (bam_fp,)
+        instrumentation.execute(tool_args)
+
+# sort order each step needs its input in, and the sort order of its output.
+# None means any order, or for outputs the same order as the input.
+STEP_SORT_ORDERS = {
+    'fixmates': ('queryname', 'queryname'),
+    'properly_paired': (None, None),
+    'fixmates_and_filter': (None, 'coordinate'),
+    'fix_255_mapping_quality': (None, None),
+    'streaming_read_groups': (None, 'coordinate'),
+    'add_or_replace_read_groups': ('coordinate', 'coordinate'),
+    'mark_duplicates': ('coordinate', 'coordinate'),
+    'split_n_cigar_reads': ('coordinate', 'coordinate'),
+    'base_recalibration': ('coordinate', 'coordinate'),
+    }
+
+class BamFile(object):
+    """Handle on a bam that carries what is already known about it between steps, so
+    a workflow only sorts or indexes when something actually changed.
+
+    sort_order is 'coordinate', 'queryname', 'unsorted' or None if it isn't known yet,
+    in which case it is read from the bam the first time it is needed. provenance is
+    the list of steps that produced the bam.
+    """
+    def __init__(self, fp, sort_order=None, provenance=()):
+        self.fp = fp
+        self.known_sort_order = sort_order
+        self.provenance = list(provenance)
+
+    @property
+    def sort_order(self):
+        if self.known_sort_order is None:
+            self.known_sort_order = get_sort_order(self.fp)
+        return self.known_sort_order
+
+    @property
+    def index_fp(self):
+        return get_bam_index_fp(self.fp)
+
+    def derive(self, fp, step):
+        """Returns a handle for the bam step writes to fp when run on this bam"""
+        produced = STEP_SORT_ORDERS[step][1]
+        return BamFile(fp, sort_order=produced or self.known_sort_order,
+                provenance=self.provenance + [step])
+
+def as_bam_file(bam):
+    return bam if isinstance(bam, BamFile) else BamFile(bam)
+
+def prepare_input(bam, step, temp_files_dir=os.getcwd(), threads=1, sort_memory='10G',
+        indexed=False):
+    """Sorts bam into the order step needs, and indexes it if indexed is True, only
+    doing either if it isn't already.
+
+    Returns
+        prepared - BamFile to run the step on, either bam or a temporary sorted copy
+            that should be removed with remove_prepared_input
+    """
+    bam = as_bam_file(bam)
+    required = STEP_SORT_ORDERS[step][0]
+    prepared = bam
+    if required is not None and bam.sort_order != required:
+        sorted_fp = create_sorted_bam(bam.fp, name_sorted=required == 'queryname',
+                temp_files_dir=temp_files_dir, threads=threads, max_memory=sort_memory)
+        prepared = BamFile(sorted_fp, sort_order=required, provenance=bam.provenance + ['sort'])
+    # indexing isn't a dag step of its own, the only step reading an intermediate is the
+    # one after it and that step can't start until it has the index
+    if indexed:
+        index_bam(prepared.fp, threads=threads)
+
+    return prepared
+
+def remove_prepared_input(bam, prepared):
+    """Removes prepared if it is a temporary copy of bam"""
+    if prepared.fp != as_bam_file(bam).fp:
+        scratch.consumed(prepared.fp)
+
+def finalize_output(bam, temp_files_dir=os.getcwd(), threads=1, sort_memory='10G'):
+    """Makes sure a workflow output is coordinate sorted with a samtools style index
+    (output.bam.bai) next to it. Sorting and indexing are skipped when the handle
+    says they were already done, i.e. by gatk."""
+    bam = as_bam_file(bam)
+    if bam.sort_order != 'coordinate':
+        remove_bam_index(bam.fp)
+        sorted_fp = create_sorted_bam(bam.fp, temp_files_dir=temp_files_dir, threads=threads,
+                max_memory=sort_memory)
+        shutil.move(sorted_fp, bam.fp)
+        scratch.consumed(sorted_fp)
+        bam = BamFile(bam.fp, sort_order='coordinate', provenance=bam.provenance + ['sort'])
+
+    index_fp = bam.index_fp
+    if index_fp is None:
+        index_bam(bam.fp, threads=threads)
+    elif index_fp != f'{bam.fp}.bai':
+        os.replace(index_fp, f'{bam.fp}.bai')
+    logging.info(f'{bam.fp} produced by: {" -> ".join(bam.provenance)}')
+
+    return bam
+
+def create_shard_intervals(shards, temp_files_dir=os.getcwd()):
+    """Returns the gatk -L value for each shard, writing interval files where needed"""
+    intervals = []
+    for shard in shards:
+        if shard == [bam_sharding.UNMAPPED_INTERVAL]:
+            intervals.append(bam_sharding.UNMAPPED_INTERVAL)
+        else:
+            intervals.append(bam_sharding.write_intervals(shard,
+                    scratch.temp_path(temp_files_dir, 'shard', '.intervals', small=True)))
+    return intervals
+
+def remove_shard_intervals(intervals):
+    for interval in intervals:
+        if interval != bam_sharding.UNMAPPED_INTERVAL:
+            scratch.consumed(interval)
+
+def run_shards(run_shard, intervals, workers):
+    """Calls run_shard(i, intervals) for every shard, with up to workers running at once.
+
+    Each shard is an external jvm, so the pool only has to wait on subprocesses.
+
+    Returns
+        outputs - list of run_shard return values in shard order
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # each shard gets a copy of the callers context so it reports to the same run
+        futures = [pool.submit(contextvars.copy_context().run, run_shard, i, shard_intervals)
+                for i, shard_intervals in enumerate(intervals)]
+        return [future.result() for future in futures]
+
+def gather_shards(shard_fps, output_fp, threads=1):
+    """Merges coordinate sorted shard bams into output_fp, indexing it the way gatk
+    would (output.bai) in the same pass, then removes the shards. Shards of whole
+    contigs are concatenated without recompressing, see bam_merge"""
+    logging.info('gathering shards')
+    bam_merge.merge_bams(shard_fps, output_fp, index_fp=re.sub(r'\.bam$', '.bai', output_fp),
+            threads=threads)
+
+    for shard_fp in shard_fps:
+        scratch.consumed(shard_fp)
+
+def faidx(reference_fp):
+    return ('samtools', 'faidx', reference_fp)
+
+def get_sequence_dict_fp(reference_fp):
+    return re.sub(r'.[^.]*$', '.dict', reference_fp)
+
+def create_sequence_dictionary(reference_fp):
+    tool_args = ('picard', 'CreateSequenceDictionary',
+            f'R={reference_fp}',
+            'O=' + get_sequence_dict_fp(reference_fp),
+            )
+
+    return tool_args
+
+def tabix(bgzip_vcf_fp):
+    return ('tabix', '-p', 'vcf', bgzip_vcf_fp)
 
 def index_reference(reference_fp):
     if not os.path.isfile(f'{reference_fp}.fai'):
         logging.info('indexing reference')
-        tool_args = ('samtools', 'faidx', reference_fp)
-        subprocess.check_output(tool_args)
+        instrumentation.execute(faidx(reference_fp))
 
 def create_reference_sequence_dict(reference_fp):
     index_reference(reference_fp)
 
-    output_fp = re.sub(r'.[^.]*$', '.dict', reference_fp)
-    if not os.path.isfile(output_fp):
+    if not os.path.isfile(get_sequence_dict_fp(reference_fp)):
         logging.info('creating reference sequence dictionary')
-        tool_args = ('picard', 'CreateSequenceDictionary',
-                f'R={reference_fp}',
-                'O=' + output_fp,
-                )
-        subprocess.check_output(tool_args)
+        instrumentation.execute(create_sequence_dictionary(reference_fp))
 
 def index_vcf(bgzip_vcf_fp):
     if not os.path.isfile(f'{bgzip_vcf_fp}.tbi'):
-        tool_args = ('tabix', '-p', 'vcf', bgzip_vcf_fp)
-        subprocess.check_output(tool_args)
-
-
-def add_or_replace_read_groups(input_fp='/dev/stdin', output_fp='/dev/stdout'):
-    tool_args = ('picard', 'AddOrReplaceReadGroups',
-            f'I={input_fp}',
-            f'O={output_fp}',
-            'SO=coordinate', 'RGID=id', 'RGLB=library',
-            'RGPL=platform', 'RGPU=machine', 'RGSM=sample')
+        instrumentation.execute(tabix(bgzip_vcf_fp))
 
-    return tool_args
-
-def run_add_or_replace_read_groups(input_fp, output_fp, temp_files_dir=os.getcwd()):
-    # sort and index if needed
-    sorted_input_fp = create_sorted_bam(input_fp, temp_files_dir=temp_files_dir)
-    index_bam(sorted_input_fp)
+def reference_steps(reference_fp, known_sites_fp=None):
+    """Returns dag steps that index the reference, create its sequence dictionary and
+    index the known sites, for whichever of them isn't done yet"""
+    steps = []
+    if not os.path.isfile(f'{reference_fp}.fai'):
+        steps.append(dag.Step('index_reference', faidx(reference_fp)))
+    if not os.path.isfile(get_sequence_dict_fp(reference_fp)):
+        steps.append(dag.Step('create_reference_sequence_dict',
+                create_sequence_dictionary(reference_fp)))
+    if known_sites_fp is not None and not os.path.isfile(f'{known_sites_fp}.tbi'):
+        steps.append(dag.Step('index_vcf', tabix(known_sites_fp)))
+
+    return steps
+
+def get_jvm_step_names(steps):
+    """Returns the names of the steps that start a jvm, i.e. CreateSequenceDictionary.
+    Their heap isn't budgeted next to sorts (see resource_plan.make_plan), so bam steps
+    wait for them"""
+    return [step.name for step in steps
+            if not callable(step.run) and step.run[0] in jvm_executor.MAIN_CLASSES]
+
+
+def add_or_replace_read_groups(input_fp='/dev/stdin', output_fp='/dev/stdout',
+        read_group=None, from_header=False, uncompressed=False, threads=1):
+    """Returns a python pipeline stage that stamps a single read group on every record,
+    see bam_stages.add_read_group"""
+    compression_level = 0 if uncompressed else 6
+    def stage(input_f, output_f):
+        bam_stages.add_read_group(input_f or input_fp, output_f or output_fp,
+                read_group=read_group, from_header=from_header, threads=threads,
+                compression_level=compression_level)
+    stage.__qualname__ = 'add_read_group'
+    stage.input_fp = input_fp
+
+    return stage
+
+def run_add_or_replace_read_groups(input_fp, output_fp, temp_files_dir=os.getcwd(),
+        threads=1, sort_memory='10G', read_group=None, read_group_from_header=False):
+    """Coordinate sorts the input if needed and stamps a single read group on every
+    record. read_group is a dict of @RG fields (ID, SM, LB, PL, PU) overriding the
+    defaults, or the first @RG of the input header if read_group_from_header is True."""
+    sorted_input = prepare_input(input_fp, 'add_or_replace_read_groups',
+            temp_files_dir=temp_files_dir, threads=threads, sort_memory=sort_memory)
 
-    tool_args = add_or_replace_read_groups(input_fp=sorted_input_fp, output_fp=output_fp)
     logging.info('running add or replace read groups')
-    logging.info(f'executing command: {tool_args}')
-    output = subprocess.check_output(tool_args).decode('utf-8')
+    read_group = instrumentation.run_python_stage('add_read_group',
+            bam_stages.add_read_group, sorted_input.fp, output_fp, read_group=read_group,
+            from_header=read_group_from_header, threads=threads, input_fp=sorted_input.fp)
+    logging.info(f'added read group {read_group}')
 
-    if sorted_input_fp != input_fp:
-        os.remove(sorted_input_fp)
-        os.remove(sorted_input_fp + '.bai')
+    remove_prepared_input(input_fp, sorted_input)
 
-    return output
-
-def split_n_cigar_reads(reference_fp, input_fp='/dev/stdin', output_fp='/dev/stdout'):
-    tool_args = ('gatk', 'SplitNCigarReads',
+def split_n_cigar_reads(reference_fp, input_fp='/dev/stdin', output_fp='/dev/stdout',
+        max_mem=None, intervals=None):
+    tool_args = gatk_args('SplitNCigarReads', max_mem=max_mem) + (
             '-R', reference_fp,
             '-I', input_fp,
-            '-O', output_fp)
+            '-O', output_fp) + gatk_interval_args(intervals)
 
     return tool_args
 
+def run_sharded_split_n_cigar_reads(input_fp, output_fp, reference_fp, workers,
+        temp_files_dir=os.getcwd(), threads=1, max_mem=None):
+    """Runs split n cigar reads on shards of whole contigs, with up to workers jvms at once,
+    and merges the shards into a single coordinate sorted and indexed output.
+
+    input_fp must be coordinate sorted and indexed.
+    """
+    shards = bam_sharding.create_shards(reference_fp, workers,
+            bam_index_fp=get_bam_index_fp(input_fp))
+    intervals = create_shard_intervals(shards, temp_files_dir=temp_files_dir)
+    shard_fps = [scratch.temp_path(temp_files_dir, 'split.shard', '.bam') for _ in shards]
+
+    def run_shard(i, shard_intervals):
+        tool_args = split_n_cigar_reads(reference_fp, input_fp=input_fp,
+                output_fp=shard_fps[i], max_mem=max_mem, intervals=shard_intervals)
+        logging.info(f'executing command: {tool_args}')
+        return instrumentation.execute(tool_args).decode('utf-8')
+
+    logging.info(f'running split n cigar reads on {len(shards)} shards')
+    outputs = run_shards(run_shard, intervals, workers)
+    gather_shards(shard_fps, output_fp, threads=threads)
+    remove_shard_intervals(intervals)
+
+    return '\n\n'.join(outputs)
+
 def run_split_n_cigar_reads(input_fp, output_fp, reference_fp,
-        temp_files_dir=os.getcwd()):
-    # sort and index if needed
-    sorted_input_fp = create_sorted_bam(input_fp, temp_files_dir=temp_files_dir)
-    index_bam(sorted_input_fp)
+        temp_files_dir=os.getcwd(), threads=1, sort_memory='10G', max_mem=None, workers=1,
+        splitter='gatk'):
+    """Splits reads at N cigar operations with gatk SplitNCigarReads, or with bam_splitn
+    if splitter is 'native'"""
+    if splitter not in SPLITTERS:
+        raise ValueError(f'splitter must be one of {", ".join(SPLITTERS)}')
 
     # make sure reference is prepared
     index_reference(reference_fp)
 
-    tool_args = split_n_cigar_reads(reference_fp, input_fp=sorted_input_fp, output_fp=output_fp)
-    logging.info('running split n cigar reads')
-    logging.info(f'executing command: {tool_args}')
-    output = subprocess.check_output(tool_args).decode('utf-8')
+    if splitter == 'native':
+        # the native splitter splits contigs between processes with the help of an index
+        sorted_input = prepare_input(input_fp, 'split_n_cigar_reads',
+                temp_files_dir=temp_files_dir, threads=threads, sort_memory=sort_memory,
+                indexed=threads > 1)
+        logging.info('running native split n cigar reads')
+        instrumentation.run_python_stage('split_n_cigar_reads',
+                bam_splitn.split_n_cigar_reads, sorted_input.fp, output_fp, reference_fp,
+                threads=threads, index_fp=sorted_input.index_fp,
+                temp_files_dir=temp_files_dir, input_fp=sorted_input.fp)
+        remove_prepared_input(input_fp, sorted_input)
+        return
+
+    # sort if needed, only shards are read by interval so need an index
+    sorted_input = prepare_input(input_fp, 'split_n_cigar_reads',
+            temp_files_dir=temp_files_dir, threads=threads, sort_memory=sort_memory,
+            indexed=workers > 1)
+
+    if workers > 1:
+        output = run_sharded_split_n_cigar_reads(sorted_input.fp, output_fp, reference_fp,
+                workers, temp_files_dir=temp_files_dir, threads=threads, max_mem=max_mem)
+    else:
+        tool_args = split_n_cigar_reads(reference_fp, input_fp=sorted_input.fp,
+                output_fp=output_fp, max_mem=max_mem)
+        logging.info('running split n cigar reads')
+        logging.info(f'executing command: {tool_args}')
+        output = instrumentation.execute(tool_args).decode('utf-8')
 
-    if sorted_input_fp != input_fp:
-        os.remove(sorted_input_fp)
-        os.remove(sorted_input_fp + '.bai')
+    remove_prepared_input(input_fp, sorted_input)
 
     return output
 
 def mark_duplicates(input_fp='/dev/stdin', output_fp='/dev/stdout', max_records_in_ram=100000,
         temp_dir='temp_dir', metrics_fp='output.metrics', max_mem='1g'):
-    tool_args = ('picard', '-Xmx' + max_mem, 'MarkDuplicates',
+    tool_args = picard_args('MarkDuplicates', max_mem=max_mem) + (
             f'I={input_fp}',
             f'O={output_fp}',
             f'ASSUME_SORT_ORDER=coordinate',
@@ -140,239 +609,651 @@ def mark_duplicates(input_fp='/dev/stdin', output_fp='/dev/stdout', max_records_
 
     return tool_args
 
-def run_mark_duplicates(input_fp, output_fp, temp_files_dir=os.getcwd(), max_mem='1g'):
-    # sort and index if needed
-    sorted_input_fp = create_sorted_bam(input_fp, temp_files_dir=temp_files_dir)
-    index_bam(sorted_input_fp)
-    metrics_fp = os.path.join(temp_files_dir, f'output.{uuid.uuid4()}.metrics')
-    temp_dir = os.path.join(temp_files_dir, f'temp_{uuid.uuid4()}_dir')
+def run_mark_duplicates(input_fp, output_fp, temp_files_dir=os.getcwd(), max_mem='1g',
+        threads=1, sort_memory='10G', max_records_in_ram=100000, duplicate_marker='picard',
+        metrics_fp=None, reference_fp=None, known_sites_fp=None, recal_table_fp=None):
+    """Marks duplicates with picard, or with bam_markdup if duplicate_marker is 'native'.
+
+    Duplication metrics are written to metrics_fp if it is given. With the native
+    marker, if recal_table_fp is given the base recalibration table of the output is
+    collected against reference_fp and known_sites_fp in the same pass and written to
+    it, ready for run_base_recalibration.
+    """
+    if duplicate_marker not in DUPLICATE_MARKERS:
+        raise ValueError(f'duplicate_marker must be one of {", ".join(DUPLICATE_MARKERS)}')
+    if recal_table_fp is not None and duplicate_marker != 'native':
+        raise ValueError('recalibration tables can only be collected by the native '
+                'duplicate marker')
+
+    if duplicate_marker == 'native':
+        # the native marker splits contigs between processes with the help of an index
+        sorted_input = prepare_input(input_fp, 'mark_duplicates',
+                temp_files_dir=temp_files_dir, threads=threads, sort_memory=sort_memory,
+                indexed=threads > 1)
+        logging.info('running native mark duplicates')
+        instrumentation.run_python_stage('mark_duplicates', bam_markdup.mark_duplicates,
+                sorted_input.fp, output_fp, metrics_fp=metrics_fp, threads=threads,
+                index_fp=sorted_input.index_fp, reference_fp=reference_fp,
+                known_sites_fp=known_sites_fp, recal_table_fp=recal_table_fp,
+                temp_files_dir=temp_files_dir, input_fp=sorted_input.fp)
+        remove_prepared_input(input_fp, sorted_input)
+        return
+
+    # sort if needed, picard doesn't need an index
+    sorted_input = prepare_input(input_fp, 'mark_duplicates', temp_files_dir=temp_files_dir,
+            threads=threads, sort_memory=sort_memory)
+    keep_metrics = metrics_fp is not None
+    if not keep_metrics:
+        metrics_fp = scratch.temp_path(temp_files_dir, 'output', '.metrics', small=True)
+    temp_dir = scratch.temp_path(temp_files_dir, 'temp', '_dir')
     os.mkdir(temp_dir)
 
-    tool_args = mark_duplicates(input_fp=sorted_input_fp, output_fp=output_fp,
-            temp_dir=temp_dir, metrics_fp=metrics_fp, max_mem=max_mem)
+    tool_args = mark_duplicates(input_fp=sorted_input.fp, output_fp=output_fp,
+            temp_dir=temp_dir, metrics_fp=metrics_fp, max_mem=max_mem,
+            max_records_in_ram=max_records_in_ram)
     logging.info('running mark duplicates')
     logging.info(f'executing command: {tool_args}')
-    output = subprocess.check_output(tool_args).decode('utf-8')
+    output = instrumentation.execute(tool_args).decode('utf-8')
 
-    os.remove(metrics_fp)
-    if sorted_input_fp != input_fp:
-        os.remove(sorted_input_fp)
-        os.remove(sorted_input_fp + '.bai')
+    if not keep_metrics:
+        scratch.consumed(metrics_fp)
+    remove_prepared_input(input_fp, sorted_input)
 
     # remove temporary directory
-    shutil.rmtree(temp_dir)
+    scratch.consumed(temp_dir)
 
     return output
 
-def base_recalibrator_table(input_fp, output_fp, reference_fp, known_sites_fp):
-    tool_args = ('gatk', 'BaseRecalibrator',
+def base_recalibrator_table(input_fp, output_fp, reference_fp, known_sites_fp, max_mem=None,
+        intervals=None):
+    tool_args = gatk_args('BaseRecalibrator', max_mem=max_mem) + (
             '-I', input_fp,
             '-R', reference_fp,
             '--known-sites', known_sites_fp,
-            '-O', output_fp)
+            '-O', output_fp) + gatk_interval_args(intervals)
+
+    return tool_args
+
+def gather_base_recalibrator_tables(table_fps, output_fp, max_mem=None):
+    tool_args = gatk_args('GatherBQSRReports', max_mem=max_mem)
+    for table_fp in table_fps:
+        tool_args += ('-I', table_fp)
+    tool_args += ('-O', output_fp)
 
     return tool_args
 
-def base_recalibration(input_fp, output_fp, reference_fp, table_fp):
-    tool_args = ['gatk', 'ApplyBQSR',
+def base_recalibration(input_fp, output_fp, reference_fp, table_fp, max_mem=None,
+        intervals=None):
+    tool_args = gatk_args('ApplyBQSR', max_mem=max_mem) + (
             '-I', input_fp,
             '-R', reference_fp,
             '--bqsr-recal-file', table_fp,
-            '-O', output_fp]
+            '-O', output_fp) + gatk_interval_args(intervals)
     return tool_args
 
+def run_sharded_base_recalibration(input_fp, output_fp, reference_fp, known_sites_fp, workers,
+        temp_files_dir=os.getcwd(), threads=1, max_mem=None, table_fp=None):
+    """Runs BaseRecalibrator and ApplyBQSR on shards of whole contigs, with up to workers
+    jvms at once. Shard tables are gathered into a single model before it is applied,
+    so results match an unsharded run. If table_fp is given the model is read from it
+    and only ApplyBQSR runs.
+
+    input_fp must be coordinate sorted and indexed.
+    """
+    shards = bam_sharding.create_shards(reference_fp, workers,
+            bam_index_fp=get_bam_index_fp(input_fp))
+    intervals = create_shard_intervals(shards, temp_files_dir=temp_files_dir)
+    # unplaced reads are never used for recalibration
+    mapped_intervals = [i for i in intervals if i != bam_sharding.UNMAPPED_INTERVAL]
+    keep_table = table_fp is not None
+    table_fps = []
+    if not keep_table:
+        table_fps = [scratch.temp_path(temp_files_dir, 'output.shard', '.table', small=True)
+                for _ in mapped_intervals]
+        table_fp = scratch.temp_path(temp_files_dir, 'output', '.table', small=True)
+    shard_fps = [scratch.temp_path(temp_files_dir, 'bqsr.shard', '.bam') for _ in shards]
+
+    def run_table_shard(i, shard_intervals):
+        tool_args = base_recalibrator_table(input_fp, table_fps[i], reference_fp,
+                known_sites_fp, max_mem=max_mem, intervals=shard_intervals)
+        logging.info(f'executing command: {tool_args}')
+        return instrumentation.execute(tool_args).decode('utf-8')
+
+    def run_apply_shard(i, shard_intervals):
+        tool_args = base_recalibration(input_fp, shard_fps[i], reference_fp, table_fp,
+                max_mem=max_mem, intervals=shard_intervals)
+        logging.info(f'executing command: {tool_args}')
+        return instrumentation.execute(tool_args).decode('utf-8')
+
+    logging.info(f'running base recalibration on {len(shards)} shards')
+    outputs = []
+    if not keep_table:
+        outputs += run_shards(run_table_shard, mapped_intervals, workers)
+
+        tool_args = gather_base_recalibrator_tables(table_fps, table_fp, max_mem=max_mem)
+        logging.info(f'executing command: {tool_args}')
+        outputs.append(instrumentation.execute(tool_args).decode('utf-8'))
+        for fp in table_fps:
+            scratch.consumed(fp)
+
+    outputs += run_shards(run_apply_shard, intervals, workers)
+    gather_shards(shard_fps, output_fp, threads=threads)
+    remove_shard_intervals(intervals)
+    if not keep_table:
+        scratch.consumed(table_fp)
+
+    return '\n\n'.join(outputs)
+
 def run_base_recalibration(input_fp, output_fp, reference_fp, known_sites_fp,
-        temp_files_dir=os.getcwd()):
+        temp_files_dir=os.getcwd(), threads=1, sort_memory='10G', max_mem=None, workers=1,
+        table_fp=None):
+    """Recalibrates base qualities with BaseRecalibrator and ApplyBQSR.
+
+    If table_fp is an existing recalibration table of the input, such as one collected
+    by run_mark_duplicates, BaseRecalibrator is skipped and only ApplyBQSR runs.
+    """
+    if table_fp is not None and not os.path.isfile(table_fp):
+        table_fp = None
+
     # make sure reference is prepared
     index_reference(reference_fp)
     create_reference_sequence_dict(reference_fp)
 
-    # sort and index bam if needed
-    sorted_input_fp = create_sorted_bam(input_fp, temp_files_dir=temp_files_dir)
-    index_bam(sorted_input_fp)
+    # sort if needed, only shards are read by interval so need an index
+    sorted_input = prepare_input(input_fp, 'base_recalibration',
+            temp_files_dir=temp_files_dir, threads=threads, sort_memory=sort_memory,
+            indexed=workers > 1)
 
-    table_fp = os.path.join(temp_files_dir, f'output.{str(uuid.uuid4())}.table')
-    tool_args = base_recalibrator_table(sorted_input_fp, table_fp, reference_fp, known_sites_fp)
-    output = subprocess.check_output(tool_args).decode('utf-8')
+    if workers > 1:
+        output = run_sharded_base_recalibration(sorted_input.fp, output_fp, reference_fp,
+                known_sites_fp, workers, temp_files_dir=temp_files_dir, threads=threads,
+                max_mem=max_mem, table_fp=table_fp)
+    else:
+        output = ''
+        keep_table = table_fp is not None
+        if not keep_table:
+            table_fp = scratch.temp_path(temp_files_dir, 'output', '.table', small=True)
+            tool_args = base_recalibrator_table(sorted_input.fp, table_fp, reference_fp,
+                    known_sites_fp, max_mem=max_mem)
+            output = instrumentation.execute(tool_args).decode('utf-8') + '\n\n'
+
+        tool_args = base_recalibration(sorted_input.fp, output_fp, reference_fp, table_fp,
+                max_mem=max_mem)
+        output += instrumentation.execute(tool_args).decode('utf-8')
+
+        if not keep_table:
+            scratch.consumed(table_fp)
+    remove_prepared_input(input_fp, sorted_input)
 
-    tool_args = base_recalibration(sorted_input_fp, output_fp, reference_fp, table_fp)
-    output += '\n\n' + subprocess.check_output(tool_args).decode('utf-8')
+    return output
 
-    os.remove(table_fp)
-    if sorted_input_fp != input_fp:
-        os.remove(sorted_input_fp)
-        os.remove(sorted_input_fp + '.bai')
+def name_sort(input_fp='/dev/stdin', output_fp='/dev/stdout', max_memory='10G',
+        temp_files_dir=os.getcwd(), uncompressed=False, threads=1):
+    tool_args = ('samtools', 'sort', '-n') + samtools_thread_args(threads) + (
+            '-m', split_memory(max_memory, threads),
+            '-T', scratch.temp_path(temp_files_dir, 'sort'), '-o', output_fp)
+    if uncompressed:
+        tool_args += ('-u',)
+    tool_args += (input_fp,)
 
-    return output
+    return tool_args
 
-def fixmates(input_fp='/dev/stdin', output_fp='/dev/stdout'):
-    tool_args = ('samtools', 'fixmate', input_fp, output_fp)
+def fixmates(input_fp='/dev/stdin', output_fp='/dev/stdout', uncompressed=False, threads=1):
+    tool_args = ('samtools', 'fixmate') + samtools_thread_args(threads)
+    if uncompressed:
+        tool_args += ('-u',)
+    tool_args += (input_fp, output_fp)
 
     return tool_args
 
-def run_fixmates(input_fp, output_fp, temp_files_dir=os.getcwd()):
-    # sort and index bam if needed
-    sorted_input_fp = create_sorted_bam(input_fp, name_sorted=True, temp_files_dir=temp_files_dir)
+def run_fixmates(input_fp, output_fp, temp_files_dir=os.getcwd(), threads=1, sort_memory='10G'):
+    # name sort if needed
+    sorted_input = prepare_input(input_fp, 'fixmates', temp_files_dir=temp_files_dir,
+            threads=threads, sort_memory=sort_memory)
 
-    tool_args = fixmates(input_fp=sorted_input_fp, output_fp=output_fp)
+    tool_args = fixmates(input_fp=sorted_input.fp, output_fp=output_fp, threads=threads)
     logging.info('running fixmates')
     logging.info(f'executing command: {tool_args}')
-    subprocess.check_output(tool_args)
+    instrumentation.execute(tool_args)
 
-    if sorted_input_fp != input_fp:
-        os.remove(sorted_input_fp)
+    remove_prepared_input(input_fp, sorted_input)
 
-def properly_paired(input_fp='/dev/stdin', output_fp='/dev/stdout'):
-    tool_args = ('samtools', 'view', '-h', '-f', '0x2', '-F', '0x4', '-F', '0x8', '-F', '0x100',
-            '-F', '0x200', '-F', '0x800', '-o', output_fp, input_fp)
+def coordinate_sort(input_fp='/dev/stdin', output_fp='/dev/stdout', max_memory='10G',
+        temp_files_dir=os.getcwd(), threads=1):
+    tool_args = ('samtools', 'sort') + samtools_thread_args(threads) + (
+            '-m', split_memory(max_memory, threads),
+            '-T', scratch.temp_path(temp_files_dir, 'sort'), '-o', output_fp, input_fp)
 
     return tool_args
 
-def run_properly_paired(input_fp, output_fp, temp_files_dir=os.getcwd()):
-    # sort and index bam if needed
-    sorted_input_fp = create_sorted_bam(input_fp, temp_files_dir=temp_files_dir)
-    index_bam(sorted_input_fp)
+def run_fixmates_and_filter(input_fp, output_fp, temp_files_dir=os.getcwd(), threads=1,
+        sort_memory='10G', read_filter='properly_paired'):
+    """Fills in mate fields and drops reads failing read_filter (properly paired by
+    default) on the name sorted stream, then coordinate sorts straight into output_fp.
 
-    tool_args = properly_paired(input_fp=sorted_input_fp, output_fp=output_fp)
-    logging.info('running properly paired')
-    logging.info(f'executing command: {tool_args}')
-    subprocess.check_output(tool_args)
+    Runs as a single pipe, so the only bam written is the coordinate sorted output.
+    The name sort is skipped if the input is already name sorted. When both sorts run
+    they are alive at the same time, so sort_memory is split between them.
+    """
+    input_bam = as_bam_file(input_fp)
+    name_sort_needed = input_bam.sort_order != 'queryname'
+    n_sorts = 1 + name_sort_needed
+    sort_threads = split_threads(threads, n_sorts)
+    stage_memory = split_memory(sort_memory, n_sorts)
+
+    stages = []
+    if name_sort_needed:
+        stages.append(name_sort(input_fp=input_bam.fp, temp_files_dir=temp_files_dir,
+                uncompressed=True, threads=sort_threads, max_memory=stage_memory))
+        stages.append(fixmates(uncompressed=True, threads=sort_threads))
+    else:
+        stages.append(fixmates(input_fp=input_bam.fp, uncompressed=True, threads=sort_threads))
+    stages.append(filter_stage(read_filter, uncompressed=True, threads=sort_threads))
+    stages.append(coordinate_sort(output_fp=output_fp, temp_files_dir=temp_files_dir,
+            threads=sort_threads, max_memory=stage_memory))
+
+    logging.info('running fixmates and read filter')
+    run_pipeline(stages)
+
+def filter_stage(read_filter, input_fp='/dev/stdin', output_fp='/dev/stdout',
+        uncompressed=False, threads=1):
+    """Returns a python pipeline stage that keeps records passing read_filter (a
+    bam_filter preset name or filter spec)"""
+    compression_level = 0 if uncompressed else 6
+    def stage(input_f, output_f):
+        bam_filter.filter_records(input_f or input_fp, output_f or output_fp,
+                record_filter=read_filter, threads=threads,
+                compression_level=compression_level)
+    stage.__qualname__ = 'filter_records'
+    stage.input_fp = input_fp
+
+    return stage
+
+def properly_paired(input_fp='/dev/stdin', output_fp='/dev/stdout', uncompressed=False,
+        threads=1):
+    return filter_stage('properly_paired', input_fp=input_fp, output_fp=output_fp,
+            uncompressed=uncompressed, threads=threads)
+
+def run_properly_paired(input_fp, output_fp, temp_files_dir=os.getcwd(), threads=1,
+        sort_memory='10G', read_filter='properly_paired'):
+    """Filters to properly paired alignments, or whatever read_filter is given. A flag
+    filter works in any sort order, so the output keeps the order of the input.
+
+    If the input is indexed the filter is split over up to threads processes.
+    """
+    input_bam = as_bam_file(input_fp)
+    logging.info(f'running read filter {read_filter}')
+    instrumentation.run_python_stage('filter_records', bam_filter.filter_records,
+            input_bam.fp, output_fp, record_filter=read_filter, threads=threads,
+            index_fp=input_bam.index_fp, temp_files_dir=temp_files_dir,
+            input_fp=input_bam.fp)
+
+def fix_255_mapping_quality_stage(input_fp='/dev/stdin', output_fp='/dev/stdout',
+        uncompressed=False, threads=1):
+    """Returns a python pipeline stage that rewrites 255 mapping qualities to 60"""
+    compression_level = 0 if uncompressed else 6
+    def stage(input_f, output_f):
+        bam_stages.fix_255_mapping_quality(input_f or input_fp, output_f or output_fp,
+                threads=threads, compression_level=compression_level)
+    stage.__qualname__ = 'fix_255_mapping_quality'
+    stage.input_fp = input_fp
+
+    return stage
+
+def run_fix_255_mapping_quality(input_fp, output_fp, threads=1):
+    logging.info('running fix 255 mapping quality')
+    input_fp = as_bam_file(input_fp).fp
+    instrumentation.run_python_stage('fix_255_mapping_quality',
+            bam_stages.fix_255_mapping_quality, input_fp, output_fp, threads=threads,
+            input_fp=input_fp)
+
+def run_streaming_read_groups(input_fp, output_fp, fixmate=False, properly_paired_only=False,
+        fix_255_mapping_quality=False, temp_files_dir=os.getcwd(), threads=1,
+        sort_memory='10G', read_filter='properly_paired', read_group=None,
+        read_group_from_header=False):
+    """Runs the optional fixmates, properly paired and fix 255 mapping quality steps
+    followed by add or replace read groups as a single pipe.
+
+    Uncompressed bam is passed between steps and only the read group output is written
+    to disk (coordinate sorted). All stages run at the same time, so the thread budget
+    is split between the samtools and native stages, and the sort memory between the
+    name and coordinate sorts.
+    """
+    input_bam = as_bam_file(input_fp)
+    # name sort for fixmate only if the input isn't name sorted already
+    name_sort_needed = fixmate and input_bam.sort_order != 'queryname'
+    # fixmate leaves reads in name order, other stages keep the input order
+    coordinate_sort_needed = fixmate or input_bam.sort_order != 'coordinate'
+    n_stages = name_sort_needed + fixmate + properly_paired_only + fix_255_mapping_quality + \
+            coordinate_sort_needed
+    stage_threads = split_threads(threads, max(1, n_stages))
+    stage_memory = split_memory(sort_memory, max(1, name_sort_needed + coordinate_sort_needed))
+
+    stages = []
+    if name_sort_needed:
+        stages.append(name_sort(input_fp=input_bam.fp, temp_files_dir=temp_files_dir,
+                uncompressed=True, threads=stage_threads, max_memory=stage_memory))
+    if fixmate:
+        if not stages:
+            stages.append(fixmates(input_fp=input_bam.fp, uncompressed=True,
+                    threads=stage_threads))
+        else:
+            stages.append(fixmates(uncompressed=True, threads=stage_threads))
+    if properly_paired_only:
+        if not stages:
+            stages.append(filter_stage(read_filter, input_fp=input_bam.fp,
+                    uncompressed=True, threads=stage_threads))
+        else:
+            stages.append(filter_stage(read_filter, uncompressed=True,
+                    threads=stage_threads))
+    if fix_255_mapping_quality:
+        if not stages:
+            stages.append(fix_255_mapping_quality_stage(input_fp=input_bam.fp,
+                    uncompressed=True, threads=stage_threads))
+        else:
+            stages.append(fix_255_mapping_quality_stage(uncompressed=True,
+                    threads=stage_threads))
+
+    if not stages:
+        run_add_or_replace_read_groups(input_bam, output_fp, temp_files_dir=temp_files_dir,
+                threads=threads, sort_memory=sort_memory, read_group=read_group,
+                read_group_from_header=read_group_from_header)
+        return
+
+    if coordinate_sort_needed:
+        stages.append(add_or_replace_read_groups(read_group=read_group,
+                from_header=read_group_from_header, uncompressed=True, threads=stage_threads))
+        stages.append(coordinate_sort(output_fp=output_fp, temp_files_dir=temp_files_dir,
+                threads=stage_threads, max_memory=stage_memory))
+    else:
+        stages.append(add_or_replace_read_groups(output_fp=output_fp, read_group=read_group,
+                from_header=read_group_from_header, threads=stage_threads))
+    logging.info('running streaming preprocessing')
+    run_pipeline(stages)
+
+def remove_bam_index(bam_fp):
+    """Removes any index next to the bam (samtools .bam.bai or picard/gatk .bai)"""
+    for index_fp in (f'{bam_fp}.bai', re.sub(r'\.bam$', '.bai', bam_fp)):
+        if index_fp != bam_fp and os.path.isfile(index_fp):
+            os.remove(index_fp)
+
+def remove_bam(bam_fp):
+    """Removes bam and any index next to it"""
+    remove_bam_index(bam_fp)
+    if os.path.isfile(bam_fp):
+        os.remove(bam_fp)
+
+def run_chain_link(cache, link, input_bam, output, consumes):
+    step_cache.run_cached_step(cache, link['step'],
+            lambda: link['run'](input_bam, output.fp),
+            [input_bam.fp] + list(link.get('inputs', ())), output.fp,
+            params=link.get('params'), tools=link.get('tools', ()),
+            extra_fps=link.get('extra_outputs', ()))
+    for fp in consumes:
+        scratch.consumed(fp)
+
+def chain_steps(chain, input_bam, output_fp, temp_files_dir=os.getcwd(), cache=None,
+        after=()):
+    """Returns (steps, output), dag steps that run a chain of bam steps each on the output
+    of the one before, the last one writing output_fp, and the handle of output_fp.
+
+    chain is a list of dicts of
+        step - name of the step, see STEP_SORT_ORDERS
+        run - run(input_bam, output_fp) creates output_fp from input_bam
+        params, tools - passed to step_cache.run_cached_step
+        extra_outputs - other files run creates, cached with the output
+        inputs - other files the output depends on, i.e. the reference
+        after - names of dag steps outside the chain that have to be done first
+        consumes - other intermediates to let go of once the step is done
+    Each intermediate bam is let go of as soon as the step after it is done. The first
+    step also waits for the dag steps named in after.
+    """
+    steps = []
+    bam = input_bam
+    for i, link in enumerate(chain):
+        fp = output_fp if i == len(chain) - 1 else \
+                scratch.temp_path(temp_files_dir, link['step'], '.bam')
+        output = bam.derive(fp, link['step'])
+        consumes = list(link.get('consumes', ()))
+        if bam is not input_bam:
+            consumes.append(bam.fp)
+        after = list(link.get('after', ())) + ([steps[-1].name] if steps else list(after))
+        steps.append(dag.Step(link['step'],
+                functools.partial(run_chain_link, cache, link, bam, output, consumes),
+                after=after))
+        bam = output
+
+    return steps, bam
+
+def finalize_step(output, after, temp_files_dir=os.getcwd(), threads=1, sort_memory='10G'):
+    def run():
+        with instrumentation.step('sort_and_index_output'):
+            finalize_output(output, temp_files_dir=temp_files_dir, threads=threads,
+                    sort_memory=sort_memory)
+
+    return dag.Step('sort_and_index_output', run, after=[after])
 
-    if sorted_input_fp != input_fp:
-        os.remove(sorted_input_fp)
-        os.remove(sorted_input_fp + '.bai')
+def run_cptac3_preprocessing(input_fp, output_fp, reference_fp, temp_files_dir=os.getcwd(),
+        max_mem='1g', threads=1, sort_memory='10G', workers=1, cache=None, read_group=None,
+        read_group_from_header=False, max_records_in_ram=100000,
+        duplicate_marker='picard', duplicate_metrics_fp=None, splitter='gatk'):
+    """Runs the cptac3 workflow.
 
-def run_fix_255_mapping_quality(input_fp, output_fp):
-    ps_1 = subprocess.Popen(('samtools', 'view', '-h', input_fp), stdout=subprocess.PIPE)
-    ps_2 = subprocess.Popen(('sed', r's/^\([^	]*	[^	]*	[^	]*	[^	]*	\)255/\160/'), stdin=ps_1.stdout, stdout=subprocess.PIPE)
-    ps_3 = subprocess.Popen(('sed', r's/MQ:i:255/MQ:i:60/'), stdin=ps_2.stdout, stdout=subprocess.PIPE)
+    read_group and read_group_from_header set the read group stamped on every record,
+    see run_add_or_replace_read_groups.
+    duplicate_marker and duplicate_metrics_fp are passed to run_mark_duplicates, and
+    splitter to run_split_n_cigar_reads.
 
-    subprocess.check_output(('samtools', 'view', '-h', '-o', output_fp), stdin=ps_3.stdout)
-    ps_1.wait()
-    ps_2.wait()
-    ps_3.wait()
+    The reference is indexed while the bam steps that don't need it run. Creating its
+    sequence dictionary starts a jvm, so that is done first.
 
-def run_cptac3_preprocessing(input_fp, output_fp, reference_fp, temp_files_dir=os.getcwd(),
-        max_mem='1g'):
-    # sort and add readgroups
-    read_group_output = os.path.join(temp_files_dir, f'read_groups.{str(uuid.uuid4())}.bam')
-    run_add_or_replace_read_groups(input_fp, read_group_output,
-            temp_files_dir=temp_files_dir)
-
-    # mark duplicates
-    mark_duplicates_output = os.path.join(temp_files_dir, f'mark_duplicates.{str(uuid.uuid4())}.bam')
-    run_mark_duplicates(read_group_output, mark_duplicates_output,
-            temp_files_dir=temp_files_dir, max_mem=max_mem)
-    # remove temp output
-    os.remove(read_group_output)
-    os.remove(read_group_output + '.bai')
-
-    # split n cigar reads
-    split_output = os.path.join(temp_files_dir, f'split.{str(uuid.uuid4())}.bam')
-    run_split_n_cigar_reads(mark_duplicates_output, output_fp, reference_fp,
-            temp_files_dir=temp_files_dir)
-    # remove temp output
-    os.remove(mark_duplicates_output)
-    os.remove(mark_duplicates_output + '.bai')
-    os.remove(output_fp.replace('.bam', '.bai'))
-
-    sorted_output = create_sorted_bam(output_fp, temp_files_dir=temp_files_dir)
-    index_bam(sorted_output)
-    shutil.move(sorted_output, output_fp)
+    If a step_cache.StepCache is given, steps whose output is already cached are
+    skipped so a failed run can be resumed.
+    """
+    with scratch.session():
+        reference = reference_steps(reference_fp)
+        chain = [
+            # sort and add readgroups
+            {'step': 'add_or_replace_read_groups',
+                'run': lambda bam, fp: run_add_or_replace_read_groups(bam, fp,
+                        temp_files_dir=temp_files_dir, threads=threads,
+                        sort_memory=sort_memory, read_group=read_group,
+                        read_group_from_header=read_group_from_header),
+                'params': {'read_group': read_group, 'from_header': read_group_from_header},
+                'tools': ('samtools',)},
+            {'step': 'mark_duplicates',
+                'run': lambda bam, fp: run_mark_duplicates(bam, fp,
+                        temp_files_dir=temp_files_dir, max_mem=max_mem, threads=threads,
+                        sort_memory=sort_memory, max_records_in_ram=max_records_in_ram,
+                        duplicate_marker=duplicate_marker, metrics_fp=duplicate_metrics_fp),
+                'params': {'duplicate_marker': duplicate_marker},
+                'tools': DUPLICATE_MARKERS[duplicate_marker]},
+            {'step': 'split_n_cigar_reads',
+                'run': lambda bam, fp: run_split_n_cigar_reads(bam, fp, reference_fp,
+                        temp_files_dir=temp_files_dir, max_mem=max_mem, threads=threads,
+                        sort_memory=sort_memory, workers=workers, splitter=splitter),
+                'params': {'splitter': splitter},
+                'inputs': [reference_fp], 'after': [step.name for step in reference],
+                'tools': SPLITTERS[splitter]},
+            ]
+        steps, output = chain_steps(chain, BamFile(input_fp), output_fp,
+                temp_files_dir=temp_files_dir, cache=cache,
+                after=get_jvm_step_names(reference))
+        steps.append(finalize_step(output, steps[-1].name, temp_files_dir=temp_files_dir,
+                threads=threads, sort_memory=sort_memory))
+
+        dag.run_dag(reference + steps)
 
 def run_cptac2_preprocessing(input_fp, output_fp, reference_fp, temp_files_dir=os.getcwd(),
-        max_mem='1g'):
-
-    fixmates_output = os.path.join(temp_files_dir, f'fixmates.{str(uuid.uuid4())}.bam')
-    run_fixmates(input_fp, fixmates_output, temp_files_dir=temp_files_dir)
-
-    properly_paired_output = os.path.join(temp_files_dir, f'paired.{str(uuid.uuid4())}.bam')
-    run_properly_paired(fixmates_output, properly_paired_output, temp_files_dir=temp_files_dir)
-    # remove temp output
-    #os.remove(fixmates_output)
-
-    # sort and add readgroups
-    read_group_output = os.path.join(temp_files_dir, f'read_groups.{str(uuid.uuid4())}.bam')
-    run_add_or_replace_read_groups(properly_paired_output, read_group_output,
-            temp_files_dir=temp_files_dir)
-    # remove temp output
-    #os.remove(properly_paired_output)
-    #os.remove(properly_paired_output + '.bai')
-
-    # mark duplicates
-    mark_duplicates_output = os.path.join(temp_files_dir, f'mark_duplicates.{str(uuid.uuid4())}.bam')
-    run_mark_duplicates(read_group_output, mark_duplicates_output,
-            temp_files_dir=temp_files_dir, max_mem=max_mem)
-    # remove temp output
-    #os.remove(read_group_output)
-    #os.remove(read_group_output + '.bai')
-
-    # split n cigar reads
-    split_output = os.path.join(temp_files_dir, f'split.{str(uuid.uuid4())}.bam')
-    run_split_n_cigar_reads(mark_duplicates_output, output_fp, reference_fp,
-            temp_files_dir=temp_files_dir)
-    # remove temp output
-#     os.remove(mark_duplicates_output)
-#     os.remove(mark_duplicates_output + '.bai')
-#     os.remove(output_fp.replace('.bam', '.bai'))
-
-    sorted_output = create_sorted_bam(output_fp, temp_files_dir=temp_files_dir)
-    index_bam(sorted_output)
-    shutil.move(sorted_output, output_fp)
+        max_mem='1g', threads=1, sort_memory='10G', workers=1, cache=None, read_group=None,
+        read_group_from_header=False, max_records_in_ram=100000,
+        duplicate_marker='picard', duplicate_metrics_fp=None, splitter='gatk'):
+    """Runs the cptac2 workflow.
 
-def run_basic_preprocessing(input_fp, output_fp, reference_fp, known_sites_fp,
-        properly_paired_only=False, fixmates=False, temp_files_dir=os.getcwd(),
-        fix_255_mapping_quality=False):
-    original_input_fp = input_fp
+    read_group and read_group_from_header set the read group stamped on every record,
+    see run_add_or_replace_read_groups.
+    duplicate_marker and duplicate_metrics_fp are passed to run_mark_duplicates, and
+    splitter to run_split_n_cigar_reads.
 
-    if fixmates:
-        fixmates_output = os.path.join(temp_files_dir, f'temp.{str(uuid.uuid4())}.bam')
-        run_fixmates(input_fp, fixmates_output, temp_files_dir=temp_files_dir)
-        input_fp = fixmates_output
+    The reference is indexed while the bam steps that don't need it run. Creating its
+    sequence dictionary starts a jvm, so that is done first.
 
-    if properly_paired_only:
-        properly_paired_output = os.path.join(temp_files_dir, f'temp.{str(uuid.uuid4())}.bam')
-        run_properly_paired(input_fp, properly_paired_output, temp_files_dir=temp_files_dir)
-        if input_fp != original_input_fp:
-            os.remove(input_fp)
-            if os.path.isfile(input_fp + '.bai'):
-                os.remove(input_fp + '.bai')
-        input_fp = properly_paired_output
+    If a step_cache.StepCache is given, steps whose output is already cached are
+    skipped so a failed run can be resumed.
+    """
+    with scratch.session():
+        reference = reference_steps(reference_fp)
+        chain = [
+            # fix mates and keep properly paired reads in one pass
+            {'step': 'fixmates_and_filter',
+                'run': lambda bam, fp: run_fixmates_and_filter(bam, fp,
+                        temp_files_dir=temp_files_dir, threads=threads,
+                        sort_memory=sort_memory),
+                'tools': ('samtools',)},
+            # sort and add readgroups
+            {'step': 'add_or_replace_read_groups',
+                'run': lambda bam, fp: run_add_or_replace_read_groups(bam, fp,
+                        temp_files_dir=temp_files_dir, threads=threads,
+                        sort_memory=sort_memory, read_group=read_group,
+                        read_group_from_header=read_group_from_header),
+                'params': {'read_group': read_group, 'from_header': read_group_from_header},
+                'tools': ('samtools',)},
+            {'step': 'mark_duplicates',
+                'run': lambda bam, fp: run_mark_duplicates(bam, fp,
+                        temp_files_dir=temp_files_dir, max_mem=max_mem, threads=threads,
+                        sort_memory=sort_memory, max_records_in_ram=max_records_in_ram,
+                        duplicate_marker=duplicate_marker, metrics_fp=duplicate_metrics_fp),
+                'params': {'duplicate_marker': duplicate_marker},
+                'tools': DUPLICATE_MARKERS[duplicate_marker]},
+            {'step': 'split_n_cigar_reads',
+                'run': lambda bam, fp: run_split_n_cigar_reads(bam, fp, reference_fp,
+                        temp_files_dir=temp_files_dir, max_mem=max_mem, threads=threads,
+                        sort_memory=sort_memory, workers=workers, splitter=splitter),
+                'params': {'splitter': splitter},
+                'inputs': [reference_fp], 'after': [step.name for step in reference],
+                'tools': SPLITTERS[splitter]},
+            ]
+        steps, output = chain_steps(chain, BamFile(input_fp), output_fp,
+                temp_files_dir=temp_files_dir, cache=cache,
+                after=get_jvm_step_names(reference))
+        steps.append(finalize_step(output, steps[-1].name, temp_files_dir=temp_files_dir,
+                threads=threads, sort_memory=sort_memory))
+
+        dag.run_dag(reference + steps)
 
-    if fix_255_mapping_quality:
-        fix_255_output = os.path.join(temp_files_dir, f'temp.{str(uuid.uuid4())}.bam')
-        run_fix_255_mapping_quality(input_fp, fix_255_output)
-        if input_fp != original_input_fp:
-            os.remove(input_fp)
-            if os.path.isfile(input_fp + '.bai'):
-                os.remove(input_fp + '.bai')
-        input_fp = fix_255_output
-
-    # add read groups
-    read_group_output = os.path.join(temp_files_dir, f'temp.{str(uuid.uuid4())}.bam')
-    run_add_or_replace_read_groups(input_fp, read_group_output, temp_files_dir=temp_files_dir)
-    if input_fp != original_input_fp:
-        os.remove(input_fp)
-        if os.path.isfile(input_fp + '.bai'):
-            os.remove(input_fp + '.bai')
-
-    # mark duplicates
-    mark_duplicates_output = os.path.join(temp_files_dir, f'temp.{str(uuid.uuid4())}.bam')
-    run_mark_duplicates(read_group_output, mark_duplicates_output,
-            temp_files_dir=temp_files_dir)
-    # remove temp output
-    os.remove(read_group_output)
-    os.remove(read_group_output + '.bai')
-
-    # base recalibration
-    run_base_recalibration(mark_duplicates_output, output_fp, reference_fp, known_sites_fp,
-            temp_files_dir=temp_files_dir)
-    # remove temp output
-    os.remove(mark_duplicates_output)
-    os.remove(mark_duplicates_output + '.bai')
-    os.remove(output_fp.replace('.bam', '.bai'))
-
-    sorted_output = create_sorted_bam(output_fp, temp_files_dir=temp_files_dir)
-    index_bam(sorted_output)
-
-    shutil.move(sorted_output, output_fp)
+def run_basic_preprocessing(input_fp, output_fp, reference_fp, known_sites_fp,
+        properly_paired_only=False, fixmates=False, temp_files_dir=os.getcwd(),
+        fix_255_mapping_quality=False, streaming=False, max_mem='1g', threads=1,
+        sort_memory='10G', workers=1, cache=None, read_filter='properly_paired',
+        read_group=None, read_group_from_header=False, max_records_in_ram=100000,
+        duplicate_marker='picard', duplicate_metrics_fp=None):
+    """Runs the standard preprocessing workflow.
+
+    read_filter is the bam_filter preset name or filter spec used when
+    properly_paired_only is True. read_group and read_group_from_header set the read
+    group stamped on every record, see run_add_or_replace_read_groups.
+    duplicate_marker and duplicate_metrics_fp are passed to run_mark_duplicates. The
+    native duplicate marker also collects the base recalibration table while it marks
+    duplicates, so base recalibration only has to apply it.
+
+    If streaming is True the fixmates, properly paired, fix 255 mapping quality and
+    read groups steps are chained together as a single pipe with uncompressed bam
+    between them, so no intermediate bam is written until read groups are added.
+
+    The reference and known sites are indexed while the bam steps that don't need
+    them run. Creating the reference sequence dictionary starts a jvm, so that is done
+    first.
+
+    If a step_cache.StepCache is given, steps whose output is already cached are
+    skipped so a failed run can be resumed.
+    """
+    with scratch.session():
+        reference = reference_steps(reference_fp, known_sites_fp=known_sites_fp)
+        reference_names = [step.name for step in reference]
+        chain = []
+        read_filter_params = {'read_filter': repr(bam_filter.parse_filter(read_filter))}
+
+        if streaming:
+            chain.append({'step': 'streaming_read_groups',
+                'run': lambda bam, fp: run_streaming_read_groups(bam, fp,
+                        fixmate=fixmates, properly_paired_only=properly_paired_only,
+                        fix_255_mapping_quality=fix_255_mapping_quality,
+                        temp_files_dir=temp_files_dir, threads=threads,
+                        sort_memory=sort_memory, read_filter=read_filter,
+                        read_group=read_group, read_group_from_header=read_group_from_header),
+                'params': {'fixmates': fixmates, 'properly_paired_only': properly_paired_only,
+                        'fix_255_mapping_quality': fix_255_mapping_quality,
+                        'read_filter': read_filter_params['read_filter'],
+                        'read_group': read_group, 'from_header': read_group_from_header},
+                'tools': ('samtools',)})
+        else:
+            if fixmates and properly_paired_only:
+                # fix mates and filter in one pass, straight into coordinate order
+                chain.append({'step': 'fixmates_and_filter',
+                    'run': lambda bam, fp: run_fixmates_and_filter(bam, fp,
+                            temp_files_dir=temp_files_dir, threads=threads,
+                            sort_memory=sort_memory, read_filter=read_filter),
+                    'params': read_filter_params, 'tools': ('samtools',)})
+            elif fixmates:
+                chain.append({'step': 'fixmates',
+                    'run': lambda bam, fp: run_fixmates(bam, fp,
+                            temp_files_dir=temp_files_dir, threads=threads,
+                            sort_memory=sort_memory),
+                    'tools': ('samtools',)})
+            elif properly_paired_only:
+                chain.append({'step': 'properly_paired',
+                    'run': lambda bam, fp: run_properly_paired(bam, fp,
+                            temp_files_dir=temp_files_dir, threads=threads,
+                            sort_memory=sort_memory, read_filter=read_filter),
+                    'params': read_filter_params})
+
+            if fix_255_mapping_quality:
+                chain.append({'step': 'fix_255_mapping_quality',
+                    'run': lambda bam, fp: run_fix_255_mapping_quality(bam, fp,
+                            threads=threads)})
+
+            # add read groups
+            chain.append({'step': 'add_or_replace_read_groups',
+                'run': lambda bam, fp: run_add_or_replace_read_groups(bam, fp,
+                        temp_files_dir=temp_files_dir, threads=threads,
+                        sort_memory=sort_memory, read_group=read_group,
+                        read_group_from_header=read_group_from_header),
+                'params': {'read_group': read_group, 'from_header': read_group_from_header},
+                'tools': ('samtools',)})
+
+        # mark duplicates, the native marker collects the recalibration table in the same
+        # pass, which is cached with its output so a resumed run recalibrates the same
+        # way. It reads the reference to collect it, so has to wait for the reference to
+        # be prepared.
+        table_fp = None
+        if duplicate_marker == 'native':
+            table_fp = scratch.temp_path(temp_files_dir, 'output', '.table', small=True)
+        chain.append({'step': 'mark_duplicates',
+            'run': lambda bam, fp: run_mark_duplicates(bam, fp,
+                    temp_files_dir=temp_files_dir, max_mem=max_mem, threads=threads,
+                    sort_memory=sort_memory, max_records_in_ram=max_records_in_ram,
+                    duplicate_marker=duplicate_marker, metrics_fp=duplicate_metrics_fp,
+                    reference_fp=reference_fp, known_sites_fp=known_sites_fp,
+                    recal_table_fp=table_fp),
+            'params': {'duplicate_marker': duplicate_marker},
+            'after': reference_names if table_fp is not None else [],
+            'extra_outputs': [table_fp] if table_fp is not None else [],
+            'tools': DUPLICATE_MARKERS[duplicate_marker]})
+
+        chain.append({'step': 'base_recalibration',
+            'run': lambda bam, fp: run_base_recalibration(bam, fp, reference_fp,
+                    known_sites_fp, temp_files_dir=temp_files_dir, max_mem=max_mem,
+                    threads=threads, sort_memory=sort_memory, workers=workers,
+                    table_fp=table_fp),
+            'params': {'table': 'native' if table_fp is not None else 'gatk'},
+            'inputs': [reference_fp, known_sites_fp], 'after': reference_names,
+            'consumes': [table_fp] if table_fp is not None else [],
+            'tools': ('samtools', 'gatk')})
+
+        steps, output = chain_steps(chain, BamFile(input_fp), output_fp,
+                temp_files_dir=temp_files_dir, cache=cache,
+                after=get_jvm_step_names(reference))
+        steps.append(finalize_step(output, steps[-1].name, temp_files_dir=temp_files_dir,
+                threads=threads, sort_memory=sort_memory))
+
+        dag.run_dag(reference + steps)
@@ -0,0 +1,128 @@
+import argparse
+import contextlib
+import os
+import sys
+
+import bam_processing as bp
+import batch
+import jvm_executor
+import progress
+
+parser = argparse.ArgumentParser(description='run many samples at once from a manifest')
+
+parser.add_argument('manifest', type=str,
+        help='tab separated manifest with a header and columns sample, input, output and \
+workflow_type (standard, cptac3 or cptac2). An optional known_sites column overrides \
+--known-sites for that sample. Optional rg_id, rg_sm, rg_lb, rg_pl and rg_pu columns set \
+the read group of that sample.')
+
+parser.add_argument('--reference-fasta', type=str,
+        help='reference fasta shared by every sample')
+parser.add_argument('--known-sites', type=str,
+        help='known sites for base recal')
+parser.add_argument('--reference-cache-dir', type=str,
+        help='directory of prepared references shared between runs, see \
+bam_processing_cli.py --help. Defaults to $BAM_PROCESSING_REFERENCE_CACHE.')
+parser.add_argument('--status-dir', type=str,
+        default='batch_status', help='directory for per sample status files. Samples with \
+a done status are skipped when the batch is restarted.')
+parser.add_argument('--cpus', type=int,
+        default=os.cpu_count(), help='total cpus all running samples can use')
+parser.add_argument('--memory', type=str,
+        help='total memory all running samples can use (i.e. 64G). Defaults to the \
+physical memory of the machine.')
+parser.add_argument('--fixmate', action='store_true',
+        help='run samtools fixmate as part of standard workflows.')
+parser.add_argument('--properly-paired-only', action='store_true',
+        help='filter out all alignments that are not properly paired in standard workflows.')
+parser.add_argument('--read-filter', type=str,
+        default='properly_paired', help='filter used by --properly-paired-only, see \
+bam_processing_cli.py --help.')
+parser.add_argument('--rg-lb', type=str,
+        help='read group library (LB) for samples without an rg_lb column.')
+parser.add_argument('--rg-pl', type=str,
+        help='read group platform (PL) for samples without an rg_pl column.')
+parser.add_argument('--rg-pu', type=str,
+        help='read group platform unit (PU) for samples without an rg_pu column.')
+parser.add_argument('--rg-from-header', action='store_true',
+        help='take read group fields missing from the manifest from the first @RG line of \
+each input. Otherwise the read group sample (SM) is the sample name.')
+parser.add_argument('--fix-255-mapping-quality', action='store_true',
+        help='Changes all 255 mapping qualities to 60 in standard workflows.')
+parser.add_argument('--streaming', action='store_true',
+        help='stream the steps before mark duplicates through a single pipe.')
+parser.add_argument('--temp-files-dir', type=str,
+        default=os.getcwd(), help='directory to put per sample temporary directories in.')
+parser.add_argument('--max-memory', type=str,
+        default='1g', help='max heap size for each java process')
+parser.add_argument('--threads', type=int,
+        default=1, help='number of threads samtools steps of each sample can use')
+parser.add_argument('--sort-memory', type=str,
+        default='10G', help='total memory for samtools sort of each sample')
+parser.add_argument('--max-records-in-ram', type=int,
+        default=100000, help='MAX_RECORDS_IN_RAM for picard MarkDuplicates of each sample')
+parser.add_argument('--duplicate-marker', type=str,
+        default='picard', choices=sorted(bp.DUPLICATE_MARKERS), help='mark duplicates with \
+picard MarkDuplicates or the native marker, which needs no jvm')
+parser.add_argument('--splitter', type=str,
+        default='gatk', choices=sorted(bp.SPLITTERS), help='split reads at N cigar \
+operations in cptac workflows with gatk SplitNCigarReads or the native splitter, which \
+needs no jvm')
+parser.add_argument('--duplicate-metrics', action='store_true',
+        help='write duplication metrics of each sample next to its output, as \
+<output>.duplicate_metrics.txt')
+parser.add_argument('--workers', type=int,
+        default=1, help='number of genomic shards to run gatk steps on at once per sample')
+parser.add_argument('--resume', action='store_true',
+        help='reuse step outputs cached by a previous run.')
+parser.add_argument('--cache-dir', type=str,
+        help='directory to cache step outputs in, shared by every sample.')
+parser.add_argument('--cache-max-size', type=str,
+        help='max size of the step cache (i.e. 500G).')
+parser.add_argument('--status-file', type=str,
+        help='keep a json file with the percent complete, records/s and eta of every \
+running command of every sample up to date, for schedulers to poll.')
+parser.add_argument('--status-port', type=int,
+        help='serve the same json as --status-file at http://127.0.0.1:<port>/.')
+parser.add_argument('--jvm-executor', action='store_true',
+        help='run every picard and gatk call of every sample in one long lived jvm \
+(nailgun) instead of starting a jvm per call.')
+parser.add_argument('--jvm-executor-memory', type=str,
+        default='8g', help='heap size of the jvm executor, shared by all running tools.')
+
+args = parser.parse_args()
+
+def main():
+    samples = batch.read_manifest(args.manifest)
+    memory = bp.parse_memory(args.memory) if args.memory is not None \
+            else batch.get_total_memory()
+
+    cache = None
+    if args.resume or args.cache_dir is not None:
+        cache_dir = args.cache_dir or os.path.join(args.temp_files_dir, 'step_cache')
+        max_size = bp.parse_memory(args.cache_max_size) \
+                if args.cache_max_size is not None else None
+        cache = bp.step_cache.StepCache(cache_dir, max_size=max_size, resume=args.resume)
+
+    executor = jvm_executor.executor(max_mem=args.jvm_executor_memory) \
+            if args.jvm_executor else contextlib.nullcontext()
+    with executor, progress.session(status_fp=args.status_file, port=args.status_port):
+        states = batch.run_batch(samples, args.reference_fasta, args.status_dir, args.cpus,
+                memory, known_sites_fp=args.known_sites, temp_files_dir=args.temp_files_dir,
+                threads=args.threads, max_mem=args.max_memory, sort_memory=args.sort_memory,
+                workers=args.workers, streaming=args.streaming, fixmates=args.fixmate,
+                properly_paired_only=args.properly_paired_only, read_filter=args.read_filter,
+                fix_255_mapping_quality=args.fix_255_mapping_quality, cache=cache,
+                read_group={'LB': args.rg_lb, 'PL': args.rg_pl, 'PU': args.rg_pu},
+                read_group_from_header=args.rg_from_header,
+                reference_cache_dir=args.reference_cache_dir,
+                max_records_in_ram=args.max_records_in_ram,
+                duplicate_marker=args.duplicate_marker,
+                duplicate_metrics=args.duplicate_metrics, splitter=args.splitter)
+
+    failed = [sample for sample, state in states.items() if state == 'failed']
+    if failed:
+        sys.exit(f'failed samples: {", ".join(failed)}')
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,10 @@ import os
 import subprocess
 
 import bam_processing as bp
+import jvm_executor
+import progress
+import reference_cache
+import resource_plan
 
 parser = argparse.ArgumentParser()
 
@@ -13,6 +17,10 @@ parser.add_argument('--reference-fasta', type=str,
         help='reference fasta')
 parser.add_argument('--known-sites', type=str,
         help='known sites for base recal')
+parser.add_argument('--reference-cache-dir', type=str,
+        help='directory of prepared references shared between runs. The reference and \
+known sites are indexed there once per checksum instead of next to the inputs. Defaults \
+to $BAM_PROCESSING_REFERENCE_CACHE, if unset references are indexed in place.')
 parser.add_argument('--output', type=str,
         default='output.bam', help='output bam')
 parser.add_argument('--workflow-type', type=str,
@@ -21,52 +29,211 @@ parser.add_argument('--fixmate', action='store_true',
         help='run samtools fixmate as part of workflow.')
 parser.add_argument('--properly-paired-only', action='store_true',
         help='filter out all alignments that are not properly paired.')
+parser.add_argument('--read-filter', type=str,
+        default='properly_paired', help='filter used by --properly-paired-only. Either a \
+preset (properly_paired, mapped, primary, pass_qc, no_duplicates) or comma separated \
+presets and require_flags=, exclude_flags=, min_mapping_quality= and mate_same_reference \
+items, i.e. properly_paired,min_mapping_quality=20')
+parser.add_argument('--rg-id', type=str,
+        help='read group ID stamped on every read. Defaults to id.')
+parser.add_argument('--rg-sm', type=str,
+        help='read group sample (SM). Defaults to sample.')
+parser.add_argument('--rg-lb', type=str,
+        help='read group library (LB). Defaults to library.')
+parser.add_argument('--rg-pl', type=str,
+        help='read group platform (PL). Defaults to platform.')
+parser.add_argument('--rg-pu', type=str,
+        help='read group platform unit (PU). Defaults to machine.')
+parser.add_argument('--rg-from-header', action='store_true',
+        help='take read group fields from the first @RG line of the input header. --rg-* \
+options still win.')
 parser.add_argument('--fix-255-mapping-quality', action='store_true',
         help='Changes all 255 mapping qualities to 60.')
+parser.add_argument('--streaming', action='store_true',
+        help='stream fixmate, properly paired, fix 255 mapping quality and read group steps \
+through a single pipe instead of writing intermediate bams.')
 parser.add_argument('--temp-files-dir', type=str,
         help='directory to put samtools temporary files in.')
+parser.add_argument('--scratch-max-size', type=str,
+        help='most disk space intermediates in the temp files directory can take (i.e. \
+200G). The run fails instead of going over it. Intermediates are always removed as soon as \
+the step that reads them finishes, and when the run fails or is killed.')
+parser.add_argument('--tmpfs-dir', type=str,
+        help='tmpfs directory for small intermediates such as metrics, recalibration tables \
+and interval lists. Defaults to /dev/shm if it is writable, an empty string keeps them \
+with the rest.')
 parser.add_argument('--max-memory', type=str,
-        default='1g', help='max heap size for java to allocate')
+        help='max heap size for java to allocate. Defaults to what fits in --memory \
+alongside the other settings.')
+parser.add_argument('--threads', type=int,
+        help='number of threads samtools steps can use. Defaults to every available cpu.')
+parser.add_argument('--sort-memory', type=str,
+        help='total memory for samtools sort, split between threads. Defaults to enough \
+to sort the input in memory, up to half of --memory.')
+parser.add_argument('--workers', type=int,
+        help='number of genomic shards to run gatk steps on at once. Each worker is a \
+separate jvm with --max-memory heap. Defaults to 1, or more for big inputs.')
+parser.add_argument('--max-records-in-ram', type=int,
+        help='MAX_RECORDS_IN_RAM for picard MarkDuplicates. Defaults to what fits in \
+--max-memory.')
+parser.add_argument('--duplicate-marker', type=str,
+        default='picard', choices=sorted(bp.DUPLICATE_MARKERS), help='mark duplicates with \
+picard MarkDuplicates or the native marker, which needs no jvm and splits contigs between \
+--threads processes.')
+parser.add_argument('--splitter', type=str,
+        default='gatk', choices=sorted(bp.SPLITTERS), help='split reads at N cigar \
+operations in the cptac workflows with gatk SplitNCigarReads or the native splitter, which \
+needs no jvm and splits contigs between --threads processes.')
+parser.add_argument('--duplicate-metrics', type=str,
+        help='write picard style duplication metrics to this file.')
+parser.add_argument('--memory', type=str,
+        help='memory the run can use (i.e. 16G), settings not given are derived from it. \
+Defaults to available memory, or the cgroup limit if lower.')
+parser.add_argument('--resume', action='store_true',
+        help='skip steps whose outputs are already in the step cache from a previous run.')
+parser.add_argument('--cache-dir', type=str,
+        help='directory to cache step outputs in. Defaults to step_cache in the temp files \
+directory when --resume is given. Step outputs are only cached if one of --cache-dir or \
+--resume is given.')
+parser.add_argument('--report', type=str,
+        help='write a json report with wall time, cpu time, peak memory and io of every step.')
+parser.add_argument('--trace', type=str,
+        help='write a chrome trace (chrome://tracing or perfetto) of every step.')
+parser.add_argument('--status-file', type=str,
+        help='keep a json file with the percent complete, records/s and eta of every \
+running command up to date, for schedulers to poll.')
+parser.add_argument('--status-port', type=int,
+        help='serve the same json as --status-file at http://127.0.0.1:<port>/.')
+parser.add_argument('--cache-max-size', type=str,
+        help='max size of the step cache (i.e. 500G). Least recently used steps are evicted.')
+parser.add_argument('--jvm-executor', action='store_true',
+        help='run every picard and gatk call in one long lived jvm (nailgun) instead of \
+starting a jvm per call. Cuts jvm startup time on small bams.')
+parser.add_argument('--jvm-executor-memory', type=str,
+        help='heap size of the jvm executor. Defaults to --max-memory times --workers.')
 
 args = parser.parse_args()
 
+def get_step_cache(resume, cache_dir, cache_max_size, temp_files_dir):
+    if not resume and cache_dir is None:
+        return None
+    if cache_dir is None:
+        cache_dir = os.path.join(temp_files_dir or os.getcwd(), 'step_cache')
+    max_size = bp.parse_memory(cache_max_size) if cache_max_size is not None else None
+
+    return bp.step_cache.StepCache(cache_dir, max_size=max_size, resume=resume)
+
 def run_standard_workflow(input_bam, output_bam, reference_fasta, known_sites_vcf_gz,
-        fixmate, properly_paired_only, fix_255_mapping_quality, temp_files_dir):
+        fixmate, properly_paired_only, fix_255_mapping_quality, temp_files_dir, streaming,
+        max_memory, threads, sort_memory, workers, cache, read_filter, read_group,
+        read_group_from_header, max_records_in_ram, duplicate_marker, duplicate_metrics_fp):
     if temp_files_dir is None:
         bp.run_basic_preprocessing(input_bam, output_bam, reference_fasta, known_sites_vcf_gz,
-                fixmates=fixmate, properly_paired_only=properly_paired_only)
+                fixmates=fixmate, properly_paired_only=properly_paired_only,
+                streaming=streaming, max_mem=max_memory, threads=threads,
+                sort_memory=sort_memory, workers=workers, cache=cache, read_filter=read_filter,
+                read_group=read_group, read_group_from_header=read_group_from_header,
+                max_records_in_ram=max_records_in_ram, duplicate_marker=duplicate_marker,
+                duplicate_metrics_fp=duplicate_metrics_fp)
     else:
         bp.run_basic_preprocessing(input_bam, output_bam, reference_fasta, known_sites_vcf_gz,
                 fixmates=fixmate, properly_paired_only=properly_paired_only,
-                fix_255_mapping_quality=fix_255_mapping_quality, temp_files_dir=temp_files_dir)
+                fix_255_mapping_quality=fix_255_mapping_quality, temp_files_dir=temp_files_dir,
+                streaming=streaming, max_mem=max_memory, threads=threads,
+                sort_memory=sort_memory, workers=workers, cache=cache, read_filter=read_filter,
+                read_group=read_group, read_group_from_header=read_group_from_header,
+                max_records_in_ram=max_records_in_ram, duplicate_marker=duplicate_marker,
+                duplicate_metrics_fp=duplicate_metrics_fp)
 
-def run_cptac3_workflow(input_bam, output_bam, reference_fasta, temp_files_dir, max_memory):
+def run_cptac3_workflow(input_bam, output_bam, reference_fasta, temp_files_dir, max_memory,
+        threads, sort_memory, workers, cache, read_group, read_group_from_header,
+        max_records_in_ram, duplicate_marker, duplicate_metrics_fp, splitter):
     if temp_files_dir is None:
-        bp.run_cptac3_preprocessing(input_bam, output_bam, reference_fasta, max_mem=max_memory)
+        bp.run_cptac3_preprocessing(input_bam, output_bam, reference_fasta, max_mem=max_memory,
+                threads=threads, sort_memory=sort_memory, workers=workers, cache=cache,
+                read_group=read_group, read_group_from_header=read_group_from_header,
+                max_records_in_ram=max_records_in_ram, duplicate_marker=duplicate_marker,
+                duplicate_metrics_fp=duplicate_metrics_fp, splitter=splitter)
     else:
         bp.run_cptac3_preprocessing(input_bam, output_bam, reference_fasta, max_mem=max_memory,
-                temp_files_dir=temp_files_dir)
+                temp_files_dir=temp_files_dir, threads=threads, sort_memory=sort_memory,
+                workers=workers, cache=cache, read_group=read_group,
+                read_group_from_header=read_group_from_header,
+                max_records_in_ram=max_records_in_ram, duplicate_marker=duplicate_marker,
+                duplicate_metrics_fp=duplicate_metrics_fp, splitter=splitter)
 
-def run_cptac2_workflow(input_bam, output_bam, reference_fasta, temp_files_dir, max_memory):
+def run_cptac2_workflow(input_bam, output_bam, reference_fasta, temp_files_dir, max_memory,
+        threads, sort_memory, workers, cache, read_group, read_group_from_header,
+        max_records_in_ram, duplicate_marker, duplicate_metrics_fp, splitter):
     if temp_files_dir is None:
-        bp.run_cptac2_preprocessing(input_bam, output_bam, reference_fasta, max_mem=max_memory)
+        bp.run_cptac2_preprocessing(input_bam, output_bam, reference_fasta, max_mem=max_memory,
+                threads=threads, sort_memory=sort_memory, workers=workers, cache=cache,
+                read_group=read_group, read_group_from_header=read_group_from_header,
+                max_records_in_ram=max_records_in_ram, duplicate_marker=duplicate_marker,
+                duplicate_metrics_fp=duplicate_metrics_fp, splitter=splitter)
     else:
         bp.run_cptac2_preprocessing(input_bam, output_bam, reference_fasta, max_mem=max_memory,
-                temp_files_dir=temp_files_dir)
+                temp_files_dir=temp_files_dir, threads=threads, sort_memory=sort_memory,
+                workers=workers, cache=cache, read_group=read_group,
+                read_group_from_header=read_group_from_header,
+                max_records_in_ram=max_records_in_ram, duplicate_marker=duplicate_marker,
+                duplicate_metrics_fp=duplicate_metrics_fp, splitter=splitter)
 
-def main():
+def get_read_group():
+    return {'ID': args.rg_id, 'SM': args.rg_sm, 'LB': args.rg_lb, 'PL': args.rg_pl,
+            'PU': args.rg_pu}
+
+def run_workflow(cache, plan):
+    read_group = get_read_group()
+    reference_fasta, known_sites = reference_cache.prepare(args.reference_cache_dir,
+            reference_fp=args.reference_fasta, known_sites_fp=args.known_sites)
     if args.workflow_type == 'standard':
-        run_standard_workflow(args.input_bam, args.output, args.reference_fasta, args.known_sites,
+        run_standard_workflow(args.input_bam, args.output, reference_fasta, known_sites,
                 args.fixmate, args.properly_paired_only, args.fix_255_mapping_quality,
-                args.temp_files_dir)
+                args.temp_files_dir, args.streaming, plan['max_mem'], plan['threads'],
+                plan['sort_memory'], plan['workers'], cache, args.read_filter, read_group,
+                args.rg_from_header, plan['max_records_in_ram'],
+                args.duplicate_marker, args.duplicate_metrics)
     elif args.workflow_type == 'cptac3':
-        run_cptac3_workflow(args.input_bam, args.output, args.reference_fasta, args.temp_files_dir,
-                args.max_memory)
+        run_cptac3_workflow(args.input_bam, args.output, reference_fasta, args.temp_files_dir,
+                plan['max_mem'], plan['threads'], plan['sort_memory'], plan['workers'], cache,
+                read_group, args.rg_from_header, plan['max_records_in_ram'],
+                args.duplicate_marker, args.duplicate_metrics, args.splitter)
     elif args.workflow_type == 'cptac2':
-        run_cptac2_workflow(args.input_bam, args.output, args.reference_fasta, args.temp_files_dir,
-                args.max_memory)
+        run_cptac2_workflow(args.input_bam, args.output, reference_fasta, args.temp_files_dir,
+                plan['max_mem'], plan['threads'], plan['sort_memory'], plan['workers'], cache,
+                read_group, args.rg_from_header, plan['max_records_in_ram'],
+                args.duplicate_marker, args.duplicate_metrics, args.splitter)
     else:
         raise ValueError('must specify correct workflow')
 
+def main():
+    cache = get_step_cache(args.resume, args.cache_dir, args.cache_max_size,
+            args.temp_files_dir)
+
+    plan = resource_plan.make_plan(args.input_bam, threads=args.threads,
+            max_mem=args.max_memory, sort_memory=args.sort_memory, workers=args.workers,
+            max_records_in_ram=args.max_records_in_ram, memory=args.memory)
+
+    max_scratch = bp.parse_memory(args.scratch_max_size) \
+            if args.scratch_max_size is not None else None
+
+    with bp.instrumentation.report(name=args.input_bam) as run_report:
+        try:
+            with bp.scratch.session(max_bytes=max_scratch, tmpfs_dir=args.tmpfs_dir), \
+                    progress.session(status_fp=args.status_file, port=args.status_port):
+                if args.jvm_executor:
+                    max_mem = args.jvm_executor_memory or resource_plan.format_memory(
+                            bp.parse_memory(plan['max_mem']) * plan['workers'])
+                    with jvm_executor.executor(max_mem=max_mem):
+                        run_workflow(cache, plan)
+                else:
+                    run_workflow(cache, plan)
+        finally:
+            if args.report is not None:
+                run_report.write_json(args.report)
+            if args.trace is not None:
+                run_report.write_chrome_trace(args.trace)
+
 if __name__ == '__main__':
     main()
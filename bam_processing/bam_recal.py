@@ -0,0 +1,485 @@
+"""Collects the base quality recalibration model of GATK BaseRecalibrator from a stream
+of coordinate sorted records, and writes it as a GATK recalibration report that
+ApplyBQSR reads unchanged.
+
+Like BaseRecalibrator with its defaults, unmapped, secondary, duplicate, qc failed and
+mapping quality 0 or 255 reads are ignored. Adaptor sequence past the mate's start and
+soft clipped bases are clipped off first. Every remaining base that is ACGT, has a
+quality of at least 6 and isn't at a known variant site is an observation, and an
+error if it doesn't match the reference. Observations are counted by read group
+(platform unit, or id if there is none), reported quality and either the two base
+context or the machine cycle. BAQ and indel tables are off, as in GATK4.
+"""
+import math
+import sys
+
+import numpy as np
+
+import bam_filter
+import bam_io
+import genome_access
+
+# recalibration arguments, as written to the report
+MISMATCHES_CONTEXT_SIZE = 2
+MAXIMUM_CYCLE_VALUE = 500
+LOW_QUALITY_TAIL = 2
+QUANTIZING_LEVELS = 16
+ARGUMENTS = {
+    'binary_tag_name': 'null',
+    'covariate': 'ReadGroupCovariate,QualityScoreCovariate,ContextCovariate,CycleCovariate',
+    'default_platform': 'null',
+    'deletions_default_quality': '45',
+    'force_platform': 'null',
+    'indels_context_size': '3',
+    'insertions_default_quality': '45',
+    'low_quality_tail': str(LOW_QUALITY_TAIL),
+    'maximum_cycle_value': str(MAXIMUM_CYCLE_VALUE),
+    'mismatches_context_size': str(MISMATCHES_CONTEXT_SIZE),
+    'mismatches_default_quality': '-1',
+    'no_standard_covs': 'false',
+    'quantizing_levels': str(QUANTIZING_LEVELS),
+    'recalibration_report': 'null',
+    'run_without_dbsnp': 'false',
+    'solid_nocall_strategy': 'THROW_EXCEPTION',
+    'solid_recal_mode': 'SET_Q_ZERO',
+    }
+# GATK's QualityUtils and RecalDatum constants
+MIN_USABLE_Q_SCORE = 6
+MAX_SAM_QUAL_SCORE = 93
+MAX_REASONABLE_Q_SCORE = 60
+MAX_GATK_USABLE_Q_SCORE = 40
+MAX_NUMBER_OF_OBSERVATIONS = 2 ** 31 - 2
+SMOOTHING_CONSTANT = 1
+N_QUALS = MAX_SAM_QUAL_SCORE + 1
+N_CONTEXTS = 4 ** MISMATCHES_CONTEXT_SIZE
+N_CYCLES = 2 * MAXIMUM_CYCLE_VALUE + 1
+# log10 of GATK's gaussian prior on the difference between empirical and reported quality
+LOG10_PRIOR = np.array([math.log10(0.9 * math.exp(-i ** 2 / 0.5))
+        if 0.9 * math.exp(-i ** 2 / 0.5) > 0 else -sys.float_info.max
+        for i in range(MAX_GATK_USABLE_Q_SCORE + 1)])
+
+EXCLUDE_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+BASES = 'ACGT'
+# base index (ACGT -> 0-3, anything else -1) of 4 bit bam base codes and of ascii bases
+BAM_BASE_INDEX = np.full(16, -1, dtype=np.int8)
+BAM_BASE_INDEX[[1, 2, 4, 8]] = range(4)
+ASCII_BASE_INDEX = np.full(256, -1, dtype=np.int8)
+for i, base in enumerate(BASES):
+    ASCII_BASE_INDEX[ord(base)] = ASCII_BASE_INDEX[ord(base.lower())] = i
+# cigar ops that consume query, that consume reference and that align a base
+QUERY_OPS = (0, 1, 4, 7, 8)
+REFERENCE_OPS = (0, 2, 3, 7, 8)
+ALIGNED_OPS = (0, 7, 8)
+RECORD_FIELDS = dict(bam_filter.FIELDS, l_read_name=(12, 'u1'), n_cigar_op=(16, '<u2'),
+        l_seq=(20, '<i4'))
+
+class Reference(object):
+    """Contigs of a fasta as arrays of base indices, one contig in memory at a time"""
+    def __init__(self, fasta_fp):
+        self.fasta = genome_access.MappedFasta(fasta_fp)
+        self.name = None
+        self.sequence = None
+
+    def get(self, name):
+        if name != self.name:
+            self.sequence = ASCII_BASE_INDEX[self.fasta.view(name)]
+            self.name = name
+        return self.sequence
+
+    def __getstate__(self):
+        # the loaded contig isn't worth sending between processes
+        return dict(self.__dict__, name=None, sequence=None)
+
+def get_read_group_names(header_text):
+    """Returns (names, read_group_keys), the read group names of the report (platform
+    unit, or id if there is none, as GATK) and a dict of read group id -> index in
+    names"""
+    names = []
+    read_group_keys = {}
+    for line in header_text.split('\n'):
+        if not line.startswith('@RG\t'):
+            continue
+        fields = dict(field.split(':', 1) for field in line.split('\t')[1:] if ':' in field)
+        name = fields.get('PU', fields.get('ID'))
+        if name not in names:
+            names.append(name)
+        read_group_keys[fields.get('ID')] = names.index(name)
+    return names, read_group_keys
+
+def expand(values, counts):
+    """Returns (repeated, within), values repeated counts times each and the position
+    of each element within its repeat"""
+    repeated = np.repeat(values, counts)
+    firsts = np.repeat(np.cumsum(counts) - counts, counts)
+    return repeated, np.arange(len(repeated)) - firsts
+
+class CovariateCollector(object):
+    """Counts observations and errors per read group, quality and covariate for records
+    added a batch at a time.
+
+    known_sites is a genome_access.KnownSites, or a dict from
+    genome_access.load_known_sites.
+    """
+    def __init__(self, header_text, references, reference_fp, known_sites):
+        self.read_group_names, self.read_group_keys = get_read_group_names(header_text)
+        if not self.read_group_names:
+            raise ValueError('base recalibration needs reads with read groups')
+        # records are only looked up when there is more than one read group
+        self.single_read_group = len(self.read_group_keys) == 1
+        self.contigs = [name for name, _ in references]
+        self.reference = Reference(reference_fp)
+        self.known_sites = known_sites
+        n = len(self.read_group_names)
+        self.counts = {
+            'QualityScore': np.zeros((2, n, N_QUALS), dtype=np.int64),
+            'Context': np.zeros((2, n, N_QUALS, N_CONTEXTS), dtype=np.int64),
+            'Cycle': np.zeros((2, n, N_QUALS, N_CYCLES), dtype=np.int64),
+            }
+
+    def merge(self, counts):
+        """Adds counts of another collector over the same header"""
+        for name, values in counts.items():
+            self.counts[name] += values
+
+    def get_read_group_keys(self, data, offsets, aux_offsets):
+        if self.single_read_group:
+            return np.zeros(len(offsets), dtype=np.int64)
+        keys = np.empty(len(offsets), dtype=np.int64)
+        for i, (offset, aux_offset) in enumerate(zip(offsets, aux_offsets)):
+            size = int.from_bytes(data[offset:offset + 4], 'little')
+            record = bytes(data[offset + 4:offset + 4 + size])
+            read_group = bam_io.get_read_group(record, int(aux_offset - offset - 4))
+            if read_group not in self.read_group_keys:
+                raise ValueError(f'read group {read_group} is not in the header')
+            keys[i] = self.read_group_keys[read_group]
+        return keys
+
+    def add_batch(self, data, offsets):
+        """Counts the records starting (block_size field included) at offsets in data"""
+        fields = bam_filter.get_fields(data, np.asarray(offsets, dtype=np.int64),
+                fields=RECORD_FIELDS)
+        view = np.frombuffer(data, dtype=np.uint8)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        cigar_offsets = offsets + 4 + bam_io.RECORD_FIXED_SIZE + fields['l_read_name']
+        seq_offsets = cigar_offsets + 4 * fields['n_cigar_op'].astype(np.int64)
+        qual_offsets = seq_offsets + (fields['l_seq'].astype(np.int64) + 1) // 2
+        keep = (fields['flag'] & EXCLUDE_FLAGS == 0) & (fields['mapping_quality'] != 0) & \
+                (fields['mapping_quality'] != 255) & (fields['n_cigar_op'] > 0) & \
+                (fields['l_seq'] > 0)
+        # missing qualities are stored as 0xff
+        keep &= view[np.where(keep, qual_offsets, 0)] != 0xff
+        if not keep.any():
+            return
+        fields = {name: values[keep] for name, values in fields.items()}
+        offsets, cigar_offsets, seq_offsets, qual_offsets = (offsets[keep],
+                cigar_offsets[keep], seq_offsets[keep], qual_offsets[keep])
+        n_records = len(offsets)
+        l_seq = fields['l_seq'].astype(np.int64)
+        read_groups = self.get_read_group_keys(data, offsets, qual_offsets + l_seq)
+
+        # cigar ops of every record, with where each starts on the query and reference
+        op_record, op_index = expand(np.arange(n_records),
+                fields['n_cigar_op'].astype(np.int64))
+        op_offsets = cigar_offsets[op_record] + 4 * op_index
+        cigar = view[op_offsets[:, None] + np.arange(4)].copy().view('<u4').ravel()
+        ops, lengths = cigar & 0xf, (cigar >> 4).astype(np.int64)
+        query_lengths = np.where(np.isin(ops, QUERY_OPS), lengths, 0)
+        reference_lengths = np.where(np.isin(ops, REFERENCE_OPS), lengths, 0)
+        query_starts = np.cumsum(query_lengths) - query_lengths
+        reference_starts = np.cumsum(reference_lengths) - reference_lengths
+        first_ops = np.cumsum(fields['n_cigar_op']) - fields['n_cigar_op']
+        query_starts -= query_starts[first_ops][op_record]
+        reference_starts += fields['pos'][op_record] - reference_starts[first_ops][op_record]
+        # drop records whose cigar doesn't match their sequence
+        valid = np.bincount(op_record, weights=query_lengths, minlength=n_records) == l_seq
+        reference_ends = fields['pos'] + np.bincount(op_record, weights=reference_lengths,
+                minlength=n_records).astype(np.int64)
+
+        # every base of the query
+        base_op, within = expand(np.arange(len(ops)), query_lengths)
+        base_record = op_record[base_op]
+        query_index = query_starts[base_op] + within
+        aligned = np.isin(ops[base_op], ALIGNED_OPS)
+        reference_positions = np.where(aligned, reference_starts[base_op] + within, -1)
+
+        # like GATK, clip adaptor sequence past the mate's start, then soft clips
+        flag = fields['flag'].astype(np.int64)
+        reverse = flag & 0x10 > 0
+        start, end = fields['pos'] + 1, reference_ends
+        mate_start = fields['next_pos'] + 1
+        template_length = fields['template_length'].astype(np.int64)
+        well_defined = (template_length != 0) & (flag & 0x1 > 0) & (flag & 0x8 == 0) & \
+                (reverse != (flag & 0x20 > 0)) & \
+                np.where(reverse, end > mate_start, start <= mate_start + template_length)
+        boundary = np.where(reverse, mate_start - 1, start + np.abs(template_length))
+        clip_adaptor = well_defined & (start <= boundary) & (boundary <= end)
+        # reverse reads lose bases up to the boundary, forward reads from it on
+        boundary_1based = reference_positions + 1
+        lo = np.zeros(n_records, dtype=np.int64)
+        hi = l_seq.copy()
+        cut = aligned & clip_adaptor[base_record] & reverse[base_record] & \
+                (boundary_1based <= boundary[base_record])
+        np.maximum.at(lo, base_record[cut], query_index[cut] + 1)
+        cut = aligned & clip_adaptor[base_record] & ~reverse[base_record] & \
+                (boundary_1based >= boundary[base_record])
+        np.minimum.at(hi, base_record[cut], query_index[cut])
+        unclipped = ops[base_op] != 4
+        first_unclipped = np.full(n_records, np.iinfo(np.int64).max)
+        last_unclipped = np.full(n_records, -1)
+        np.minimum.at(first_unclipped, base_record[unclipped], query_index[unclipped])
+        np.maximum.at(last_unclipped, base_record[unclipped], query_index[unclipped])
+        lo = np.maximum(lo, first_unclipped)
+        hi = np.minimum(hi, last_unclipped + 1)
+        valid &= hi > lo
+
+        kept = valid[base_record] & (query_index >= lo[base_record]) & \
+                (query_index < hi[base_record])
+        base_record, query_index, aligned, reference_positions, base_op = (
+                base_record[kept], query_index[kept], aligned[kept],
+                reference_positions[kept], base_op[kept])
+        if not len(base_record):
+            return
+        read_index = query_index - lo[base_record]
+        read_length = (hi - lo)[base_record]
+        record_reverse = reverse[base_record]
+
+        seq_bytes = view[seq_offsets[base_record] + query_index // 2]
+        codes = np.where(query_index % 2 == 0, seq_bytes >> 4, seq_bytes & 0xf)
+        bases = BAM_BASE_INDEX[codes].astype(np.int64)
+        quals = view[qual_offsets[base_record] + query_index].astype(np.int64)
+
+        # low quality tails are left out of contexts
+        good = quals > LOW_QUALITY_TAIL
+        first_good = np.full(n_records, np.iinfo(np.int64).max)
+        last_good = np.full(n_records, -1)
+        np.minimum.at(first_good, base_record[good], read_index[good])
+        np.maximum.at(last_good, base_record[good], read_index[good])
+        context_bases = np.where((read_index < first_good[base_record]) |
+                (read_index > last_good[base_record]), -1, bases)
+
+        # the context is the base and the one before it in sequencing order, so reverse
+        # reads take the complement of the next base
+        previous = np.append(-1, context_bases[:-1])
+        following = np.append(context_bases[1:], -1)
+        first = np.where(record_reverse, np.where(following >= 0, 3 - following, -1),
+                previous)
+        has_context = np.where(record_reverse, read_index < read_length - 1, read_index > 0)
+        second = np.where(record_reverse, 3 - context_bases, context_bases)
+        contexts = np.where(has_context & (first >= 0) & (context_bases >= 0),
+                first * 4 + second, -1)
+
+        # cycles count from 1 in sequencing order, negative for the second read of a pair
+        second_of_pair = (flag[base_record] & 0x81) == 0x81
+        cycles = np.where(record_reverse, read_length - read_index, read_index + 1)
+        cycles = np.where(second_of_pair, -cycles, cycles)
+        if np.abs(cycles).max() > MAXIMUM_CYCLE_VALUE:
+            raise ValueError(f'reads longer than {MAXIMUM_CYCLE_VALUE} bases can not be '
+                    'recalibrated')
+
+        errors = np.zeros(len(bases), dtype=np.int64)
+        known = np.zeros(len(bases), dtype=bool)
+        ref_ids = fields['ref_id'][base_record]
+        for ref_id in np.unique(ref_ids):
+            on_contig = ref_ids == ref_id
+            name = self.contigs[ref_id]
+            sequence = self.reference.get(name)
+            positions = reference_positions[on_contig]
+            in_reference = aligned[on_contig] & (positions < len(sequence))
+            reference_bases = np.where(in_reference,
+                    sequence[np.where(in_reference, positions, 0)], -1)
+            errors[on_contig] = aligned[on_contig] & (reference_bases != bases[on_contig])
+            known[on_contig] = aligned[on_contig] & \
+                    genome_access.is_known(self.known_sites.get(name), positions)
+
+        # inserted bases are at a known site if the aligned bases either side are
+        index = np.arange(len(bases))
+        bounds = np.searchsorted(base_record, np.arange(n_records + 1))
+        record_starts, record_ends = bounds[:-1][base_record], bounds[1:][base_record]
+        before = np.maximum.accumulate(np.where(aligned, index, -1))
+        after = np.minimum.accumulate(np.where(aligned, index, len(bases))[::-1])[::-1]
+        inserted = ~aligned & (before >= record_starts) & (after < record_ends)
+        known[inserted] = known[before[inserted]] & known[np.minimum(after, len(bases) - 1)
+                [inserted]]
+
+        use = (bases >= 0) & (quals >= MIN_USABLE_Q_SCORE) & ~known
+        keys = read_groups[base_record] * N_QUALS + quals
+        self.add_counts('QualityScore', keys[use], errors[use])
+        use_context = use & (contexts >= 0)
+        self.add_counts('Context', keys[use_context] * N_CONTEXTS + contexts[use_context],
+                errors[use_context])
+        self.add_counts('Cycle', keys[use] * N_CYCLES + cycles[use] + MAXIMUM_CYCLE_VALUE,
+                errors[use])
+
+    def add_counts(self, name, keys, errors):
+        counts = self.counts[name]
+        size = counts[0].size
+        counts[0] += np.bincount(keys, minlength=size).reshape(counts[0].shape)
+        counts[1] += np.bincount(keys, weights=errors, minlength=size).astype(
+                np.int64).reshape(counts[1].shape)
+
+def get_empirical_quality(observations, errors, reported):
+    """GATK's RecalDatum empirical quality of arrays of observation and error counts:
+    the most likely quality from 0 to 60 given the counts, each smoothed by one, and a
+    gaussian prior around the reported quality"""
+    errors = np.floor(np.asarray(errors, dtype=np.float64) + 0.5) + SMOOTHING_CONSTANT
+    observations = np.asarray(observations, dtype=np.float64) + 2 * SMOOTHING_CONSTANT
+    # the binomial is computed over at most an int's worth of observations
+    scale = np.minimum(1.0, MAX_NUMBER_OF_OBSERVATIONS / observations)
+    errors = np.where(scale < 1, np.floor(errors * scale + 0.5), errors)
+    observations = np.minimum(observations, MAX_NUMBER_OF_OBSERVATIONS)
+
+    log10_coefficient = np.array([(math.lgamma(n + 1) - math.lgamma(k + 1) -
+            math.lgamma(n - k + 1)) / math.log(10) for n, k in zip(observations, errors)])
+    qualities = np.arange(MAX_REASONABLE_Q_SCORE + 1, dtype=np.float64)
+    log10_error = -qualities / 10
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        log10_correct = np.log10(1 - 10 ** log10_error)
+        likelihood = log10_coefficient[:, None] + errors[:, None] * log10_error + \
+                (observations - errors)[:, None] * log10_correct
+        likelihood[~np.isfinite(likelihood)] = -sys.float_info.max
+        difference = np.minimum(np.abs(np.trunc(qualities[None, :] -
+                np.asarray(reported, dtype=np.float64)[:, None])), MAX_GATK_USABLE_Q_SCORE)
+        posterior = LOG10_PRIOR[difference.astype(np.int64)] + likelihood
+    return np.minimum(np.argmax(posterior, axis=1), MAX_SAM_QUAL_SCORE).astype(np.float64)
+
+def quantize(histogram, n_levels=QUANTIZING_LEVELS, min_interesting_quality=MIN_USABLE_Q_SCORE):
+    """Returns list mapping every quality to its quantized quality, merging neighbouring
+    qualities of the histogram until n_levels are left as GATK's QualQuantizer"""
+    def error_rate(interval):
+        if interval['fixed'] is not None:
+            return 10 ** (-interval['fixed'] / 10)
+        if interval['observations'] == 0:
+            return 0.0
+        return (interval['errors'] + 1) / (interval['observations'] + 1)
+
+    def penalty(interval, global_error_rate):
+        if global_error_rate == 0.0:
+            return 0.0
+        if not interval['subintervals']:
+            if interval['end'] <= min_interesting_quality:
+                return 0.0
+            return abs(math.log10(error_rate(interval)) - math.log10(global_error_rate)) * \
+                    interval['observations']
+        return sum(penalty(subinterval, global_error_rate)
+                for subinterval in interval['subintervals'])
+
+    intervals = [{'start': q, 'end': q, 'observations': n,
+            'errors': math.floor(n * 10 ** (-q / 10)), 'fixed': q, 'subintervals': []}
+            for q, n in enumerate(histogram)]
+    while len(intervals) > n_levels:
+        best = None
+        for i in range(len(intervals) - 1):
+            left, right = intervals[i], intervals[i + 1]
+            merged = {'start': left['start'], 'end': right['end'],
+                    'observations': left['observations'] + right['observations'],
+                    'errors': left['errors'] + right['errors'], 'fixed': None,
+                    'subintervals': [left, right]}
+            merged_penalty = penalty(merged, error_rate(merged))
+            if best is None or merged_penalty < best[0]:
+                best = (merged_penalty, i, merged)
+        _, i, merged = best
+        intervals[i:i + 2] = [merged]
+
+    quantized = [0] * len(histogram)
+    for interval in intervals:
+        if interval['fixed'] is not None:
+            quality = interval['fixed']
+        else:
+            quality = round_half_up(-10 * math.log10(error_rate(interval))) \
+                    if error_rate(interval) > 0 else MAX_SAM_QUAL_SCORE
+            quality = max(1, min(quality, MAX_SAM_QUAL_SCORE))
+        for q in range(interval['start'], interval['end'] + 1):
+            quantized[q] = quality
+    return quantized
+
+def round_half_up(x):
+    return int(math.floor(x + 0.5))
+
+def format_table(name, description, columns, rows):
+    """Returns a GATKReport v1.1 table. columns is a list of (name, format), values
+    are aligned in fixed width columns as GATK does so its parser can split them"""
+    cells = [[fmt % value for (_, fmt), value in zip(columns, row)] for row in rows]
+    widths = [max([len(column)] + [len(row[i]) for row in cells])
+            for i, (column, _) in enumerate(columns)]
+    right = [all(is_number(row[i]) for row in cells) for i in range(len(columns))]
+
+    lines = [f'#:GATKTable:{len(columns)}:{len(rows)}:' +
+            ''.join(f'{fmt}:' for _, fmt in columns) + ';',
+            f'#:GATKTable:{name}:{description}',
+            '  '.join(column.ljust(width) for (column, _), width in zip(columns, widths))]
+    for row in cells:
+        lines.append('  '.join(value.rjust(width) if align else value.ljust(width)
+                for value, width, align in zip(row, widths, right)))
+    return '\n'.join(lines) + '\n\n'
+
+def is_number(value):
+    try:
+        float(value)
+    except ValueError:
+        return value in ('null', 'NA')
+    return True
+
+def write_report(collector, output_fp):
+    """Writes the counts of a CovariateCollector as a GATK recalibration report"""
+    names = collector.read_group_names
+    counts = collector.counts
+
+    # quality score table
+    quality_observations, quality_errors = counts['QualityScore']
+    read_group_keys, qualities = np.nonzero(quality_observations)
+    observations = quality_observations[read_group_keys, qualities]
+    errors = quality_errors[read_group_keys, qualities]
+    empirical = get_empirical_quality(observations, errors, qualities)
+    quality_rows = sorted((names[rg], int(q), 'M', e, int(n), float(x))
+            for rg, q, e, n, x in zip(read_group_keys, qualities, empirical, observations,
+                    errors))
+
+    # read group table, reported quality is the quality expected from every observation
+    read_group_rows = []
+    for rg in sorted(set(read_group_keys), key=lambda rg: names[rg]):
+        n = quality_observations[rg]
+        expected_errors = float((n * 10 ** (-np.arange(N_QUALS) / 10)).sum())
+        total = int(n.sum())
+        reported = -10 * math.log10(expected_errors / total)
+        read_group_rows.append((names[rg], 'M', get_empirical_quality([total],
+                [quality_errors[rg].sum()], [reported])[0], reported, total,
+                float(quality_errors[rg].sum())))
+
+    # context and cycle table
+    covariate_rows = []
+    for covariate, to_value in (('Context', lambda v: BASES[v // 4] + BASES[v % 4]),
+            ('Cycle', lambda v: str(v - MAXIMUM_CYCLE_VALUE))):
+        covariate_observations, covariate_errors = counts[covariate]
+        read_group_keys, covariate_qualities, values = np.nonzero(covariate_observations)
+        observations = covariate_observations[read_group_keys, covariate_qualities, values]
+        errors = covariate_errors[read_group_keys, covariate_qualities, values]
+        empirical = get_empirical_quality(observations, errors, covariate_qualities)
+        covariate_rows += [(names[rg], int(q), to_value(int(v)), covariate, 'M', e, int(n),
+                float(x)) for rg, q, v, e, n, x in zip(read_group_keys, covariate_qualities,
+                        values, empirical, observations, errors)]
+    covariate_rows.sort()
+
+    # quantization of the empirical qualities of the quality score table
+    histogram = [0] * N_QUALS
+    for _, _, _, e, n, _ in quality_rows:
+        histogram[round_half_up(e)] += n
+    quantized = quantize(histogram)
+
+    with open(output_fp, 'w') as f:
+        f.write('#:GATKReport.v1.1:5\n')
+        f.write(format_table('Arguments',
+                'Recalibration argument collection values used in this run',
+                [('Argument', '%s'), ('Value', '%s')], sorted(ARGUMENTS.items())))
+        f.write(format_table('Quantized', 'Quality quantization map',
+                [('QualityScore', '%d'), ('Count', '%d'), ('QuantizedScore', '%d')],
+                [(q, histogram[q], quantized[q]) for q in range(N_QUALS)]))
+        f.write(format_table('RecalTable0', '', [('ReadGroup', '%s'), ('EventType', '%s'),
+                ('EmpiricalQuality', '%.4f'), ('EstimatedQReported', '%.4f'),
+                ('Observations', '%d'), ('Errors', '%.2f')], read_group_rows))
+        f.write(format_table('RecalTable1', '', [('ReadGroup', '%s'),
+                ('QualityScore', '%d'), ('EventType', '%s'), ('EmpiricalQuality', '%.4f'),
+                ('Observations', '%d'), ('Errors', '%.2f')], quality_rows))
+        f.write(format_table('RecalTable2', '', [('ReadGroup', '%s'),
+                ('QualityScore', '%d'), ('CovariateValue', '%s'), ('CovariateName', '%s'),
+                ('EventType', '%s'), ('EmpiricalQuality', '%.4f'), ('Observations', '%d'),
+                ('Errors', '%.2f')], covariate_rows))
@@ -0,0 +1,70 @@
+"""Splits the genome into balanced shards of whole contigs for scatter-gather runs."""
+import bam_io
+import genome_access
+
+# gatk interval name for reads without a position
+UNMAPPED_INTERVAL = 'unmapped'
+
+def read_fasta_index(reference_fp):
+    """Returns list of (contig, length) tuples from the .fai next to the reference"""
+    return genome_access.MappedFasta(reference_fp).get_lengths()
+
+def get_contig_weights(reference_fp, bam_index_fp=None):
+    """Returns list of (contig, weight) in reference order.
+
+    Weights are read counts from the bam index when it is given and has per reference
+    metadata, otherwise contig lengths.
+    """
+    contigs = read_fasta_index(reference_fp)
+    if bam_index_fp is None:
+        return contigs
+
+    references, _ = bam_io.read_bam_index(bam_index_fp)
+    if len(references) != len(contigs) or any(r['mapped'] is None for r in references):
+        return contigs
+
+    return [(name, r['mapped'] + r['unmapped'])
+            for (name, _), r in zip(contigs, references)]
+
+def has_unplaced_reads(bam_index_fp):
+    """Returns False only if the bam index says there are no unplaced unmapped reads"""
+    if bam_index_fp is None:
+        return True
+    _, n_no_coordinate = bam_io.read_bam_index(bam_index_fp)
+    return n_no_coordinate is None or n_no_coordinate > 0
+
+def create_shards(reference_fp, n_shards, bam_index_fp=None):
+    """Packs whole contigs into at most n_shards shards of roughly equal weight.
+
+    Contigs are never split, so reads overlapping a shard boundary can't be emitted by
+    two shards. Unplaced unmapped reads get their own shard.
+
+    Returns
+        shards - list of lists of interval names, each in reference order
+    """
+    weights = get_contig_weights(reference_fp, bam_index_fp=bam_index_fp)
+    order = {name: i for i, (name, _) in enumerate(weights)}
+
+    # longest processing time first, always add to the lightest shard
+    shards = [[] for _ in range(min(n_shards, len(weights)))]
+    totals = [0] * len(shards)
+    for name, weight in sorted(weights, key=lambda x: x[1], reverse=True):
+        if bam_index_fp is not None and weight == 0:
+            continue
+        i = totals.index(min(totals))
+        shards[i].append(name)
+        totals[i] += weight
+
+    shards = [sorted(shard, key=order.get) for shard in shards if shard]
+    if has_unplaced_reads(bam_index_fp):
+        shards.append([UNMAPPED_INTERVAL])
+
+    return shards
+
+def write_intervals(shard, output_fp):
+    """Writes a gatk .intervals list file for the shard"""
+    with open(output_fp, 'w') as f:
+        for name in shard:
+            f.write(name + '\n')
+
+    return output_fp
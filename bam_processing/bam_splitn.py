@@ -0,0 +1,586 @@
+"""Native splitting of spliced reads of coordinate sorted bams, following GATK
+SplitNCigarReads.
+
+Every read with N cigar operations is cut into one record per section between them,
+with the rest of the read hard clipped. Deletions and insertions next to a cut are
+dropped with it, and sections without aligned bases are left out. The first section
+keeps the read's flags, the others are supplementary, and every section gets an SA tag
+naming the others. Secondary reads aren't split. Mapping quality 255 is taken as 60.
+
+Like GATK, reads (split or not) that overhang a splice junction seen in any read, by at
+most MAX_BASES_IN_OVERHANG bases and no more than half their length, have the overhang
+hard clipped if it doesn't match the start or end of the intron on the reference.
+Reference bases are read through a memory map of the fasta, using its .fai.
+
+Clipping can move the first section of a read, so as in GATK there are two passes. The
+first finds where the primary section of every pair ends up, the second writes the
+records with their mates' positions and MC tags pointing there.
+
+With an index, contigs are split by separate processes.
+"""
+import bisect
+import heapq
+import logging
+import struct
+
+import numpy as np
+
+import bam_chunks
+import bam_filter
+import bam_io
+import bam_markdup
+import bam_recal
+import genome_access
+
+# GATK's overhang fixing defaults
+MAX_BASES_IN_OVERHANG = 40
+MAX_MISMATCHES_IN_OVERHANG = 1
+# like GATK, mapping quality 255 (unavailable, STAR's unique mappers) is taken as 60
+MAPPING_QUALITY_255 = 60
+# drop splice junctions no open section can reach every this many records
+PRUNE_INTERVAL = 10000
+CIGAR_OPS = 'MIDNSHP=X'
+M, I, D, N, S, H = 0, 1, 2, 3, 4, 5
+QUERY_OPS = {0, 1, 4, 7, 8}
+REFERENCE_OPS = {0, 2, 3, 7, 8}
+ALIGNED_OPS = {0, 7, 8}
+# hex digits of packed bam bases -> bases
+SEQ_TABLE = str.maketrans('0123456789abcdef', '=ACMGRSVTWYHKDBN')
+RECORD_FORMAT = '<iiBBHHHiiii'
+MATE_BITS = {0x40: 0x80, 0x80: 0x40}
+
+class Read(object):
+    """A record with the fields splitting needs"""
+    __slots__ = ('record', 'ref_id', 'pos', 'mapping_quality', 'flag', 'l_seq',
+            'next_ref_id', 'next_pos', 'name', 'ops', 'seq_offset', 'aux_offset', 'bases')
+
+    def __init__(self, record, fields, ops):
+        self.record = record
+        (self.ref_id, self.pos, l_read_name, self.mapping_quality, _, n_cigar_op, self.flag,
+                self.l_seq, self.next_ref_id, self.next_pos, _) = fields
+        self.name = record[bam_io.RECORD_FIXED_SIZE:bam_io.RECORD_FIXED_SIZE + l_read_name - 1]
+        self.ops = ops
+        self.seq_offset = bam_io.RECORD_FIXED_SIZE + l_read_name + 4 * n_cigar_op
+        self.aux_offset = self.seq_offset + (self.l_seq + 1) // 2 + self.l_seq
+        self.bases = None
+
+    def get_bases(self, start, end):
+        """Returns the bases [start, end) of the query"""
+        if self.bases is None:
+            packed = self.record[self.seq_offset:self.seq_offset + (self.l_seq + 1) // 2]
+            self.bases = packed.hex().translate(SEQ_TABLE)
+        return self.bases[start:end].encode('ascii')
+
+class Section(object):
+    """A section of a read, the query bases [q0, q1) aligned at pos by cigar ops, with
+    h0 and h1 bases hard clipped before and after. ops is None for records that are
+    passed through as they are."""
+    __slots__ = ('read', 'number', 'pos', 'ops', 'q0', 'q1', 'h0', 'h1', 'flag', 'sa',
+            'closed')
+
+    def __init__(self, read, number, pos, ops, q0, q1, h0, h1, flag):
+        self.read = read
+        self.number = number
+        self.pos = pos
+        self.ops = ops
+        self.q0, self.q1 = q0, q1
+        self.h0, self.h1 = h0, h1
+        self.flag = flag
+        self.sa = None
+        self.closed = False
+
+    def get_end(self):
+        if self.ops is None:
+            return self.pos
+        return self.pos + sum(length for op, length in self.ops if op in REFERENCE_OPS)
+
+    def get_cigar(self):
+        return format_cigar(([(H, self.h0)] if self.h0 else []) + self.ops +
+                ([(H, self.h1)] if self.h1 else []))
+
+    def is_whole(self):
+        return self.ops is None or (self.number == 0 and self.ops is self.read.ops)
+
+def format_cigar(ops):
+    return ''.join(f'{length}{CIGAR_OPS[op]}' for op, length in ops)
+
+def clip_ops(ops, n):
+    """Removes n query bases from the start of cigar ops, then any deletion or insertion
+    left at the new start.
+
+    Returns
+        (ops, query, reference) - remaining ops, and query and reference bases removed
+    """
+    ops = list(ops)
+    query = reference = 0
+    while ops and (n > 0 or ops[0][0] in (I, D)):
+        op, length = ops[0]
+        take = length
+        if op in QUERY_OPS and n > 0:
+            take = min(n, length)
+            n -= take
+        if op in QUERY_OPS:
+            query += take
+        if op in REFERENCE_OPS:
+            reference += take
+        if take < length:
+            ops[0] = (op, length - take)
+        else:
+            ops.pop(0)
+    return ops, query, reference
+
+def clip_start(section, n):
+    section.ops, query, reference = clip_ops(section.ops, n)
+    section.q0 += query
+    section.h0 += query
+    section.pos += reference
+
+def clip_end(section, n):
+    ops, query, _ = clip_ops(section.ops[::-1], n)
+    section.ops = ops[::-1]
+    section.q1 -= query
+    section.h1 += query
+
+def split_read(read):
+    """Returns (sections, splices), the sections of a read between its N cigar
+    operations and the [start, end) reference span of each of them"""
+    ops = read.ops
+    h0 = ops[0][1] if ops and ops[0][0] == H else 0
+    h1 = ops[-1][1] if len(ops) > 1 and ops[-1][0] == H else 0
+    core = ops[1 if h0 else 0:len(ops) - 1 if h1 else len(ops)]
+    if read.flag & 0x100 or not any(op == N for op, _ in core):
+        return [Section(read, 0, read.pos, ops if not h0 and not h1 else core, 0, read.l_seq,
+                h0, h1, read.flag)], []
+
+    sections = []
+    splices = []
+    query = 0
+    reference = read.pos
+    bounds = []
+    current = []
+    section_query, section_reference = 0, reference
+    for op, length in core + [(N, 0)]:
+        if op == N:
+            bounds.append((current, section_query, query, section_reference))
+            if length:
+                splices.append((reference, reference + length))
+            reference += length
+            current = []
+            section_query, section_reference = query, reference
+            continue
+        current.append((op, length))
+        if op in QUERY_OPS:
+            query += length
+        if op in REFERENCE_OPS:
+            reference += length
+
+    for i, (section_ops, q0, q1, pos) in enumerate(bounds):
+        # only the ends next to a cut lose their deletions and insertions
+        if i > 0:
+            section_ops, removed, shift = clip_ops(section_ops, 0)
+            q0 += removed
+            pos += shift
+        if i < len(bounds) - 1:
+            section_ops, removed, _ = clip_ops(section_ops[::-1], 0)
+            section_ops = section_ops[::-1]
+            q1 -= removed
+        if not any(op in ALIGNED_OPS for op, _ in section_ops):
+            continue
+        number = len(sections)
+        flag = read.flag | 0x800 if number else read.flag
+        sections.append(Section(read, number, pos, section_ops, q0, q1, h0 + q0,
+                h1 + read.l_seq - q1, flag))
+    return sections, splices
+
+def get_nm(read):
+    for tag, value_type, value_offset, size in bam_io.iter_aux(read.record, read.aux_offset):
+        if tag == 'NM' and value_type in bam_io.AUX_TYPE_FORMATS:
+            return struct.unpack_from(bam_io.AUX_TYPE_FORMATS[value_type], read.record,
+                    value_offset)[0]
+    return 0
+
+def get_aux(read, tag):
+    for aux_tag, value_type, value_offset, size in bam_io.iter_aux(read.record,
+            read.aux_offset):
+        if aux_tag == tag and value_type == 'Z':
+            return read.record[value_offset:value_offset + size - 1].decode('ascii')
+    return None
+
+def set_supplementary_tags(sections, contig):
+    """Gives every section an SA tag naming the other sections, followed by the
+    alignments the read's own SA tag named"""
+    read = sections[0].read
+    mapping_quality = read.mapping_quality
+    if mapping_quality == 255:
+        mapping_quality = MAPPING_QUALITY_255
+    nm = get_nm(read)
+    entries = [f'{contig},{s.pos + 1},{"-" if s.flag & 0x10 else "+"},{s.get_cigar()},'
+            f'{mapping_quality},{nm};' for s in sections]
+    original = get_aux(read, 'SA') or ''
+    for i, section in enumerate(sections):
+        section.sa = ''.join(entries[:i] + entries[i + 1:]) + original
+
+def mismatches(read_bases, reference_bases):
+    """GATK's test of whether overhanging bases don't belong where they are aligned"""
+    if read_bases == reference_bases:
+        return False
+    n = sum(1 for a, b in zip(read_bases, reference_bases) if a != b)
+    if n > MAX_MISMATCHES_IN_OVERHANG:
+        return True
+    return n >= (len(read_bases) + 1) // 2
+
+def build_record(section, mate_change=None):
+    """Returns the raw bam record of a section. mate_change is the (pos, cigar) its
+    mate ended up with, if that changed"""
+    read = section.read
+    record = read.record
+    mapping_quality = MAPPING_QUALITY_255 if read.mapping_quality == 255 else \
+            read.mapping_quality
+    drop = set()
+    extra = b''
+    if section.sa is not None:
+        drop.add('SA')
+        extra += b'SAZ' + section.sa.encode('ascii') + b'\x00'
+    next_pos = read.next_pos
+    if mate_change is not None:
+        next_pos, mate_cigar = mate_change
+        drop.add('MC')
+        extra += b'MCZ' + mate_cigar.encode('ascii') + b'\x00'
+
+    if section.is_whole():
+        if not drop and mapping_quality == read.mapping_quality:
+            return record
+        fixed = bytearray(record[:read.aux_offset])
+        fixed[9] = mapping_quality
+        struct.pack_into('<i', fixed, 24, next_pos)
+    else:
+        cigar = ([(H, section.h0)] if section.h0 else []) + section.ops + \
+                ([(H, section.h1)] if section.h1 else [])
+        l_seq = section.q1 - section.q0
+        packed = read.record[read.seq_offset:read.seq_offset + (read.l_seq + 1) // 2].hex()
+        seq = packed[section.q0:section.q1]
+        qual_offset = read.seq_offset + (read.l_seq + 1) // 2
+        qual = record[qual_offset + section.q0:qual_offset + section.q1]
+        if read.l_seq and record[qual_offset] == 0xff:
+            qual = b'\xff' * l_seq
+        end = section.get_end()
+        l_read_name = len(read.name) + 1
+        _, _, _, _, _, _, _, _, next_ref_id, _, template_length = struct.unpack_from(
+                RECORD_FORMAT, record, 0)
+        fixed = bytearray(struct.pack(RECORD_FORMAT, read.ref_id, section.pos, l_read_name,
+                mapping_quality, bam_io.reg2bin(section.pos, max(end, section.pos + 1)),
+                len(cigar), section.flag, l_seq, next_ref_id, next_pos, template_length))
+        fixed += read.name + b'\x00'
+        fixed += struct.pack(f'<{len(cigar)}I', *(length << 4 | op for op, length in cigar))
+        fixed += bytes.fromhex(seq + '0' * (len(seq) % 2)) + qual
+
+    aux = b''
+    for tag, _, value_offset, size in bam_io.iter_aux(record, read.aux_offset):
+        if tag not in drop:
+            aux += record[value_offset - 3:value_offset + size]
+    return bytes(fixed) + aux + extra
+
+class Splitter(object):
+    """Splits a coordinate sorted stream of records and fixes overhangs, handing back
+    sections in coordinate order once no later record can change them.
+
+    A section is done once the stream has moved past its end, since a junction a later
+    read brings in starts after it. Sections are handed back once nothing open or to
+    come can sort before them.
+
+    Without mate_changes this is the first pass, and the (pos, cigar) of the primary
+    section of every pair that moved is collected in changes, a dict of the contig of
+    the mate -> (name, read 1/2 flag bits, original pos) -> (pos, cigar). With it,
+    records are built with their mate's changes.
+    """
+    def __init__(self, reference, references, mate_changes=None):
+        self.reference = reference
+        self.contigs = [name for name, _ in references]
+        self.mate_changes = mate_changes
+        self.changes = {}
+        self.counts = {'reads': 0, 'split_reads': 0, 'records': 0, 'clipped_overhangs': 0}
+        self.ref_id = None
+        self.position = (-1, -1)
+        self.n = 0
+        self.n_since_prune = 0
+        # heaps of (end, n, section) and (pos, n, section) of sections still open
+        self.open = []
+        self.open_starts = []
+        # heap of (pos, n, section) of done sections waiting for their turn
+        self.done = []
+        self.splices = set()
+        self.splice_starts = []
+        self.splice_ends = []
+
+    def add_splice(self, splice):
+        if splice in self.splices:
+            return
+        self.splices.add(splice)
+        bisect.insort(self.splice_starts, splice)
+        bisect.insort(self.splice_ends, (splice[1], splice[0]))
+
+    def prune_splices(self, bound):
+        """Drops junctions no section starting at or after bound can overhang"""
+        cut = bisect.bisect_left(self.splice_starts, (bound,))
+        for splice in self.splice_starts[:cut]:
+            self.splices.discard(splice)
+        del self.splice_starts[:cut]
+        del self.splice_ends[:bisect.bisect_left(self.splice_ends, (bound + 1,))]
+
+    def get_overhang(self, section, splice):
+        """Returns (side, overhang) of a section overhanging a junction, or None"""
+        start, end = splice
+        pos, section_end = section.pos, section.get_end()
+        if pos < start < section_end <= end:
+            return 'left', section_end - start
+        if start <= pos < end < section_end:
+            return 'right', end - pos
+        return None
+
+    def fix_overhangs(self, section):
+        if section.ops is None or not self.splice_ends:
+            return
+        # only junctions starting or ending at most limit bases into the section count
+        pos, end = section.pos, section.get_end()
+        limit = min(MAX_BASES_IN_OVERHANG, (section.q1 - section.q0) // 2)
+        candidates = self.splice_starts[
+                bisect.bisect_left(self.splice_starts, (max(pos + 1, end - limit),)):
+                bisect.bisect_left(self.splice_starts, (end,))]
+        candidates += [(start, splice_end) for splice_end, start in self.splice_ends[
+                bisect.bisect_left(self.splice_ends, (pos + 1,)):
+                bisect.bisect_left(self.splice_ends, (min(end, pos + limit + 1),))]
+                if start <= pos]
+        if not candidates:
+            return
+        contig = self.contigs[section.read.ref_id]
+        for splice in sorted(set(candidates)):
+            overhang = self.get_overhang(section, splice)
+            if overhang is None:
+                continue
+            side, n = overhang
+            length = section.q1 - section.q0
+            if n > MAX_BASES_IN_OVERHANG or n > length // 2:
+                continue
+            if side == 'left':
+                soft = section.ops[-1][1] if section.ops[-1][0] == S else 0
+                read_bases = section.read.get_bases(section.q1 - soft - n, section.q1 - soft)
+                reference_bases = self.reference.fetch(contig, splice[0], splice[0] + n)
+                if mismatches(read_bases, reference_bases):
+                    clip_end(section, soft + n)
+                    self.counts['clipped_overhangs'] += 1
+            else:
+                soft = section.ops[0][1] if section.ops[0][0] == S else 0
+                read_bases = section.read.get_bases(section.q0 + soft, section.q0 + soft + n)
+                reference_bases = self.reference.fetch(contig, splice[1] - n, splice[1])
+                if mismatches(read_bases, reference_bases):
+                    clip_start(section, soft + n)
+                    self.counts['clipped_overhangs'] += 1
+
+    def close(self, section):
+        """Fixes the overhangs of a section that is done and queues it"""
+        self.fix_overhangs(section)
+        read = section.read
+        if self.mate_changes is None and section.number == 0 and section.ops is not None \
+                and read.flag & 0x1 and not read.flag & 0x908 and \
+                not section.is_whole() and (section.pos != read.pos or
+                section.get_cigar() != format_cigar(read.ops)):
+            key = (read.name, read.flag & 0xc0, read.pos)
+            self.changes.setdefault(read.next_ref_id, {})[key] = (section.pos,
+                    section.get_cigar())
+        heapq.heappush(self.done, (section.pos, self.n, section))
+        self.n += 1
+
+    def release(self, bound=None):
+        """Yields done sections that sort before bound, (pos, n), or all of them"""
+        while self.open_starts and self.open_starts[0][2].closed:
+            heapq.heappop(self.open_starts)
+        if self.open_starts:
+            bound = min(bound, self.open_starts[0][:2]) if bound is not None else None
+        while self.done and (bound is None or self.done[0][:2] < bound):
+            yield self.emit(heapq.heappop(self.done)[2])
+
+    def emit(self, section):
+        self.counts['records'] += 1
+        if self.mate_changes is None:
+            return None
+        read = section.read
+        mate_change = None
+        if read.flag & 0x1 and not read.flag & 0x8:
+            key = (read.name, MATE_BITS.get(read.flag & 0xc0, read.flag & 0xc0), read.next_pos)
+            # changes are kept under the contig of the read they are for
+            mate_change = self.mate_changes.get(read.ref_id, {}).get(key)
+        return build_record(section, mate_change)
+
+    def close_open(self, position=None):
+        """Closes open sections ending at or before position, or all of them"""
+        while self.open and (position is None or self.open[0][0] <= position):
+            _, _, section = heapq.heappop(self.open)
+            self.close(section)
+            section.closed = True
+
+    def add(self, read):
+        """Adds the next read of the stream, yields sections that are ready"""
+        self.counts['reads'] += 1
+        ref_id = read.ref_id
+        position = (ref_id if ref_id >= 0 else 1 << 31, read.pos)
+        if position < self.position:
+            raise ValueError('bam is not coordinate sorted')
+        self.position = position
+        if ref_id != self.ref_id:
+            yield from self.finish()
+            self.ref_id = ref_id
+            self.splices, self.splice_starts, self.splice_ends = set(), [], []
+
+        if read.flag & 0x4 or not read.ops or ref_id < 0:
+            heapq.heappush(self.done, (read.pos, self.n, Section(read, 0, read.pos, None, 0,
+                    read.l_seq, 0, 0, read.flag)))
+            self.n += 1
+        else:
+            sections, splices = split_read(read)
+            if len(sections) > 1 or splices:
+                self.counts['split_reads'] += 1
+            if len(sections) > 1:
+                set_supplementary_tags(sections, self.contigs[ref_id])
+            for splice in splices:
+                self.add_splice(splice)
+            for section in sections:
+                heapq.heappush(self.open, (section.get_end(), self.n, section))
+                heapq.heappush(self.open_starts, (section.pos, self.n, section))
+                self.n += 1
+
+        self.close_open(read.pos)
+        self.n_since_prune += 1
+        if self.n_since_prune >= PRUNE_INTERVAL:
+            self.n_since_prune = 0
+            bound = min([read.pos] + [pos for pos, _, _ in self.open_starts[:1]])
+            self.prune_splices(bound)
+        yield from self.release((read.pos, self.n))
+
+    def finish(self):
+        """Closes every section and yields all that are left"""
+        self.close_open()
+        self.open_starts = []
+        yield from self.release()
+
+def parse_batch(data, offsets):
+    """Yields a Read for each record starting (block_size field included) at offsets in
+    data. Cigars of the whole batch are parsed at once."""
+    offsets = np.asarray(offsets, dtype=np.int64)
+    fields = bam_filter.get_fields(data, offsets, fields=bam_recal.RECORD_FIELDS)
+    view = np.frombuffer(data, dtype=np.uint8)
+    n_cigar_op = fields['n_cigar_op'].astype(np.int64)
+    cigar_offsets = offsets + 4 + bam_io.RECORD_FIXED_SIZE + fields['l_read_name']
+    op_record, op_index = bam_recal.expand(np.arange(len(offsets)), n_cigar_op)
+    op_offsets = cigar_offsets[op_record] + 4 * op_index
+    cigar = view[op_offsets[:, None] + np.arange(4)].copy().view('<u4').ravel()
+    ops = list(zip((cigar & 0xf).tolist(), (cigar >> 4).tolist()))
+    first_ops = np.cumsum(n_cigar_op) - n_cigar_op
+    for offset, first, n in zip(offsets.tolist(), first_ops.tolist(), n_cigar_op.tolist()):
+        size = struct.unpack_from('<i', data, offset)[0]
+        record = data[offset + 4:offset + 4 + size]
+        yield Read(record, struct.unpack_from(RECORD_FORMAT, record, 0),
+                ops[first:first + n])
+
+def split_stream(read, splitter, writer=None):
+    """Adds records read by read(n) to splitter, writing what it hands back to writer
+    if one is given"""
+    leftover = b''
+    while True:
+        chunk = read(bam_filter.BATCH_SIZE)
+        if not chunk:
+            break
+        data = leftover + chunk
+        offsets, end = bam_filter.find_records(data)
+        if offsets:
+            for read_ in parse_batch(data, offsets):
+                for record in splitter.add(read_):
+                    if writer is not None:
+                        bam_io.write_record(writer, record)
+        leftover = data[end:]
+    if leftover:
+        raise ValueError('bam ends with a truncated record')
+    for record in splitter.finish():
+        if writer is not None:
+            bam_io.write_record(writer, record)
+
+def find_chunk_changes(input_fp, start, end, reference_fp, references):
+    """First pass over the records between virtual offsets start and end, see
+    Splitter.changes"""
+    splitter = Splitter(genome_access.MappedFasta(reference_fp), references)
+    with bam_io.BgzfReader(input_fp) as reader:
+        reader.seek(start)
+        split_stream(lambda n: reader.read_to(end, n), splitter)
+    return splitter.changes
+
+def split_chunk(input_fp, output_fp, start, end, reference_fp, references, mate_changes,
+        compression_level=6):
+    """Splits the records between virtual offsets start and end into output_fp as bgzf
+    blocks without a header or eof marker, so chunks can be concatenated. Returns the
+    counts of the splitter"""
+    splitter = Splitter(genome_access.MappedFasta(reference_fp), references,
+            mate_changes=mate_changes)
+    with bam_io.BgzfReader(input_fp) as reader, open(output_fp, 'wb') as f:
+        writer = bam_io.BgzfWriter(f, compression_level=compression_level)
+        reader.seek(start)
+        split_stream(lambda n: reader.read_to(end, n), splitter, writer)
+        writer.flush()
+    return splitter.counts
+
+def split_n_cigar_reads(input_fp, output_fp, reference_fp, threads=1, index_fp=None,
+        compression_level=6, temp_files_dir=None):
+    """Splits the reads of coordinate sorted input_fp at their N cigar operations and
+    clips their overhangs into output_fp, see the module docstring. Without a .fai next
+    to reference_fp the fasta is scanned to find its contigs.
+
+    If index_fp is given and threads > 1 each contig is split by a separate process,
+    into an intermediate in temp_files_dir.
+
+    Returns
+        counts - dict of reads read, reads split, records written and overhangs clipped
+    """
+    command_line = f'bam_splitn input={input_fp} output={output_fp} reference={reference_fp}'
+    with bam_io.BgzfReader(input_fp) as reader:
+        header_text, references = bam_io.read_header(reader)
+        first_offset = reader.tell()
+    if bam_io.get_header_tag(header_text, 'HD', 'SO') not in (None, 'coordinate'):
+        raise ValueError(f'{input_fp} must be coordinate sorted to split reads')
+
+    chunks = None
+    if index_fp is not None and threads > 1:
+        chunks = bam_chunks.get_contig_chunks(index_fp, first_offset)
+    if chunks is None:
+        chunks = [(first_offset, 1 << 64, None)]
+
+    # first pass, find where the primary sections of pairs end up
+    results = bam_chunks.map_chunks(find_chunk_changes, input_fp, chunks,
+            [(reference_fp, references)] * len(chunks), threads=threads)
+    mate_changes = {}
+    for result in results:
+        for ref_id, changes in result.items():
+            mate_changes.setdefault(ref_id, {}).update(changes)
+
+    # second pass, split and write
+    with bam_io.BgzfWriter(output_fp, compression_level=compression_level,
+            threads=threads) as writer:
+        bam_io.write_header(writer, bam_markdup.add_program(header_text, command_line,
+                program='bam_splitn'), references)
+        if len(chunks) == 1:
+            splitter = Splitter(genome_access.MappedFasta(reference_fp), references,
+                    mate_changes=mate_changes)
+            with bam_io.BgzfReader(input_fp, threads=threads) as reader:
+                reader.seek(first_offset)
+                split_stream(reader.read, splitter, writer)
+            counts = splitter.counts
+        else:
+            # each chunk only needs the changes of mates on its own contig
+            chunk_changes = [{ref_id: mate_changes.get(ref_id, {})} if ref_id is not None
+                    else {} for _, _, ref_id in chunks]
+            chunk_counts = bam_chunks.write_chunks(writer, split_chunk, input_fp, chunks,
+                    [(reference_fp, references, changes, compression_level)
+                    for changes in chunk_changes], threads=threads,
+                    temp_files_dir=temp_files_dir, prefix='splitn')
+            counts = {name: sum(c[name] for c in chunk_counts) for name in chunk_counts[0]}
+
+    logging.info(f'split {counts["split_reads"]} of {counts["reads"]} reads into '
+            f'{counts["records"]} records, clipped {counts["clipped_overhangs"]} overhangs')
+    return counts
@@ -0,0 +1,262 @@
+"""Native streaming stages that work directly on binary bam records.
+
+Each stage reads bam from input_fp and writes bam to output_fp, where either can be a
+filepath or a binary file object, so they can run on their own or as a python stage
+inside bam_processing.run_pipeline.
+"""
+import struct
+
+import numpy as np
+
+import bam_filter
+import bam_io
+
+# bytes of an MQ aux tag holding 255, for every integer type that can hold it
+MQ_255_PATTERNS = (b'MQC\xff', b'MQS\xff\x00', b'MQs\xff\x00', b'MQI\xff\x00\x00\x00',
+        b'MQi\xff\x00\x00\x00')
+
+def find_all(data, pattern, end):
+    """Returns every offset of pattern in data[:end]"""
+    positions = []
+    position = data.find(pattern, 0, end)
+    while position != -1:
+        positions.append(position)
+        position = data.find(pattern, position + 1, end)
+    return positions
+
+def fix_255_batch(data, offsets, end, new_mapping_quality=60):
+    """Rewrites 255 mapping qualities of the records starting (block_size field
+    included) at offsets in data, a bytearray, in place. Returns the number of records
+    changed.
+
+    MAPQ fields are patched for the whole batch at once. Aux fields are only parsed
+    for records where the bytes of a 255 MQ tag turn up, to tell a tag from the same
+    bytes inside another field.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    view = np.frombuffer(data, dtype=np.uint8)
+    mapping_quality_offset = bam_filter.FIELDS['mapping_quality'][0]
+    changed = view[offsets + mapping_quality_offset] == 255
+    view[offsets[changed] + mapping_quality_offset] = new_mapping_quality
+
+    positions = [position for pattern in MQ_255_PATTERNS
+            for position in find_all(data, pattern, end)]
+    candidates = np.unique(np.searchsorted(offsets, positions, side='right') - 1)
+    for i in candidates.tolist():
+        record_offset = int(offsets[i]) + 4
+        size = struct.unpack_from('<i', data, offsets[i])[0]
+        record = bytes(data[record_offset:record_offset + size])
+        for tag, value_type, value_offset, _ in bam_io.iter_aux(record):
+            if tag == 'MQ' and value_type in bam_io.AUX_TYPE_FORMATS:
+                value_format = bam_io.AUX_TYPE_FORMATS[value_type]
+                if struct.unpack_from(value_format, record, value_offset)[0] == 255:
+                    struct.pack_into(value_format, data, record_offset + value_offset,
+                            new_mapping_quality)
+                    changed[i] = True
+                break
+
+    return int(changed.sum())
+
+def fix_255_mapping_quality(input_fp='/dev/stdin', output_fp='/dev/stdout', threads=1,
+        compression_level=6, new_mapping_quality=60):
+    """Rewrites mapping qualities of 255 (STAR's unique mapping quality) to
+    new_mapping_quality.
+
+    Both the MAPQ field and integer MQ (mate mapping quality) aux tags are patched in
+    place on batches of binary records, see fix_255_batch. Nothing else in the records
+    is touched.
+
+    Returns
+        n_changed - number of records that were modified
+    """
+    n_changed = 0
+    with bam_io.BgzfReader(input_fp, threads=threads) as reader, \
+            bam_io.BgzfWriter(output_fp, compression_level=compression_level,
+                    threads=threads) as writer:
+        header_text, references = bam_io.read_header(reader)
+        bam_io.write_header(writer, header_text, references)
+
+        leftover = b''
+        while True:
+            chunk = reader.read(bam_filter.BATCH_SIZE)
+            if not chunk:
+                break
+            data = bytearray(leftover + chunk)
+            offsets, end = bam_filter.find_records(data)
+            if offsets:
+                n_changed += fix_255_batch(data, offsets, end,
+                        new_mapping_quality=new_mapping_quality)
+                writer.write(memoryview(data)[:end])
+            leftover = bytes(data[end:])
+        if leftover:
+            raise ValueError('bam ends with a truncated record')
+
+    return n_changed
+
+# size of the value of every fixed size aux type, 0 for the others
+AUX_SIZES = np.zeros(256, dtype=np.int64)
+for value_type, size in bam_io.AUX_TYPE_SIZES.items():
+    AUX_SIZES[ord(value_type)] = size
+
+# fields giving the length of the parts of a record before its aux fields
+SIZE_FIELDS = {
+    'l_read_name': (12, 'u1'),
+    'n_cigar_op': (16, '<u2'),
+    'l_seq': (20, '<i4'),
+    }
+
+# AddOrReplaceReadGroups values the workflows have always used
+DEFAULT_READ_GROUP = {'ID': 'id', 'LB': 'library', 'PL': 'platform', 'PU': 'machine',
+        'SM': 'sample'}
+
+def get_header_read_group(header_text):
+    """Returns the fields of the first @RG line of the header as a dict"""
+    for line in header_text.split('\n'):
+        if line.startswith('@RG\t'):
+            return dict(field.split(':', 1) for field in line.split('\t')[1:] if ':' in field)
+    return {}
+
+def get_read_group(header_text, read_group=None, from_header=False):
+    """Returns the read group to stamp on a bam.
+
+    Starts from DEFAULT_READ_GROUP, then the first @RG of the input header if
+    from_header is True, then any fields given in read_group.
+    """
+    fields = dict(DEFAULT_READ_GROUP)
+    if from_header:
+        fields.update(get_header_read_group(header_text))
+    fields.update({key: value for key, value in (read_group or {}).items()
+            if value is not None})
+    return fields
+
+def replace_header_read_groups(header_text, read_group):
+    """Replaces every @RG line with a single line for read_group, placed where picard
+    puts it (after @HD and @SQ lines)"""
+    lines = [line for line in header_text.rstrip('\n\x00').split('\n')
+            if line and not line.startswith('@RG\t')]
+    rg_line = '\t'.join(['@RG', f'ID:{read_group["ID"]}'] +
+            [f'{key}:{value}' for key, value in sorted(read_group.items()) if key != 'ID'])
+    i = 0
+    while i < len(lines) and lines[i].startswith(('@HD', '@SQ')):
+        i += 1
+    lines.insert(i, rg_line)
+
+    return '\n'.join(lines) + '\n'
+
+def get_aux_offsets(data, offsets):
+    """Returns the offsets in data of the first aux field of the records starting
+    (block_size field included) at offsets"""
+    fields = bam_filter.get_fields(data, offsets, SIZE_FIELDS)
+    l_seq = fields['l_seq'].astype(np.int64)
+    return offsets + 4 + bam_io.RECORD_FIXED_SIZE + fields['l_read_name'] + \
+            4 * fields['n_cigar_op'].astype(np.int64) + (l_seq + 1) // 2 + l_seq
+
+def get_int32(view, positions):
+    """Returns the little endian int32s at positions of a numpy array of bytes"""
+    columns = view[positions[:, None] + np.arange(4)]
+    return np.ascontiguousarray(columns).view('<i4').ravel().astype(np.int64)
+
+def find_tags(view, starts, ends, tag):
+    """Returns (offsets, sizes) of aux field tag in the records whose aux fields are
+    view[starts:ends], walking the aux fields of all of them at once. offset is -1 and
+    size 0 for records without it"""
+    tag = np.frombuffer(tag.encode('ascii'), dtype=np.uint8)
+    nuls = np.flatnonzero(view == 0)
+    found = np.full(len(starts), -1, dtype=np.int64)
+    found_sizes = np.zeros(len(starts), dtype=np.int64)
+    positions = starts.copy()
+    active = positions < ends
+    while active.any():
+        indexes = np.flatnonzero(active)
+        position = positions[indexes]
+        value_type = view[position + 2]
+        size = AUX_SIZES[value_type]
+        is_string = (value_type == ord('Z')) | (value_type == ord('H'))
+        values = position[is_string] + 3
+        size[is_string] = nuls[np.searchsorted(nuls, values)] - values + 1
+        is_array = value_type == ord('B')
+        size[is_array] = 5 + AUX_SIZES[view[position[is_array] + 3]] * \
+                get_int32(view, position[is_array] + 4)
+        if not size.all():
+            raise ValueError('unknown aux type')
+        is_tag = (view[position] == tag[0]) & (view[position + 1] == tag[1])
+        found[indexes[is_tag]] = position[is_tag]
+        found_sizes[indexes[is_tag]] = size[is_tag] + 3
+        positions[indexes] = position + 3 + size
+        active[indexes[is_tag]] = False
+        active &= positions < ends
+
+    return found, found_sizes
+
+def read_group_batch(data, offsets, end, tag):
+    """Returns the records starting (block_size field included) at offsets in data[:end]
+    with any RG tag removed and tag appended, as a numpy array of bytes.
+
+    Records are copied, their aux fields walked and their sizes updated for the whole
+    batch at once, see find_tags.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    sizes = np.diff(np.append(offsets, end)) - 4
+    aux_offsets = get_aux_offsets(data, offsets)
+    view = np.frombuffer(data, dtype=np.uint8, count=end)
+
+    # drop existing RG tags
+    found, removed = find_tags(view, aux_offsets, offsets + 4 + sizes, 'RG')
+    has_tag = found != -1
+    if has_tag.any():
+        edges = np.zeros(end + 1, dtype=np.int8)
+        edges[found[has_tag]] = 1
+        edges[found[has_tag] + removed[has_tag]] -= 1
+        view = view[np.cumsum(edges[:end], dtype=np.int8) == 0]
+
+    # append the tag to every record
+    tag = np.frombuffer(tag, dtype=np.uint8)
+    sizes += len(tag) - removed
+    output_offsets = offsets - np.cumsum(removed) + removed + \
+            np.arange(len(offsets)) * len(tag)
+    is_tag = np.zeros(len(view) + len(offsets) * len(tag), dtype=bool)
+    is_tag[(output_offsets + 4 + sizes - len(tag))[:, None] + np.arange(len(tag))] = True
+    output = np.empty(len(is_tag), dtype=np.uint8)
+    output[~is_tag] = view
+    output[is_tag] = np.tile(tag, len(offsets))
+    output[output_offsets[:, None] + np.arange(4)] = \
+            sizes.astype('<i4').view(np.uint8).reshape(-1, 4)
+
+    return output
+
+def add_read_group(input_fp='/dev/stdin', output_fp='/dev/stdout', read_group=None,
+        from_header=False, threads=1, compression_level=6):
+    """Native replacement for picard AddOrReplaceReadGroups.
+
+    Replaces the @RG header lines with one for the read group (see get_read_group) and
+    sets RG:Z:<ID> on every record, removing any RG tag the record already had.
+    Records are rewritten a batch at a time, see read_group_batch. Nothing else in the
+    records is decoded and record order is kept.
+
+    Returns
+        read_group - the read group fields that were used
+    """
+    with bam_io.BgzfReader(input_fp, threads=threads) as reader, \
+            bam_io.BgzfWriter(output_fp, compression_level=compression_level,
+                    threads=threads) as writer:
+        header_text, references = bam_io.read_header(reader)
+        read_group = get_read_group(header_text, read_group=read_group,
+                from_header=from_header)
+        bam_io.write_header(writer, replace_header_read_groups(header_text, read_group),
+                references)
+
+        tag = b'RGZ' + read_group['ID'].encode('utf-8') + b'\x00'
+        leftover = b''
+        while True:
+            chunk = reader.read(bam_filter.BATCH_SIZE)
+            if not chunk:
+                break
+            data = leftover + chunk
+            offsets, end = bam_filter.find_records(data)
+            if offsets:
+                writer.write(memoryview(read_group_batch(data, offsets, end, tag)))
+            leftover = data[end:]
+        if leftover:
+            raise ValueError('bam ends with a truncated record')
+
+    return read_group
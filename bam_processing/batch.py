@@ -0,0 +1,259 @@
+"""Runs many samples at once within a global cpu and memory budget."""
+import concurrent.futures
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+import uuid
+
+import bam_processing as bp
+import instrumentation
+import reference_cache
+import scratch
+
+MANIFEST_COLUMNS = ('sample', 'input', 'output', 'workflow_type')
+# optional manifest columns holding read group fields
+READ_GROUP_COLUMNS = {'rg_id': 'ID', 'rg_sm': 'SM', 'rg_lb': 'LB', 'rg_pl': 'PL',
+        'rg_pu': 'PU'}
+# resident memory a jvm uses on top of its -Xmx heap (metaspace, code cache, gc)
+JVM_OVERHEAD = '512M'
+
+def read_manifest(manifest_fp):
+    """Reads a tab separated manifest with a header line and at least the columns
+    sample, input, output and workflow_type. Optional known_sites and rg_id, rg_sm,
+    rg_lb, rg_pl and rg_pu columns are used by run_sample.
+
+    Returns
+        samples - list of dicts, one per manifest row
+    """
+    samples = []
+    with open(manifest_fp) as f:
+        columns = f.readline().rstrip('\n').split('\t')
+        missing = [c for c in MANIFEST_COLUMNS if c not in columns]
+        if missing:
+            raise ValueError(f'manifest is missing columns: {", ".join(missing)}')
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            samples.append(dict(zip(columns, line.rstrip('\n').split('\t'))))
+
+    names = [sample['sample'] for sample in samples]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f'duplicate samples in manifest: {", ".join(duplicates)}')
+
+    return samples
+
+def get_total_memory():
+    """Returns physical memory of the machine in bytes"""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def get_sample_resources(threads=1, max_mem='1g', sort_memory='10G', workers=1):
+    """Estimates the peak cpus and memory (bytes) a single sample needs.
+
+    Workflow steps run one after the other, so the peak is whichever is bigger of the
+    samtools sorts (sort_memory is shared when two run at once) and the sharded
+    gatk/picard steps, which run one jvm per worker.
+    """
+    jvm_memory = bp.parse_memory(max_mem) + bp.parse_memory(JVM_OVERHEAD)
+    sort_phase = bp.parse_memory(sort_memory)
+    gatk_phase = workers * jvm_memory
+
+    return max(threads, workers), max(sort_phase, gatk_phase)
+
+class ResourceScheduler(object):
+    """Hands out cpus and memory from a fixed budget.
+
+    A request bigger than the whole budget is granted once nothing else is running.
+    """
+    def __init__(self, cpus, memory):
+        self.cpus = cpus
+        self.memory = memory
+        self.used_cpus = 0
+        self.used_memory = 0
+        self.condition = threading.Condition()
+
+    def fits(self, cpus, memory):
+        if self.used_cpus == 0 and self.used_memory == 0:
+            return True
+        return self.used_cpus + cpus <= self.cpus and self.used_memory + memory <= self.memory
+
+    def acquire(self, cpus, memory):
+        """Blocks until cpus and memory are available and reserves them"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.fits(cpus, memory))
+            self.used_cpus += cpus
+            self.used_memory += memory
+
+    def release(self, cpus, memory):
+        with self.condition:
+            self.used_cpus -= cpus
+            self.used_memory -= memory
+            self.condition.notify_all()
+
+def get_status_fp(status_dir, sample):
+    return os.path.join(status_dir, f'{sample}.status.json')
+
+def read_status(status_dir, sample):
+    """Returns the status dict written for sample, or None if there isn't one"""
+    status_fp = get_status_fp(status_dir, sample)
+    if not os.path.isfile(status_fp):
+        return None
+    with open(status_fp) as f:
+        return json.load(f)
+
+def write_status(status_dir, sample, status):
+    """Atomically replaces the status file for sample"""
+    status_fp = get_status_fp(status_dir, sample)
+    temp_fp = f'{status_fp}.{str(uuid.uuid4())}.tmp'
+    with open(temp_fp, 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(temp_fp, status_fp)
+
+def is_done(status_dir, sample):
+    """Returns True if a previous batch finished sample and its output is still there"""
+    status = read_status(status_dir, sample['sample'])
+    return status is not None and status['state'] == 'done' and \
+            os.path.isfile(sample['output'])
+
+def prepare_reference(reference_fp, known_sites_fp=None, reference_cache_dir=None):
+    """Indexes the reference (and known sites) once up front so concurrent samples
+    don't race to create the same files.
+
+    Returns
+        (reference_fp, known_sites_fp) - the cached copies if there is a reference
+            cache, see reference_cache.prepare
+    """
+    if reference_cache.get_cache_dir(reference_cache_dir) is not None:
+        return reference_cache.prepare(reference_cache_dir, reference_fp=reference_fp,
+                known_sites_fp=known_sites_fp)
+
+    bp.index_reference(reference_fp)
+    bp.create_reference_sequence_dict(reference_fp)
+    if known_sites_fp is not None:
+        bp.index_vcf(known_sites_fp)
+
+    return reference_fp, known_sites_fp
+
+def run_sample(sample, reference_fp, known_sites_fp=None, temp_files_dir=os.getcwd(),
+        fixmates=False, properly_paired_only=False, fix_255_mapping_quality=False,
+        streaming=False, max_mem='1g', threads=1, sort_memory='10G', workers=1, cache=None,
+        read_filter='properly_paired', read_group=None, read_group_from_header=False,
+        reference_cache_dir=None, max_records_in_ram=100000, duplicate_marker='picard',
+        duplicate_metrics=False, splitter='gatk'):
+    """Runs the workflow given in the manifest row for a single sample.
+
+    The read group sample (SM) defaults to the sample name. Fields from the manifest's
+    rg_* columns win over read_group, which wins over the input header when
+    read_group_from_header is given. If duplicate_metrics is True duplication metrics
+    are written to <output>.duplicate_metrics.txt. splitter is only used by the cptac
+    workflows.
+    """
+    workflow_type = sample['workflow_type']
+    # a known_sites column is only seen here, so prepare it with the sample
+    _, sample_known_sites_fp = reference_cache.prepare(reference_cache_dir,
+            known_sites_fp=sample.get('known_sites') or None)
+    sample_read_group = {key: value for key, value in (read_group or {}).items()
+            if value is not None}
+    sample_read_group.update({field: sample[column] for column, field in READ_GROUP_COLUMNS.items()
+            if sample.get(column)})
+    # the sample name only stands in for the header's SM if it isn't being read
+    if not read_group_from_header:
+        sample_read_group.setdefault('SM', sample['sample'])
+    kwargs = {'temp_files_dir': temp_files_dir, 'max_mem': max_mem, 'threads': threads,
+            'sort_memory': sort_memory, 'workers': workers, 'cache': cache,
+            'read_group': sample_read_group, 'read_group_from_header': read_group_from_header,
+            'max_records_in_ram': max_records_in_ram, 'duplicate_marker': duplicate_marker,
+            'duplicate_metrics_fp': f'{sample["output"]}.duplicate_metrics.txt'
+                    if duplicate_metrics else None}
+    if workflow_type == 'standard':
+        bp.run_basic_preprocessing(sample['input'], sample['output'], reference_fp,
+                sample_known_sites_fp or known_sites_fp, fixmates=fixmates,
+                properly_paired_only=properly_paired_only,
+                fix_255_mapping_quality=fix_255_mapping_quality, streaming=streaming,
+                read_filter=read_filter, **kwargs)
+    elif workflow_type == 'cptac3':
+        bp.run_cptac3_preprocessing(sample['input'], sample['output'], reference_fp,
+                splitter=splitter, **kwargs)
+    elif workflow_type == 'cptac2':
+        bp.run_cptac2_preprocessing(sample['input'], sample['output'], reference_fp,
+                splitter=splitter, **kwargs)
+    else:
+        raise ValueError(f'unknown workflow type {workflow_type} for sample {sample["sample"]}')
+
+def run_batch(samples, reference_fp, status_dir, cpus, memory, known_sites_fp=None,
+        temp_files_dir=os.getcwd(), threads=1, max_mem='1g', sort_memory='10G', workers=1,
+        streaming=False, reference_cache_dir=None, **kwargs):
+    """Runs every sample in the manifest as cpus and memory become available.
+
+    Each sample gets its own scratch session and temp directory, and writes a status file
+    (status_dir/<sample>.status.json) as it starts, finishes or fails. Samples a
+    previous batch already finished are skipped. A failed sample doesn't stop the
+    others.
+
+    Extra keyword arguments are passed through to run_sample.
+
+    Returns
+        states - dict of sample -> 'done', 'skipped' or 'failed'
+    """
+    os.makedirs(status_dir, exist_ok=True)
+    reference_fp, known_sites_fp = prepare_reference(reference_fp,
+            known_sites_fp=known_sites_fp, reference_cache_dir=reference_cache_dir)
+
+    sample_cpus, sample_memory = get_sample_resources(threads=threads, max_mem=max_mem,
+            sort_memory=sort_memory, workers=workers)
+    if sample_cpus > cpus or sample_memory > memory:
+        logging.warning(f'a sample needs {sample_cpus} cpus and {sample_memory} bytes, '
+                'more than the batch budget. Samples will run one at a time.')
+    scheduler = ResourceScheduler(cpus, memory)
+
+    def process(sample):
+        name = sample['sample']
+        status = {'sample': name, 'input': sample['input'], 'output': sample['output'],
+                'workflow_type': sample['workflow_type'], 'state': 'running',
+                'started': time.time()}
+        # the sample's session holds its temp directory too, so it goes if the batch
+        # is killed
+        with scratch.session():
+            sample_temp_dir = scratch.temp_path(temp_files_dir, name)
+            try:
+                write_status(status_dir, name, status)
+                logging.info(f'starting sample {name}')
+                os.makedirs(sample_temp_dir)
+                with instrumentation.report(name=name) as run_report:
+                    run_sample(sample, reference_fp, known_sites_fp=known_sites_fp,
+                            temp_files_dir=sample_temp_dir, threads=threads,
+                            max_mem=max_mem, sort_memory=sort_memory, workers=workers,
+                            streaming=streaming, reference_cache_dir=reference_cache_dir,
+                            **kwargs)
+                status.update({'state': 'done', 'steps': run_report.summarize()})
+            except Exception:
+                logging.error(f'sample {name} failed')
+                status.update({'state': 'failed', 'error': traceback.format_exc()})
+            finally:
+                status['finished'] = time.time()
+                write_status(status_dir, name, status)
+                scheduler.release(sample_cpus, sample_memory)
+                scratch.consumed(sample_temp_dir)
+        return status['state']
+
+    states = {}
+    futures = {}
+    with scratch.cleanup_on_signal(), concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, len(samples))) as executor:
+        for sample in samples:
+            if is_done(status_dir, sample):
+                logging.info(f'skipping finished sample {sample["sample"]}')
+                states[sample['sample']] = 'skipped'
+                continue
+            # blocks until the sample fits, so samples start in manifest order
+            scheduler.acquire(sample_cpus, sample_memory)
+            futures[sample['sample']] = executor.submit(contextvars.copy_context().run,
+                    process, sample)
+        for name, future in futures.items():
+            states[name] = future.result()
+
+    return states
@@ -0,0 +1,192 @@
+"""Times every run_* step and full workflow on synthetic bams.
+
+Each benchmark runs on the same synthetic dataset (see synthetic_bam) and reports wall
+time, cpu time, records/sec and peak memory, where peak memory is the biggest of any
+subprocess and of this process. Results are json so runs can be compared against a
+saved baseline with compare.
+"""
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import time
+import traceback
+
+import bam_filter
+import bam_processing as bp
+import instrumentation
+import step_cache
+
+TOOLS = ('samtools', 'picard', 'gatk')
+
+def get_benchmarks(dataset, temp_files_dir, threads=1, max_mem='1g', sort_memory='1G',
+        workers=1):
+    """Returns dict of benchmark name -> function(output_fp)"""
+    coordinate_bam = dataset['coordinate_bam']
+    queryname_bam = dataset['queryname_bam']
+    reference = dataset['reference']
+    known_sites = dataset['known_sites']
+    common = {'temp_files_dir': temp_files_dir, 'threads': threads, 'sort_memory': sort_memory}
+    workflow = dict(common, max_mem=max_mem, workers=workers)
+
+    return {
+        'add_or_replace_read_groups': lambda output_fp: bp.run_add_or_replace_read_groups(
+                coordinate_bam, output_fp, **common),
+        'fixmates': lambda output_fp: bp.run_fixmates(queryname_bam, output_fp, **common),
+        'fixmates_and_filter': lambda output_fp: bp.run_fixmates_and_filter(queryname_bam,
+                output_fp, **common),
+        'properly_paired': lambda output_fp: bp.run_properly_paired(coordinate_bam,
+                output_fp, **common),
+        'read_filter': lambda output_fp: bam_filter.filter_records(coordinate_bam, output_fp,
+                threads=threads),
+        'fix_255_mapping_quality': lambda output_fp: bp.run_fix_255_mapping_quality(
+                coordinate_bam, output_fp, threads=threads),
+        'streaming_read_groups': lambda output_fp: bp.run_streaming_read_groups(queryname_bam,
+                output_fp, fixmate=True, properly_paired_only=True,
+                fix_255_mapping_quality=True, **common),
+        'mark_duplicates': lambda output_fp: bp.run_mark_duplicates(coordinate_bam, output_fp,
+                max_mem=max_mem, **common),
+        'native_mark_duplicates': lambda output_fp: bp.run_mark_duplicates(coordinate_bam,
+                output_fp, duplicate_marker='native', **common),
+        'split_n_cigar_reads': lambda output_fp: bp.run_split_n_cigar_reads(coordinate_bam,
+                output_fp, reference, max_mem=max_mem, workers=workers, **common),
+        'native_split_n_cigar_reads': lambda output_fp: bp.run_split_n_cigar_reads(
+                coordinate_bam, output_fp, reference, splitter='native', **common),
+        'base_recalibration': lambda output_fp: bp.run_base_recalibration(coordinate_bam,
+                output_fp, reference, known_sites, max_mem=max_mem, workers=workers, **common),
+        'standard': lambda output_fp: bp.run_basic_preprocessing(coordinate_bam, output_fp,
+                reference, known_sites, fixmates=True, properly_paired_only=True,
+                fix_255_mapping_quality=True, **workflow),
+        'cptac2': lambda output_fp: bp.run_cptac2_preprocessing(coordinate_bam, output_fp,
+                reference, **workflow),
+        'cptac3': lambda output_fp: bp.run_cptac3_preprocessing(coordinate_bam, output_fp,
+                reference, **workflow),
+        }
+
+def reset_peak_memory():
+    """Resets the peak rss (VmHWM) of this process, linux only"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def get_peak_memory():
+    """Returns peak rss (VmHWM) of this process in bytes, or 0 if unknown"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def get_cpu_time():
+    """Returns cpu time used by this process and its finished subprocesses"""
+    return sum(usage.ru_utime + usage.ru_stime for usage in (
+            resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+def run_benchmark(name, function, n_records, output_dir):
+    """Runs function(output_fp) once in a clean output directory.
+
+    Returns
+        dict of wall_time, cpu_time, max_rss_bytes and records_per_second
+    """
+    run_dir = os.path.join(output_dir, name)
+    os.makedirs(run_dir, exist_ok=True)
+    reset_peak_memory()
+    started, cpu_started = time.time(), get_cpu_time()
+    try:
+        with instrumentation.report(name=name) as run_report:
+            function(os.path.join(run_dir, 'output.bam'))
+        wall_time = time.time() - started
+        cpu_time = get_cpu_time() - cpu_started
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    return {
+        'wall_time': wall_time,
+        'cpu_time': cpu_time,
+        'max_rss_bytes': max([get_peak_memory()] + [record['max_rss_bytes']
+                for record in run_report.records if record['type'] != 'step']),
+        'records_per_second': n_records / wall_time if wall_time else None,
+        }
+
+def run_benchmarks(dataset, output_dir, names=None, repeats=1, **kwargs):
+    """Runs the named benchmarks (all of them by default) repeats times each.
+
+    The fastest run of each benchmark is reported. A benchmark that fails, i.e. because
+    a tool isn't installed, is reported with its error and doesn't stop the others.
+    Extra keyword arguments are passed to get_benchmarks.
+
+    Returns
+        dict of benchmark name -> result
+    """
+    benchmarks = get_benchmarks(dataset, output_dir, **kwargs)
+    unknown = sorted(set(names or []) - set(benchmarks))
+    if unknown:
+        raise ValueError(f'unknown benchmarks: {", ".join(unknown)}, must be some of '
+                f'{", ".join(benchmarks)}')
+
+    results = {}
+    for name in names or benchmarks:
+        logging.info(f'running benchmark {name}')
+        try:
+            runs = [run_benchmark(name, benchmarks[name], dataset['n_reads'], output_dir)
+                    for _ in range(repeats)]
+        except Exception:
+            logging.error(f'benchmark {name} failed')
+            results[name] = {'error': traceback.format_exc()}
+            continue
+        result = dict(min(runs, key=lambda run: run['wall_time']))
+        result['runs'] = runs
+        results[name] = result
+
+    return results
+
+def get_environment():
+    """Returns dict describing the machine and tool versions results were measured with"""
+    return {
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'tools': {tool: step_cache.get_tool_version(tool) for tool in TOOLS},
+        }
+
+def write_results(output_fp, results, dataset_params, options):
+    with open(output_fp, 'w') as f:
+        json.dump({
+            'created': time.time(),
+            'environment': get_environment(),
+            'dataset': dataset_params,
+            'options': options,
+            'benchmarks': results,
+            }, f, indent=2)
+
+def read_results(results_fp):
+    with open(results_fp) as f:
+        return json.load(f)
+
+def compare(results, baseline, tolerance=0.1):
+    """Compares records/sec of benchmarks that succeeded in both results and baseline.
+
+    Returns
+        list of (name, baseline_records_per_second, records_per_second, ratio,
+            regressed) where regressed is True if throughput dropped by more than
+            tolerance
+    """
+    rows = []
+    for name, result in results['benchmarks'].items():
+        previous = baseline['benchmarks'].get(name)
+        if previous is None or 'error' in result or 'error' in previous:
+            continue
+        ratio = result['records_per_second'] / previous['records_per_second']
+        rows.append((name, previous['records_per_second'], result['records_per_second'],
+                ratio, ratio < 1 - tolerance))
+
+    return rows
@@ -0,0 +1,101 @@
+import argparse
+import os
+import sys
+
+import benchmark
+import synthetic_bam
+
+parser = argparse.ArgumentParser(description='benchmark workflow steps on synthetic bams')
+
+parser.add_argument('--output', type=str,
+        default='benchmark.json', help='json file to write results to')
+parser.add_argument('--baseline', type=str,
+        help='results json of a previous run to compare records/sec against')
+parser.add_argument('--tolerance', type=float,
+        default=0.1, help='fraction records/sec can drop below the baseline before a \
+benchmark counts as a regression')
+parser.add_argument('--fail-on-regression', action='store_true',
+        help='exit with an error if any benchmark regressed against the baseline')
+parser.add_argument('--benchmarks', type=str,
+        help='comma separated benchmarks to run, i.e. mark_duplicates,standard. Defaults \
+to every step and the standard, cptac2 and cptac3 workflows.')
+parser.add_argument('--repeats', type=int,
+        default=1, help='times to run each benchmark, the fastest run is reported')
+parser.add_argument('--work-dir', type=str,
+        default=os.path.join(os.getcwd(), 'benchmark_data'), help='directory for the \
+synthetic dataset and benchmark outputs')
+
+parser.add_argument('--reads', type=int,
+        default=100000, help='number of records in the synthetic bams')
+parser.add_argument('--read-length', type=int,
+        default=100, help='read length')
+parser.add_argument('--paired-fraction', type=float,
+        default=0.9, help='fraction of templates that are properly paired')
+parser.add_argument('--duplicate-rate', type=float,
+        default=0.1, help='fraction of templates that duplicate an earlier one')
+parser.add_argument('--spliced-fraction', type=float,
+        default=0.0, help='fraction of reads with an N cigar operation')
+parser.add_argument('--mapq-255-fraction', type=float,
+        default=0.0, help='fraction of templates with a mapping quality of 255')
+parser.add_argument('--reference-fasta', type=str,
+        help='reference to sample reads from, i.e. tests/data/test.fa. Defaults to a \
+random reference.')
+parser.add_argument('--contigs', type=int,
+        default=1, help='number of contigs of the random reference')
+parser.add_argument('--contig-length', type=int,
+        default=200000, help='length of each contig of the random reference')
+parser.add_argument('--seed', type=int,
+        default=0, help='random seed')
+
+parser.add_argument('--max-memory', type=str,
+        default='1g', help='max heap size for java to allocate')
+parser.add_argument('--threads', type=int,
+        default=1, help='number of threads samtools steps can use')
+parser.add_argument('--sort-memory', type=str,
+        default='1G', help='total memory for samtools sort, split between threads')
+parser.add_argument('--workers', type=int,
+        default=1, help='number of genomic shards to run gatk steps on at once')
+
+args = parser.parse_args()
+
+def main():
+    dataset_params = {
+        'n_reads': args.reads,
+        'read_length': args.read_length,
+        'paired_fraction': args.paired_fraction,
+        'duplicate_rate': args.duplicate_rate,
+        'spliced_fraction': args.spliced_fraction,
+        'mapq_255_fraction': args.mapq_255_fraction,
+        'reference_fp': args.reference_fasta,
+        'n_contigs': args.contigs,
+        'contig_length': args.contig_length,
+        'seed': args.seed,
+        }
+    options = {'threads': args.threads, 'max_mem': args.max_memory,
+            'sort_memory': args.sort_memory, 'workers': args.workers}
+
+    dataset = synthetic_bam.create_dataset(os.path.join(args.work_dir, 'data'),
+            threads=args.threads, **dataset_params)
+    names = args.benchmarks.split(',') if args.benchmarks else None
+    results = benchmark.run_benchmarks(dataset, os.path.join(args.work_dir, 'runs'),
+            names=names, repeats=args.repeats, **options)
+    benchmark.write_results(args.output, results, dataset_params, options)
+
+    for name, result in results.items():
+        if 'error' in result:
+            print(f'{name}\tfailed')
+        else:
+            print(f'{name}\t{result["wall_time"]:.2f}s\t{result["records_per_second"]:.0f} '
+                    f'records/s\t{result["max_rss_bytes"] // 1024 ** 2}M peak')
+
+    if args.baseline is not None:
+        rows = benchmark.compare(benchmark.read_results(args.output),
+                benchmark.read_results(args.baseline), tolerance=args.tolerance)
+        for name, previous, current, ratio, regressed in rows:
+            print(f'{name}\t{previous:.0f} -> {current:.0f} records/s\t{ratio:.2f}x'
+                    + ('\tREGRESSION' if regressed else ''))
+        if args.fail_on_regression and any(row[-1] for row in rows):
+            sys.exit('benchmarks regressed against the baseline')
+
+if __name__ == '__main__':
+    main()
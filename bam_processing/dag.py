@@ -0,0 +1,105 @@
+"""Runs a workflow as a graph of steps on an asyncio event loop, starting every step as
+soon as the steps it comes after have finished, so independent steps overlap.
+
+A step is either tool_args, run with instrumentation.execute, or a python callable, both
+in a thread. When a step fails the steps running next to it are cancelled: their
+subprocesses, including those started by python steps, are terminated, and no step
+that hasn't started is started.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+
+import instrumentation
+
+class Step(object):
+    """A named step of a workflow that runs once every step named in after is done"""
+    def __init__(self, name, run, after=()):
+        self.name = name
+        self.run = run
+        self.after = tuple(after)
+
+    def __repr__(self):
+        return f'Step({self.name!r}, after={self.after!r})'
+
+async def run_callable(run):
+    """Runs a python step in a thread. Subprocesses it launches are terminated if the
+    step is cancelled, which is as close to stopping a thread as python gets"""
+    process_group = instrumentation.ProcessGroup()
+    instrumentation.PROCESS_GROUP.set(process_group)
+    # the thread gets a copy of this task's context, so it reports to the same run
+    future = asyncio.get_running_loop().run_in_executor(None,
+            contextvars.copy_context().run, run)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        process_group.terminate()
+        # wait for the thread, it can't be interrupted but it can't start anything else
+        try:
+            await future
+        except Exception:
+            pass
+        raise
+
+async def run_command(tool_args):
+    """Runs tool_args through instrumentation.execute in a thread, so it is recorded with
+    its resource usage like any other command. Returns the tail of its stdout"""
+    logging.info(f'executing command: {tool_args}')
+    return await run_callable(functools.partial(instrumentation.execute, tool_args))
+
+async def run_step(step):
+    if callable(step.run):
+        return await run_callable(step.run)
+    with instrumentation.step(step.name):
+        return await run_command(step.run)
+
+def check_steps(steps):
+    names = [step.name for step in steps]
+    if len(set(names)) != len(names):
+        raise ValueError(f'step names must be unique, got {names}')
+    for step in steps:
+        missing = [name for name in step.after if name not in names]
+        if missing:
+            raise ValueError(f'step {step.name} comes after unknown steps {missing}')
+
+async def run_steps(steps):
+    check_steps(steps)
+    pending = {step.name: step for step in steps}
+    running = {}
+    results = {}
+    while pending or running:
+        for name, step in list(pending.items()):
+            if all(after in results for after in step.after):
+                logging.info(f'starting step {name}')
+                running[asyncio.ensure_future(run_step(step))] = name
+                del pending[name]
+        if not running:
+            raise ValueError(f'steps {sorted(pending)} depend on each other in a cycle')
+
+        finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        failed = None
+        for task in finished:
+            name = running.pop(task)
+            if task.exception() is not None:
+                failed = failed or (name, task.exception())
+            else:
+                results[name] = task.result()
+        if failed is not None:
+            name, exception = failed
+            logging.error(f'step {name} failed, cancelling {sorted(running.values())}')
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            raise exception
+
+    return results
+
+def run_dag(steps):
+    """Runs steps, each as soon as the steps it comes after are done.
+
+    Returns
+        results - dict of step name -> the return value of its callable, or stdout of
+            its command (its last instrumentation.OUTPUT_TAIL_LINES lines)
+    """
+    return asyncio.run(run_steps(list(steps)))
@@ -0,0 +1,244 @@
+"""Random access to the reference fasta and the known sites vcf from python, for the
+native stages and the sharding logic.
+
+MappedFasta reads bases through a memory map of the fasta, found with its .fai, so
+processes reading the same reference share its pages in the page cache instead of each
+holding a copy. KnownSites loads the variants of one contig at a time into sorted NumPy
+arrays, reading only that contig's blocks when the vcf has a .tbi, so overlap queries
+are a binary search.
+
+Both open their files on first use and leave what they loaded behind when pickled, so
+they can be handed to worker processes as they are.
+"""
+import gzip
+import mmap
+import os
+
+import numpy as np
+
+import bam_io
+
+# bytes of a vcf decompressed at a time while loading known sites
+READ_SIZE = 1 << 20
+
+def read_fasta_index(fasta_fp):
+    """Returns dict of contig -> (length, offset, line_bases, line_width) from the .fai
+    next to fasta_fp, or from scanning the fasta if there is none"""
+    index = {}
+    if os.path.isfile(fasta_fp + '.fai'):
+        with open(fasta_fp + '.fai') as f:
+            for line in f:
+                name, length, offset, line_bases, line_width = line.split('\t')[:5]
+                index[name] = (int(length), int(offset), int(line_bases), int(line_width))
+        return index
+
+    with open(fasta_fp, 'rb') as f:
+        name, offset = None, 0
+        for line in f:
+            offset += len(line)
+            if line.startswith(b'>'):
+                name = line[1:].split()[0].decode('utf-8')
+                index[name] = [0, offset, 0, 0]
+            elif name is not None and line.strip():
+                entry = index[name]
+                if entry[2] == 0:
+                    entry[2], entry[3] = len(line.rstrip(b'\r\n')), len(line)
+                entry[0] += len(line.rstrip(b'\r\n'))
+    return {name: tuple(entry) for name, entry in index.items()}
+
+class MappedFasta(object):
+    """Random access to the bases of a fasta through a memory map, found with its .fai.
+    The map is opened on first use, so instances can be sent to other processes."""
+    def __init__(self, fasta_fp):
+        self.fasta_fp = fasta_fp
+        self.index = read_fasta_index(fasta_fp)
+        self.data = None
+
+    def get_lengths(self):
+        """Returns list of (contig, length) in fasta order"""
+        return [(name, entry[0]) for name, entry in self.index.items()]
+
+    def get_data(self):
+        if self.data is None:
+            with open(self.fasta_fp, 'rb') as f:
+                self.data = np.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ),
+                        dtype=np.uint8)
+        return self.data
+
+    def view(self, name, start=0, end=None):
+        """Returns read only uint8 array of the bases of [start, end) of contig name,
+        cut to the contig, as they are in the fasta (so possibly lowercase).
+
+        The array is a view of the map when the interval is on one line of the fasta,
+        which is the whole contig for single line fastas, and a copy of just the
+        interval otherwise.
+        """
+        length, offset, line_bases, line_width = self.index[name]
+        start, end = max(0, start), length if end is None else min(end, length)
+        if end <= start:
+            return np.zeros(0, dtype=np.uint8)
+        data = self.get_data()
+        first_line, last_line = start // line_bases, (end - 1) // line_bases
+        first = offset + first_line * line_width + start % line_bases
+        if first_line == last_line:
+            return data[first:first + end - start]
+
+        # the lines in between are a strided view, the last one may be short
+        lines = np.lib.stride_tricks.as_strided(data[offset + first_line * line_width:],
+                shape=(last_line - first_line, line_bases), strides=(line_width, 1))
+        last = offset + last_line * line_width
+        return np.concatenate((lines.reshape(-1)[start % line_bases:],
+                data[last:last + (end - 1) % line_bases + 1]))
+
+    def fetch(self, name, start, end):
+        """Returns the uppercase bases of [start, end) of contig name, cut to the contig"""
+        return self.view(name, start, end).tobytes().upper()
+
+    def __getstate__(self):
+        return dict(self.__dict__, data=None)
+
+def open_vcf(vcf_fp):
+    return gzip.open(vcf_fp, 'rb') if vcf_fp.endswith('.gz') else open(vcf_fp, 'rb')
+
+def parse_sites(lines, name=None):
+    """Returns (contigs, starts, ends) of the vcf records in lines, the 0-based start
+    and exclusive end of each reference allele. Only records on contig name are kept if
+    it is given"""
+    contigs, starts, ends = [], [], []
+    for line in lines:
+        if line.startswith(b'#') or not line.strip():
+            continue
+        contig, position, _, ref = line.split(b'\t', 4)[:4]
+        if name is not None and contig != name:
+            continue
+        start = int(position) - 1
+        contigs.append(contig)
+        starts.append(start)
+        ends.append(start + len(ref))
+    return contigs, starts, ends
+
+def read_region(vcf_fp, start, end):
+    """Yields the lines of a bgzipped vcf between virtual offsets start and end"""
+    with bam_io.BgzfReader(vcf_fp) as reader:
+        reader.seek(start)
+        remainder = b''
+        while True:
+            data = reader.read_to(end, READ_SIZE)
+            if not data:
+                break
+            lines = (remainder + data).split(b'\n')
+            remainder = lines.pop()
+            yield from lines
+        if remainder:
+            yield remainder
+
+def to_arrays(starts, ends):
+    """Returns (starts, ends) sorted by start, with ends the running maximum of the
+    exclusive ends so overlaps can be found with a single search, see is_known"""
+    starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+    order = np.argsort(starts, kind='stable')
+    return starts[order], np.maximum.accumulate(ends[order])
+
+def load_known_sites(vcf_fps):
+    """Returns dict of contig -> (starts, ends) of every variant in the (optionally
+    gzipped) vcfs, see to_arrays"""
+    intervals = {}
+    for vcf_fp in vcf_fps:
+        with open_vcf(vcf_fp) as f:
+            contigs, starts, ends = parse_sites(f)
+        for contig, start, end in zip(contigs, starts, ends):
+            contig_starts, contig_ends = intervals.setdefault(contig.decode('utf-8'),
+                    ([], []))
+            contig_starts.append(start)
+            contig_ends.append(end)
+
+    return {contig: to_arrays(starts, ends) for contig, (starts, ends) in intervals.items()}
+
+def is_known(sites, positions):
+    """Returns boolean array of which 0-based reference positions overlap a known site"""
+    if sites is None:
+        return np.zeros(len(positions), dtype=bool)
+    starts, ends = sites
+    i = np.searchsorted(starts, positions, side='right') - 1
+    return (i >= 0) & (ends[np.maximum(i, 0)] > positions)
+
+def get_tabix_regions(index_fp):
+    """Returns dict of contig -> (start, end) virtual offsets of its records in the
+    bgzipped file indexed by the .tbi index_fp"""
+    names, references = bam_io.read_tbi(index_fp)
+    regions = {}
+    for name, reference in zip(names, references):
+        if reference['offsets'] is not None:
+            regions[name] = reference['offsets']
+            continue
+        chunks = [chunk for chunks in reference['bins'].values() for chunk in chunks]
+        if chunks:
+            regions[name] = (min(beg for beg, _ in chunks), max(end for _, end in chunks))
+    return regions
+
+class KnownSites(object):
+    """Known variant sites of the vcfs, one contig in memory at a time.
+
+    A contig of a bgzipped vcf with a .tbi is read from just the blocks the index
+    points at. Vcfs without one are read whole, once, the first time any contig is
+    asked for.
+    """
+    def __init__(self, vcf_fps):
+        self.vcf_fps = list(vcf_fps)
+        self.regions = {}
+        for vcf_fp in self.vcf_fps:
+            if os.path.isfile(vcf_fp + '.tbi'):
+                self.regions[vcf_fp] = get_tabix_regions(vcf_fp + '.tbi')
+        self.unindexed = None
+        self.name = None
+        self.sites = None
+
+    def get_unindexed(self):
+        if self.unindexed is None:
+            self.unindexed = load_known_sites([fp for fp in self.vcf_fps
+                    if fp not in self.regions])
+        return self.unindexed
+
+    def load(self, name):
+        starts, ends = [], []
+        for vcf_fp in self.vcf_fps:
+            if vcf_fp not in self.regions:
+                sites = self.get_unindexed().get(name)
+                if sites is not None:
+                    starts.append(sites[0])
+                    ends.append(sites[1])
+            elif name in self.regions[vcf_fp]:
+                _, contig_starts, contig_ends = parse_sites(
+                        read_region(vcf_fp, *self.regions[vcf_fp][name]),
+                        name=name.encode('utf-8'))
+                starts.append(contig_starts)
+                ends.append(contig_ends)
+        if not starts:
+            return None
+        return to_arrays(np.concatenate(starts), np.concatenate(ends))
+
+    def get(self, name):
+        """Returns (starts, ends) of the sites on contig name, see to_arrays, or None if
+        there are none"""
+        if name != self.name:
+            self.sites = self.load(name)
+            self.name = name
+        return self.sites
+
+    def is_known(self, name, positions):
+        """Returns boolean array of which 0-based positions of contig name overlap a
+        known site"""
+        return is_known(self.get(name), positions)
+
+    def overlaps(self, name, start, end):
+        """Returns whether any known site overlaps [start, end) of contig name"""
+        sites = self.get(name)
+        if sites is None or end <= start:
+            return False
+        starts, ends = sites
+        i = np.searchsorted(starts, end, side='left') - 1
+        return bool(i >= 0 and ends[i] > start)
+
+    def __getstate__(self):
+        # workers load the contigs they need themselves
+        return dict(self.__dict__, unindexed=None, name=None, sites=None)
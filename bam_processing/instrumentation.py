@@ -0,0 +1,362 @@
+"""Per-step timing, cpu, io and memory instrumentation for subprocesses and python stages.
+
+Records go to the RunReport active in the current context (see report()), so
+concurrent samples or shards each keep their own report. The stderr of every
+subprocess is streamed into the log and its progress followed, see progress.
+"""
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import re
+import resource
+import signal
+import subprocess
+import threading
+import time
+
+import jvm_executor
+import progress
+
+REPORT = contextvars.ContextVar('report', default=None)
+STEP = contextvars.ContextVar('step', default=None)
+PROCESS_GROUP = contextvars.ContextVar('process_group', default=None)
+
+# how often /proc/<pid>/io is sampled while a process runs
+IO_SAMPLE_INTERVAL = 0.1
+# lines of stdout kept by execute, the rest only goes to the log
+OUTPUT_TAIL_LINES = 1000
+
+class RunReport(object):
+    """Collects one record per subprocess, python stage and workflow step"""
+    def __init__(self, name=None):
+        self.name = name
+        self.started = time.time()
+        self.records = []
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def summarize(self):
+        """Returns wall/cpu time and peak rss totals per step"""
+        steps = {}
+        for record in self.records:
+            if record['type'] == 'step':
+                continue
+            summary = steps.setdefault(record['step'], {'wall_time': 0.0, 'cpu_time': 0.0,
+                    'max_rss_bytes': 0, 'read_bytes': 0, 'write_bytes': 0, 'commands': 0})
+            summary['wall_time'] += record['wall_time']
+            summary['cpu_time'] += record['user_time'] + record['sys_time']
+            summary['max_rss_bytes'] = max(summary['max_rss_bytes'], record['max_rss_bytes'])
+            summary['read_bytes'] += record['read_bytes']
+            summary['write_bytes'] += record['write_bytes']
+            summary['commands'] += 1
+        return steps
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'started': self.started,
+            'wall_time': time.time() - self.started,
+            'steps': self.summarize(),
+            'records': self.records,
+            }
+
+    def write_json(self, output_fp):
+        with open(output_fp, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def write_chrome_trace(self, output_fp):
+        """Writes records in chrome trace event format (chrome://tracing, perfetto)"""
+        events = []
+        for record in self.records:
+            events.append({
+                'name': record['name'],
+                'cat': record['type'],
+                'ph': 'X',
+                'ts': int((record['started'] - self.started) * 1e6),
+                'dur': int(record['wall_time'] * 1e6),
+                'pid': 1,
+                'tid': 0 if record['type'] == 'step' else record['thread'],
+                'args': {k: v for k, v in record.items() if k not in ('name', 'type')},
+                })
+        with open(output_fp, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+@contextlib.contextmanager
+def report(name=None):
+    """Makes a new RunReport active for everything run inside the block"""
+    run_report = RunReport(name=name)
+    token = REPORT.set(run_report)
+    try:
+        yield run_report
+    finally:
+        REPORT.reset(token)
+
+@contextlib.contextmanager
+def step(name):
+    """Labels everything run inside the block as part of workflow step name"""
+    token = STEP.set(name)
+    started = time.time()
+    try:
+        yield
+    finally:
+        STEP.reset(token)
+        run_report = REPORT.get()
+        if run_report is not None:
+            run_report.add({'type': 'step', 'name': name, 'step': name, 'started': started,
+                    'wall_time': time.time() - started})
+
+class ProcessGroup(object):
+    """Subprocesses launched in a context, so whoever owns it can stop them, see
+    dag.run_dag. Once terminated no more processes can be launched in the group."""
+    def __init__(self):
+        self.processes = set()
+        self.terminated = False
+        self.lock = threading.Lock()
+
+    def add(self, process):
+        with self.lock:
+            self.processes.add(process)
+            terminated = self.terminated
+        if terminated:
+            process.terminate()
+
+    def discard(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    def terminate(self):
+        with self.lock:
+            self.terminated = True
+            processes = list(self.processes)
+        for process in processes:
+            if process.returncode is None:
+                process.terminate()
+
+def describe(tool_args):
+    """Short name for a command, i.e. 'samtools sort' or 'picard MarkDuplicates'"""
+    tool_args = [str(a) for a in tool_args]
+    name = os.path.basename(tool_args[0])
+    skip_next = False
+    for arg in tool_args[1:]:
+        if skip_next:
+            skip_next = False
+        elif arg == '--java-options':
+            skip_next = True
+        elif not arg.startswith('-'):
+            return f'{name} {arg}'
+    return name
+
+def get_file_args(tool_args):
+    """Returns filepaths mentioned in tool_args, either as an argument or KEY=value"""
+    paths = []
+    for arg in tool_args:
+        arg = str(arg)
+        value = arg.split('=', 1)[1] if re.match(r'^[A-Za-z_]+=', arg) else arg
+        if value.startswith('/dev/') or value.startswith('-'):
+            continue
+        if os.path.isfile(value) or os.path.isdir(os.path.dirname(os.path.abspath(value))):
+            paths.append(value)
+    return paths
+
+def get_input_bam(tool_args):
+    """Returns the first existing bam in tool_args, or None"""
+    for fp in get_file_args(tool_args):
+        if fp.endswith('.bam') and os.path.isfile(fp):
+            return fp
+    return None
+
+def stat_files(paths):
+    stats = {}
+    for path in paths:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            stats[path] = (stat.st_size, stat.st_mtime_ns)
+    return stats
+
+def read_proc_io(pid):
+    """Returns io counters from /proc/<pid>/io, or None if not available"""
+    try:
+        with open(f'/proc/{pid}/io') as f:
+            return {key: int(value) for key, value in
+                    (line.split(': ') for line in f.read().strip().split('\n'))}
+    except (OSError, ValueError):
+        return None
+
+class ProcessMonitor(object):
+    """Tracks a launched subprocess and records its resource usage when waited on.
+    Its stderr, if piped, is logged line by line as it comes"""
+    def __init__(self, tool_args, process, files_before, routed=False):
+        self.tool_args = tool_args
+        self.routed = routed
+        self.process = process
+        self.process_group = PROCESS_GROUP.get()
+        self.files_before = files_before
+        self.started = time.time()
+        self.io = None
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._sample_io, daemon=True)
+        self.sampler.start()
+        self.tracker = progress.start(describe(tool_args), process.pid,
+                input_fp=get_input_bam(tool_args))
+        self.logger = None
+        if process.stderr is not None:
+            self.logger = threading.Thread(target=self._log_stderr, daemon=True)
+            self.logger.start()
+
+    def _log_stderr(self):
+        name = describe(self.tool_args)
+        for line in self.process.stderr:
+            line = line.decode('utf-8', 'replace').rstrip()
+            logging.info(f'{name}: {line}')
+            self.tracker.parse_line(line)
+        self.process.stderr.close()
+
+    def _sample_io(self):
+        while True:
+            io = read_proc_io(self.process.pid)
+            if io is not None:
+                self.io = io
+            if self.stopped.wait(IO_SAMPLE_INTERVAL):
+                return
+
+    def wait(self):
+        """Waits for the process, records it and returns its exit code"""
+        try:
+            _, status, rusage = os.wait4(self.process.pid, 0)
+            self.process.returncode = os.waitstatus_to_exitcode(status)
+        except ChildProcessError:
+            # already reaped through the Popen object
+            rusage = None
+            self.process.wait()
+        self.stopped.set()
+        self.sampler.join()
+        if self.logger is not None:
+            self.logger.join()
+        self.tracker.stop(self.process.returncode)
+        if self.process_group is not None:
+            self.process_group.discard(self.process)
+
+        record_command(self.tool_args, self.started, self.process.returncode,
+                self.files_before, rusage=rusage, io=self.io, routed=self.routed)
+
+        return self.process.returncode
+
+def record_command(tool_args, started, returncode, files_before, rusage=None, io=None,
+        routed=False):
+    """Adds a finished command to the active RunReport, if there is one"""
+    run_report = REPORT.get()
+    if run_report is None:
+        return
+
+    files_after = stat_files(files_before.keys() | set(get_file_args(tool_args)))
+    inputs = {fp: size for fp, (size, _) in files_before.items()}
+    outputs = {fp: size for fp, (size, mtime) in files_after.items()
+            if files_before.get(fp, (None, None))[1] != mtime}
+    if io is not None:
+        read_bytes, write_bytes = io['rchar'], io['wchar']
+    elif rusage is not None:
+        read_bytes, write_bytes = rusage.ru_inblock * 512, rusage.ru_oublock * 512
+    else:
+        read_bytes, write_bytes = 0, 0
+
+    run_report.add({
+        'type': 'command',
+        'name': describe(tool_args),
+        'step': STEP.get(),
+        'command': [str(a) for a in tool_args],
+        'thread': threading.get_ident(),
+        'started': started,
+        'wall_time': time.time() - started,
+        'user_time': rusage.ru_utime if rusage is not None else 0.0,
+        'sys_time': rusage.ru_stime if rusage is not None else 0.0,
+        # linux reports ru_maxrss in kilobytes
+        'max_rss_bytes': rusage.ru_maxrss * 1024 if rusage is not None else 0,
+        'read_bytes': read_bytes,
+        'write_bytes': write_bytes,
+        'input_sizes': inputs,
+        'output_sizes': outputs,
+        'returncode': returncode,
+        # resource usage is only the ng client's when run in the jvm executor
+        'jvm_executor': routed,
+        })
+
+def launch(tool_args, **popen_kwargs):
+    """Starts tool_args with subprocess.Popen and returns a ProcessMonitor for it.
+
+    picard and gatk calls go to the jvm executor when one is running. stderr is piped
+    to the log unless popen_kwargs say where it goes.
+    """
+    process_group = PROCESS_GROUP.get()
+    if process_group is not None and process_group.terminated:
+        raise subprocess.CalledProcessError(-signal.SIGTERM, tool_args)
+    files_before = stat_files(get_file_args(tool_args))
+    routed_args = jvm_executor.route(tool_args)
+    popen_kwargs.setdefault('stderr', subprocess.PIPE)
+    process = subprocess.Popen(routed_args, **popen_kwargs)
+    if process_group is not None:
+        process_group.add(process)
+
+    return ProcessMonitor(tool_args, process, files_before,
+            routed=routed_args is not tool_args)
+
+def execute(tool_args, stdin=None, stdout=None):
+    """Instrumented replacement for subprocess.check_output. stdout is logged line by line
+    as it comes, like stderr, and the last OUTPUT_TAIL_LINES lines of it are returned,
+    and kept as the output of the CalledProcessError if the command fails. Callers that
+    need all of stdout pass a file object to write it to as stdout instead, then nothing
+    is logged or returned"""
+    if stdout is not None:
+        monitor = launch(tool_args, stdin=stdin, stdout=stdout)
+        tail = ()
+    else:
+        monitor = launch(tool_args, stdin=stdin, stdout=subprocess.PIPE)
+        name = describe(tool_args)
+        tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+        for line in monitor.process.stdout:
+            tail.append(line)
+            logging.info(f'{name}: {line.decode("utf-8", "replace").rstrip()}')
+        monitor.process.stdout.close()
+    output = b''.join(tail)
+    returncode = monitor.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, tool_args, output=output)
+
+    return output
+
+def run_python_stage(name, stage, *args, input_fp=None, **kwargs):
+    """Runs a python callable and records its wall time and cpu time. Its progress is
+    followed through input_fp, by how far into it this process and the processes it
+    started are"""
+    started = time.time()
+    usage_before = resource.getrusage(resource.RUSAGE_THREAD)
+    tracker = progress.start(name, os.getpid(), input_fp=input_fp)
+    returncode = 1
+    try:
+        result = stage(*args, **kwargs)
+        returncode = 0
+        return result
+    finally:
+        tracker.stop(returncode)
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        run_report = REPORT.get()
+        if run_report is not None:
+            run_report.add({
+                'type': 'python',
+                'name': name,
+                'step': STEP.get(),
+                'thread': threading.get_ident(),
+                'started': started,
+                'wall_time': time.time() - started,
+                'user_time': usage.ru_utime - usage_before.ru_utime,
+                'sys_time': usage.ru_stime - usage_before.ru_stime,
+                # only available for the whole process
+                'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                'read_bytes': (usage.ru_inblock - usage_before.ru_inblock) * 512,
+                'write_bytes': (usage.ru_oublock - usage_before.ru_oublock) * 512,
+                })
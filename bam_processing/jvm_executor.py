@@ -0,0 +1,184 @@
+"""Runs picard and gatk tools in a long lived nailgun jvm instead of starting a new jvm
+for every call.
+
+When BAM_PROCESSING_JVM_EXECUTOR is set to the address of a running nailgun server,
+picard and gatk calls are rewritten to go through the ng client. If it isn't set, or
+nothing is listening there, calls run as plain subprocesses.
+
+Addresses are local:<path> for a unix socket or host:port. A tcp port on loopback can
+be connected to by any user of the machine, who could then run code in the server,
+so executor() starts each server on its own unix socket in a directory only the
+current user can open. A server can also be started once and shared by many runs:
+
+    mkdir -m 700 /tmp/ng && java -Xmx8g -cp $NAILGUN_JAR:$PICARD:$GATK_LOCAL_JAR \
+            com.facebook.nailgun.NGServer local:/tmp/ng/ng.sock
+    export BAM_PROCESSING_JVM_EXECUTOR=local:/tmp/ng/ng.sock
+
+Every tool shares the heap of the server, so per call -Xmx options are dropped.
+"""
+import contextlib
+import glob
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+ADDRESS_ENV = 'BAM_PROCESSING_JVM_EXECUTOR'
+LOCAL_PREFIX = 'local:'
+NAILGUN_SERVER_CLASS = 'com.facebook.nailgun.NGServer'
+MAIN_CLASSES = {
+    'picard': 'picard.cmdline.PicardCommandLine',
+    'gatk': 'org.broadinstitute.hellbender.Main',
+    }
+# arguments whose values are filepaths. the server has its own working directory,
+# so they are made absolute
+PATH_FLAGS = {'-I', '-O', '-R', '-L', '--known-sites', '--bqsr-recal-file'}
+PATH_KEYS = {'I', 'O', 'R', 'M', 'TMP_DIR'}
+
+def get_address():
+    return os.environ.get(ADDRESS_ENV)
+
+def parse_address(address):
+    """Returns (path, None) for a local:<path> address and (host, port) otherwise"""
+    if address.startswith(LOCAL_PREFIX):
+        return address[len(LOCAL_PREFIX):], None
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+def is_running(address):
+    """Returns True if something is listening at address"""
+    host, port = parse_address(address)
+    try:
+        if port is None:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.settimeout(1)
+                s.connect(host)
+        else:
+            socket.create_connection((host, port), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+def get_server_args(address):
+    """Returns the ng client arguments that select the server at address"""
+    host, port = parse_address(address)
+    if port is None:
+        return ('--nailgun-server', address)
+    return ('--nailgun-server', host, '--nailgun-port', str(port))
+
+def strip_jvm_options(tool_args):
+    """Removes the picard -X.. and gatk --java-options arguments that come before the
+    tool name"""
+    stripped = [tool_args[0]]
+    args = list(tool_args[1:])
+    while args and (args[0].startswith('-X') or args[0] == '--java-options'):
+        args = args[2:] if args[0] == '--java-options' else args[1:]
+
+    return stripped + args
+
+def absolutize_paths(tool_args):
+    absolutized = []
+    previous = None
+    for arg in tool_args:
+        arg = str(arg)
+        key, _, value = arg.partition('=')
+        if previous in PATH_FLAGS and (previous != '-L' or os.path.exists(arg)):
+            arg = os.path.abspath(arg)
+        elif value and key in PATH_KEYS:
+            arg = f'{key}={os.path.abspath(value)}'
+        absolutized.append(arg)
+        previous = arg
+
+    return absolutized
+
+def uses_stdio(tool_args):
+    """stdin/stdout inside the server would be the servers own, not the callers"""
+    return any('/dev/' in str(arg) for arg in tool_args)
+
+def route(tool_args):
+    """Returns tool_args rewritten to run in the jvm executor, or unchanged if they
+    aren't a picard or gatk call, or no executor is running"""
+    address = get_address()
+    if address is None or not tool_args or tool_args[0] not in MAIN_CLASSES or \
+            uses_stdio(tool_args):
+        return tool_args
+    if not is_running(address):
+        logging.info(f'jvm executor at {address} is not running, starting a new jvm')
+        return tool_args
+
+    args = absolutize_paths(strip_jvm_options(tool_args))
+
+    return ('ng',) + get_server_args(address) + (MAIN_CLASSES[args[0]],) + tuple(args[1:])
+
+def find_jar(env, tool, pattern):
+    """Returns the jar given by environmental variable env, or the first jar matching
+    pattern near the tool on the PATH"""
+    if os.environ.get(env):
+        return os.environ[env]
+    tool_fp = shutil.which(tool)
+    if tool_fp is not None:
+        tool_dir = os.path.dirname(os.path.realpath(tool_fp))
+        for directory in (tool_dir, os.path.join(tool_dir, '..', 'share', '*')):
+            jars = sorted(glob.glob(os.path.join(directory, pattern)))
+            if jars:
+                return jars[0]
+    raise FileNotFoundError(f'could not find the {tool} jar, set {env}')
+
+def get_classpath():
+    return ':'.join((
+            find_jar('NAILGUN_JAR', 'ng', 'nailgun-server*.jar'),
+            find_jar('PICARD', 'picard', 'picard*.jar'),
+            find_jar('GATK_LOCAL_JAR', 'gatk', 'gatk-package-*-local.jar'),
+            ))
+
+def stop(address):
+    subprocess.run(('ng',) + get_server_args(address) + ('ng-stop',),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+@contextlib.contextmanager
+def executor(max_mem='4g', address=None, timeout=60):
+    """Starts a nailgun jvm with picard and gatk on its classpath and routes picard and
+    gatk calls made inside the block to it.
+
+    By default the server listens on a unix socket in a new directory only the current
+    user can open, so every run gets its own server. If address is given nothing may
+    be listening there yet, so another run's server is never used and then stopped.
+    """
+    socket_dir = None
+    if address is None:
+        # mkdtemp creates the directory readable by its owner only
+        socket_dir = tempfile.mkdtemp(prefix='jvm_executor.')
+        address = f'{LOCAL_PREFIX}{os.path.join(socket_dir, "ng.sock")}'
+    elif is_running(address):
+        raise RuntimeError(f'something is already listening at {address}')
+
+    tool_args = ('java', f'-Xmx{max_mem}', '-cp', get_classpath(), NAILGUN_SERVER_CLASS,
+            address)
+    logging.info(f'starting jvm executor: {tool_args}')
+    process = subprocess.Popen(tool_args, stdout=subprocess.DEVNULL)
+    previous_address = os.environ.get(ADDRESS_ENV)
+    try:
+        started = time.time()
+        while not is_running(address):
+            if process.poll() is not None or time.time() - started > timeout:
+                raise RuntimeError(f'jvm executor failed to start at {address}')
+            time.sleep(0.2)
+        os.environ[ADDRESS_ENV] = address
+        yield address
+    finally:
+        if previous_address is None:
+            os.environ.pop(ADDRESS_ENV, None)
+        else:
+            os.environ[ADDRESS_ENV] = previous_address
+        if process.poll() is None:
+            stop(address)
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        if socket_dir is not None:
+            shutil.rmtree(socket_dir, ignore_errors=True)
@@ -0,0 +1,340 @@
+"""Follows how far along running commands are and how fast they are going.
+
+The position of a command is taken from how far into its input bam its file
+descriptor is, read from /proc/<pid>/fdinfo of the command and the processes it
+started, and from the progress lines picard and gatk log (the record count and genomic
+coordinate they last read). Together with the size, record count and contig lengths of
+the input, from its header and index, that gives percent complete, records/s and an
+eta. Native python stages are followed the same way, through the descriptors of this
+process and the chunk processes it started.
+
+Every command logs its progress every LOG_INTERVAL seconds. While a Board is active
+(see session()) the progress of every command run inside it is also written to a json
+status file and served over http on localhost, for schedulers to poll.
+"""
+import contextlib
+import contextvars
+import glob
+import http.server
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+import bam_metadata
+
+ACTIVE = contextvars.ContextVar('progress_board', default=None)
+
+# how often the input position of a running command is read
+SAMPLE_INTERVAL = 1.0
+# how often the progress of a running command is logged
+LOG_INTERVAL = 30.0
+# how often the status file is rewritten
+STATUS_INTERVAL = 5.0
+# finished commands kept on the board, oldest are dropped first
+MAX_FINISHED = 100
+
+# picard ProgressLogger, i.e.
+# INFO ... MarkDuplicates Read 1,000,000 records.  Elapsed time: 00:00:12s.  Time for
+# last 1,000,000:   12s.  Last read position: chr1:12,345,678
+PICARD_PROGRESS = re.compile(
+        r'Read\s+([\d,]+) records\..*Last read position: ([^\s:]+):([\d,]+)')
+# gatk ProgressMeter, columns are locus, elapsed minutes, reads processed, reads/minute
+GATK_PROGRESS = re.compile(r'ProgressMeter -\s+([^\s:]+):(\d+)\s+[\d.]+\s+(\d+)\s')
+
+def parse_progress_line(line):
+    """Returns (records, contig, position) from a picard or gatk progress line, or None if
+    line isn't one"""
+    match = PICARD_PROGRESS.search(line)
+    if match is not None:
+        return (int(match.group(1).replace(',', '')), match.group(2),
+                int(match.group(3).replace(',', '')))
+    match = GATK_PROGRESS.search(line)
+    if match is not None:
+        return int(match.group(3)), match.group(1), int(match.group(2))
+    return None
+
+def get_descendants(pid):
+    """Returns pid and the pids of every process below it, i.e. the jvm started by the
+    gatk wrapper script"""
+    pids = [pid]
+    for parent in pids:
+        for children_fp in glob.glob(f'/proc/{parent}/task/*/children'):
+            try:
+                with open(children_fp) as f:
+                    pids += [int(child) for child in f.read().split()]
+            except (OSError, ValueError):
+                pass
+    return pids
+
+def read_file_position(pids, fp):
+    """Returns the furthest offset any of pids has fp open at, or None if none of them
+    have it open"""
+    real_fp = os.path.realpath(fp)
+    position = None
+    for pid in pids:
+        try:
+            fds = os.listdir(f'/proc/{pid}/fd')
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                if os.readlink(f'/proc/{pid}/fd/{fd}') != real_fp:
+                    continue
+                with open(f'/proc/{pid}/fdinfo/{fd}') as f:
+                    pos = int(f.readline().split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+            position = pos if position is None else max(position, pos)
+    return position
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+class Progress(object):
+    """Progress of one command through its input bam, input_fp can be None for commands
+    reading a pipe, they only have the progress they log"""
+    def __init__(self, name, input_fp=None):
+        self.name = name
+        self.input_fp = input_fp
+        self.started = time.time()
+        self.finished = None
+        self.state = 'running'
+        self.input_bytes = None
+        self.total_records = None
+        self.offsets = {}
+        self.genome_length = None
+        self.position = None
+        self.records = None
+        self.locus = None
+        self.logged = self.started
+        self.lock = threading.Lock()
+        if input_fp is not None:
+            self.read_input(input_fp)
+
+    def read_input(self, input_fp):
+        self.input_bytes = os.path.getsize(input_fp)
+        try:
+            metadata = bam_metadata.read_metadata(input_fp)
+        except (OSError, ValueError):
+            return
+        offset = 0
+        for contig in metadata['contigs']:
+            self.offsets[contig['name']] = offset
+            offset += contig['length']
+        self.genome_length = offset or None
+        self.total_records = bam_metadata.count_records(input_fp,
+                index_fp=metadata['index_fp']) if metadata['index_fp'] else None
+
+    def parse_line(self, line):
+        """Updates the records read and locus from a line the command logged"""
+        parsed = parse_progress_line(line)
+        if parsed is None:
+            return
+        with self.lock:
+            self.records, contig, position = parsed
+            self.locus = (contig, position)
+
+    def sample(self, pids):
+        """Updates how far into the input the processes pids are"""
+        if self.input_fp is None:
+            return
+        position = read_file_position(pids, self.input_fp)
+        if position is not None:
+            with self.lock:
+                self.position = max(position, self.position or 0)
+
+    def finish(self, returncode):
+        with self.lock:
+            self.finished = time.time()
+            self.state = 'done' if returncode == 0 else 'failed'
+
+    def get_fraction(self):
+        """Returns fraction of the input done, from the input position if it is known,
+        else from the locus or records logged, or None"""
+        if self.state == 'done':
+            return 1.0
+        if self.position is not None and self.input_bytes:
+            return min(self.position / self.input_bytes, 1.0)
+        if self.locus is not None and self.genome_length and self.locus[0] in self.offsets:
+            return min((self.offsets[self.locus[0]] + self.locus[1]) / self.genome_length,
+                    1.0)
+        if self.records is not None and self.total_records:
+            return min(self.records / self.total_records, 1.0)
+        return None
+
+    def get_status(self):
+        """Returns dict of state, percent complete, records and bytes read and their rate
+        per second, eta in seconds and last locus logged. Unknowns are None"""
+        with self.lock:
+            elapsed = max((self.finished or time.time()) - self.started, 1e-6)
+            fraction = self.get_fraction()
+            records = self.records
+            if records is None and fraction is not None and self.total_records:
+                records = int(fraction * self.total_records)
+            eta = None
+            if self.state == 'running' and fraction:
+                eta = elapsed * (1.0 - fraction) / fraction
+            return {
+                'name': self.name,
+                'input': self.input_fp,
+                'state': self.state,
+                'started': self.started,
+                'elapsed_seconds': elapsed,
+                'percent': fraction * 100.0 if fraction is not None else None,
+                'eta_seconds': eta,
+                'records': records,
+                'total_records': self.total_records,
+                'records_per_second': records / elapsed if records is not None else None,
+                'bytes': self.position,
+                'total_bytes': self.input_bytes,
+                'bytes_per_second': self.position / elapsed
+                        if self.position is not None else None,
+                'locus': f'{self.locus[0]}:{self.locus[1]}' if self.locus else None,
+                }
+
+    def describe(self):
+        """One line summary of get_status for the log"""
+        status = self.get_status()
+        parts = [f'{status["name"]}: running for {format_duration(status["elapsed_seconds"])}']
+        if status['percent'] is not None:
+            parts.append(f'{status["percent"]:.1f}% of {os.path.basename(self.input_fp)}'
+                    if self.input_fp else f'{status["percent"]:.1f}%')
+        if status['records_per_second'] is not None:
+            parts.append(f'{status["records_per_second"]:,.0f} records/s')
+        elif status['bytes_per_second'] is not None:
+            parts.append(f'{status["bytes_per_second"] / 1024 ** 2:,.1f} MB/s')
+        if status['eta_seconds'] is not None:
+            parts.append(f'eta {format_duration(status["eta_seconds"])}')
+        if status['locus'] is not None:
+            parts.append(f'at {status["locus"]}')
+        return ', '.join(parts)
+
+    def log_if_due(self):
+        now = time.time()
+        if now - self.logged >= LOG_INTERVAL:
+            self.logged = now
+            logging.info(self.describe())
+
+class Tracker(object):
+    """Samples the progress of a running process in a background thread, see start()"""
+    def __init__(self, progress, pid):
+        self.progress = progress
+        self.pid = pid
+        self.stopped = threading.Event()
+        self.board = ACTIVE.get()
+        if self.board is not None:
+            self.board.add(progress)
+        self.sampler = threading.Thread(target=self._sample, daemon=True)
+        self.sampler.start()
+
+    def _sample(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            self.progress.sample(get_descendants(self.pid))
+            self.progress.log_if_due()
+
+    def parse_line(self, line):
+        self.progress.parse_line(line)
+
+    def stop(self, returncode):
+        self.stopped.set()
+        self.sampler.join()
+        self.progress.finish(returncode)
+
+def start(name, pid, input_fp=None):
+    """Starts following process pid running command name through input_fp, returns a
+    Tracker to pass the lines the command logs to and to stop when the process ends"""
+    return Tracker(Progress(name, input_fp=input_fp), pid)
+
+class Board(object):
+    """Progress of every command run while it is active, written to status_fp and served
+    as json at http://127.0.0.1:<port>/ if they are given"""
+    def __init__(self, status_fp=None, port=None):
+        self.status_fp = status_fp
+        self.port = port
+        self.progresses = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.writer = None
+        self.server = None
+
+    def add(self, progress):
+        with self.lock:
+            finished = [p for p in self.progresses if p.state != 'running']
+            for p in finished[:max(0, len(finished) - MAX_FINISHED)]:
+                self.progresses.remove(p)
+            self.progresses.append(progress)
+
+    def to_dict(self):
+        with self.lock:
+            progresses = list(self.progresses)
+        return {
+            'updated': time.time(),
+            'running': sum(1 for p in progresses if p.state == 'running'),
+            'commands': [p.get_status() for p in progresses],
+            }
+
+    def write(self):
+        """Atomically replaces the status file"""
+        temp_fp = f'{self.status_fp}.{str(uuid.uuid4())}.tmp'
+        with open(temp_fp, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(temp_fp, self.status_fp)
+
+    def _write_status(self):
+        while not self.stopped.wait(STATUS_INTERVAL):
+            self.write()
+
+    def start(self):
+        if self.status_fp is not None:
+            self.write()
+            self.writer = threading.Thread(target=self._write_status, daemon=True)
+            self.writer.start()
+        if self.port is not None:
+            board = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = json.dumps(board.to_dict()).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.server = http.server.ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logging.info(f'serving progress at http://127.0.0.1:{self.server.server_port}/')
+
+    def close(self):
+        self.stopped.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+@contextlib.contextmanager
+def session(status_fp=None, port=None):
+    """Makes a new Board active for everything run inside the block. Inside an active
+    session this does nothing, so workflows report to the board of whoever runs them"""
+    if ACTIVE.get() is not None:
+        yield ACTIVE.get()
+        return
+
+    board = Board(status_fp=status_fp, port=port)
+    board.start()
+    token = ACTIVE.set(board)
+    try:
+        yield board
+    finally:
+        ACTIVE.reset(token)
+        board.close()
@@ -0,0 +1,146 @@
+"""Cache of prepared reference assets shared by every run that can see the cache
+directory, i.e. on a shared filesystem.
+
+Entries are keyed by the sha256 of the reference fasta or known sites vcf, so the same
+file under different paths, or on different nodes, is only prepared once. An entry holds
+a copy of the file (a hard link when on the same filesystem) next to its sidecars: the
+.fai and .dict of a fasta, or the .tbi of a vcf.
+
+Builds hold an exclusive flock on a lock file next to the entry, are written to a
+temporary directory and committed with a rename, so concurrent runs never race on or see
+half written sidecars. flock works across nodes on nfs (linux emulates it with fcntl
+locks there).
+
+The cache directory defaults to $BAM_PROCESSING_REFERENCE_CACHE. It can be pre-warmed,
+i.e. while building a docker image, with
+
+    python reference_cache_cli.py --cache-dir /reference_cache ref.fa known_sites.vcf.gz
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import uuid
+
+import bam_processing as bp
+import step_cache
+
+CACHE_DIR_ENV = 'BAM_PROCESSING_REFERENCE_CACHE'
+# bytes read at a time while checksumming
+CHUNK_SIZE = 16 * 1024 ** 2
+
+def get_cache_dir(cache_dir=None):
+    """Returns cache_dir, or the directory given by $BAM_PROCESSING_REFERENCE_CACHE"""
+    return cache_dir or os.environ.get(CACHE_DIR_ENV) or None
+
+def get_suffix(fp):
+    """Returns file extension, including a .gz, i.e. .fa, .fa.gz or .vcf.gz"""
+    match = re.search(r'(\.[^./]+(\.gz)?)$', os.path.basename(fp))
+    return match.group(1) if match is not None else ''
+
+def write_atomic(fp, text):
+    temp_fp = f'{fp}.{str(uuid.uuid4())}.tmp'
+    with open(temp_fp, 'w') as f:
+        f.write(text)
+    os.replace(temp_fp, fp)
+
+@contextlib.contextmanager
+def lock(lock_fp):
+    """Holds an exclusive lock on lock_fp, blocking until it is free"""
+    with open(lock_fp, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class ReferenceCache(object):
+    """Prepares references and known sites once per cache_dir and returns the
+    filepaths of the prepared copies"""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(os.path.join(cache_dir, 'checksums'), exist_ok=True)
+
+    def get_checksum(self, fp):
+        """Returns sha256 of the file.
+
+        Hashing a genome takes a while, so checksums are remembered in the cache per
+        (realpath, size, mtime).
+        """
+        stat = os.stat(fp)
+        identity = json.dumps([os.path.realpath(fp), stat.st_size, stat.st_mtime_ns])
+        memo_fp = os.path.join(self.cache_dir, 'checksums',
+                hashlib.sha256(identity.encode('utf-8')).hexdigest())
+        if os.path.isfile(memo_fp):
+            with open(memo_fp) as f:
+                return f.read().strip()
+
+        logging.info(f'checksumming {fp}')
+        digest = hashlib.sha256()
+        with open(fp, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        checksum = digest.hexdigest()
+        write_atomic(memo_fp, checksum)
+
+        return checksum
+
+    def get_entry(self, kind, fp, build):
+        """Returns filepath of the cached copy of fp, first building the entry with
+        build(copy_fp) if no run has yet"""
+        suffix = get_suffix(fp)
+        entry_dir = os.path.join(self.cache_dir, kind, self.get_checksum(fp) + suffix)
+        entry_fp = os.path.join(entry_dir, kind + suffix)
+        if os.path.isdir(entry_dir):
+            return entry_fp
+
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        with lock(f'{entry_dir}.lock'):
+            # another run may have built it while we waited for the lock
+            if os.path.isdir(entry_dir):
+                return entry_fp
+
+            logging.info(f'preparing {fp} in reference cache {entry_dir}')
+            temp_dir = f'{entry_dir}.tmp.{str(uuid.uuid4())}'
+            os.mkdir(temp_dir)
+            try:
+                temp_fp = os.path.join(temp_dir, kind + suffix)
+                step_cache.link_or_copy(fp, temp_fp)
+                build(temp_fp)
+                os.rename(temp_dir, entry_dir)
+            except Exception:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                raise
+
+        return entry_fp
+
+    def prepare_reference(self, reference_fp):
+        """Returns filepath of a cached copy of the fasta with a .fai and .dict"""
+        def build(fp):
+            bp.index_reference(fp)
+            bp.create_reference_sequence_dict(fp)
+
+        return self.get_entry('reference', reference_fp, build)
+
+    def prepare_known_sites(self, known_sites_fp):
+        """Returns filepath of a cached copy of the bgzipped vcf with a .tbi"""
+        return self.get_entry('known_sites', known_sites_fp, bp.index_vcf)
+
+def prepare(cache_dir, reference_fp=None, known_sites_fp=None):
+    """Returns (reference_fp, known_sites_fp) swapped for their cached copies if
+    there is a cache directory, otherwise unchanged"""
+    cache_dir = get_cache_dir(cache_dir)
+    if cache_dir is None:
+        return reference_fp, known_sites_fp
+
+    cache = ReferenceCache(cache_dir)
+    if reference_fp is not None:
+        reference_fp = cache.prepare_reference(reference_fp)
+    if known_sites_fp is not None:
+        known_sites_fp = cache.prepare_known_sites(known_sites_fp)
+
+    return reference_fp, known_sites_fp
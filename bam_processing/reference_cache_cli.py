@@ -0,0 +1,29 @@
+import argparse
+
+import reference_cache
+
+parser = argparse.ArgumentParser(description='prepare references and known sites in the \
+reference cache ahead of time, i.e. while building a docker image')
+
+parser.add_argument('files', type=str, nargs='+',
+        help='reference fastas and bgzipped known sites vcfs (.vcf.gz) to prepare')
+
+parser.add_argument('--cache-dir', type=str,
+        help='reference cache directory. Defaults to $BAM_PROCESSING_REFERENCE_CACHE.')
+
+args = parser.parse_args()
+
+def main():
+    cache_dir = reference_cache.get_cache_dir(args.cache_dir)
+    if cache_dir is None:
+        parser.error(f'--cache-dir or ${reference_cache.CACHE_DIR_ENV} is required')
+
+    cache = reference_cache.ReferenceCache(cache_dir)
+    for fp in args.files:
+        if fp.endswith('.vcf.gz'):
+            print(cache.prepare_known_sites(fp))
+        else:
+            print(cache.prepare_reference(fp))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Derives jvm heap, MAX_RECORDS_IN_RAM, sort memory and thread counts for a run from
+the size of the input and the memory and cpus the host (or its cgroup) allows.
+
+Settings given explicitly always win over the derived ones.
+"""
+import logging
+import os
+
+import bam_io
+import bam_metadata
+import bam_processing as bp
+
+# share of available memory a run plans to use, the rest is headroom for the os,
+# page cache and python
+MEMORY_FRACTION = 0.8
+# resident memory a jvm uses on top of its -Xmx heap (metaspace, code cache, gc)
+JVM_OVERHEAD = 512 * 1024 ** 2
+# above this the jvm can't use compressed object pointers
+MAX_HEAP = 31 * 1024 ** 3
+MIN_HEAP = 1024 ** 3
+# picard keeps about this many records in ram per gigabyte of heap
+RECORDS_PER_HEAP_GB = 250000
+MIN_RECORDS_IN_RAM = 100000
+# samtools sort needs a bit more than the uncompressed records to sort them in memory
+SORT_OVERHEAD = 1.2
+MIN_SORT_MEMORY_PER_THREAD = 128 * 1024 ** 2
+# inputs with fewer records than this aren't worth sharding across jvms
+MIN_RECORDS_TO_SHARD = 10000000
+# records read from the start of the input to estimate record size
+SAMPLE_RECORDS = 10000
+
+def read_int(fp):
+    """Returns the integer in a /proc or /sys file, or None if missing or unlimited"""
+    try:
+        with open(fp) as f:
+            value = f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+    return int(value) if value.isdigit() else None
+
+def get_cgroup_memory_limit():
+    """Returns memory limit of this process's cgroup (v2 or v1) in bytes, or None"""
+    for limit_fp in ('/sys/fs/cgroup/memory.max',
+            '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        limit = read_int(limit_fp)
+        # v1 reports no limit as a huge page aligned number
+        if limit is not None and limit < 1 << 62:
+            return limit
+    return None
+
+def get_available_memory():
+    """Returns bytes of memory a run can use, the smaller of MemAvailable and the
+    cgroup limit"""
+    available = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if available is None:
+        available = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+    limit = get_cgroup_memory_limit()
+    return min(available, limit) if limit is not None else available
+
+def get_available_cpus():
+    """Returns cpus this process can use, taking affinity and cgroup quotas into account"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else \
+            os.cpu_count()
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        quota, period = read_int('/sys/fs/cgroup/cpu/cpu.cfs_quota_us'), \
+                read_int('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+        if quota and period:
+            cpus = min(cpus, max(1, quota // period))
+    return cpus
+
+def get_record_stats(bam_fp):
+    """Returns (n_records, record_size) where record_size is the average uncompressed
+    size of a record.
+
+    The record count comes from the .bai or .csi metadata when there is an index,
+    otherwise it is estimated from how many compressed bytes the first records take.
+    """
+    file_size = os.path.getsize(bam_fp)
+    with bam_io.BgzfReader(bam_fp) as reader:
+        bam_io.read_header(reader)
+        start = reader.tell() >> 16
+        n, uncompressed = 0, 0
+        for record in bam_io.iter_records(reader):
+            n += 1
+            uncompressed += 4 + len(record)
+            if n == SAMPLE_RECORDS:
+                break
+        compressed = max(1, (reader.tell() >> 16) - start)
+    if n == 0:
+        return 0, 0
+    record_size = uncompressed // n
+
+    n_records = bam_metadata.count_records(bam_fp)
+    if n_records is not None:
+        return n_records, record_size
+
+    if n < SAMPLE_RECORDS:
+        return n, record_size
+    return int(n * (file_size - start) / compressed), record_size
+
+def format_memory(n_bytes):
+    """Returns bytes as a samtools/java style memory string in megabytes"""
+    return f'{max(1, int(n_bytes) // 1024 ** 2)}M'
+
+def make_plan(input_fp, threads=None, max_mem=None, sort_memory=None, workers=None,
+        max_records_in_ram=None, memory=None, cpus=None):
+    """Returns dict of threads, max_mem, sort_memory, workers and max_records_in_ram
+    for a run on input_fp.
+
+    memory and cpus default to what the host and cgroup make available. Any setting
+    given is kept as is and the rest are derived around it:
+        threads - every available cpu
+        workers - shard gatk steps over half the cpus for inputs big enough to be
+            worth it, as far as a minimum heap per jvm allows
+        sort_memory - enough to sort the whole input in memory if the budget allows,
+            otherwise half the budget, so sorts spill to fewer temp files
+        max_mem - the rest of the budget split between worker jvms
+        max_records_in_ram - what fits in the heap, or every record if they all fit
+    """
+    memory = bp.parse_memory(memory) if memory is not None else get_available_memory()
+    cpus = cpus or get_available_cpus()
+    n_records, record_size = get_record_stats(input_fp)
+    budget = int(memory * MEMORY_FRACTION)
+
+    if threads is None:
+        threads = cpus
+    if workers is None:
+        workers = 1
+        if n_records >= MIN_RECORDS_TO_SHARD:
+            workers = max(1, min(cpus // 2, budget // 2 // (MIN_HEAP + JVM_OVERHEAD)))
+
+    if sort_memory is None:
+        needed = int(n_records * record_size * SORT_OVERHEAD)
+        needed = max(needed, MIN_SORT_MEMORY_PER_THREAD * threads)
+        sort_memory = format_memory(min(needed, budget // 2))
+
+    if max_mem is None:
+        # sorts and jvms run one after the other, so the heap doesn't leave room for sorts.
+        # workflows start bam steps after the jvm reference steps for the same reason
+        heap = budget // workers - JVM_OVERHEAD
+        max_mem = format_memory(max(MIN_HEAP, min(MAX_HEAP, heap)))
+
+    if max_records_in_ram is None:
+        fits = bp.parse_memory(max_mem) * RECORDS_PER_HEAP_GB // 1024 ** 3
+        max_records_in_ram = max(MIN_RECORDS_IN_RAM, min(fits, n_records))
+
+    plan = {
+        'threads': threads,
+        'max_mem': max_mem,
+        'sort_memory': sort_memory,
+        'workers': workers,
+        'max_records_in_ram': max_records_in_ram,
+        }
+    logging.info(f'resource plan for {input_fp} ({n_records} records of ~{record_size} '
+            f'bytes, {format_memory(memory)} memory, {cpus} cpus): {plan}')
+
+    return plan
@@ -0,0 +1,226 @@
+"""Tracks the intermediate files of a run so none outlive it.
+
+Intermediates get their paths from temp_path. While a Scratch is active (see
+session()) every path handed out is tracked, small files (metrics, recalibration
+tables, interval lists) are put on a tmpfs when there is one, and each intermediate is
+removed as soon as its last consumer calls consumed. Whatever is left is removed when
+the session ends, whether it ends normally, by an exception or by SIGTERM or SIGHUP.
+Only the main thread gets signals, so a main thread running sessions in other threads
+removes the intermediates of all of them, see cleanup_on_signal.
+
+A ceiling on the bytes the tracked intermediates take on disk can be set, it is
+checked every time an intermediate is created or consumed.
+"""
+import contextlib
+import contextvars
+import glob
+import logging
+import os
+import re
+import shutil
+import signal
+import threading
+import uuid
+
+ACTIVE = contextvars.ContextVar('scratch', default=None)
+# every active session, in any thread
+SESSIONS = set()
+SESSIONS_LOCK = threading.Lock()
+
+# candidates for small intermediates, in order of preference
+TMPFS_DIRS = ('/dev/shm',)
+# a tmpfs with less free space than this isn't used
+MIN_TMPFS_FREE = 256 * 1024 ** 2
+# signals that end a session the same way an exception would
+CLEANUP_SIGNALS = (signal.SIGTERM, signal.SIGHUP)
+
+class ScratchSpaceError(Exception):
+    pass
+
+def find_tmpfs_dir():
+    """Returns a writable tmpfs directory with room to spare, or None"""
+    for tmpfs_dir in TMPFS_DIRS:
+        if not os.path.isdir(tmpfs_dir) or not os.access(tmpfs_dir, os.W_OK):
+            continue
+        if shutil.disk_usage(tmpfs_dir).free >= MIN_TMPFS_FREE:
+            return tmpfs_dir
+    return None
+
+def get_size(fp):
+    """Returns bytes taken by a file, or by everything under a directory"""
+    if os.path.isdir(fp):
+        return sum(os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(fp) for name in names
+                if os.path.isfile(os.path.join(root, name)))
+    return os.path.getsize(fp) if os.path.isfile(fp) else 0
+
+def remove_path(fp):
+    """Removes a file or directory, and any index next to a bam"""
+    if os.path.isdir(fp):
+        shutil.rmtree(fp, ignore_errors=True)
+        return
+    fps = [fp]
+    if fp.endswith('.bam'):
+        fps += [f'{fp}.bai', re.sub(r'\.bam$', '.bai', fp)]
+    for path in fps:
+        if os.path.isfile(path):
+            os.remove(path)
+
+class Scratch(object):
+    """Intermediates of a run, with how many consumers each is still waiting on.
+
+    max_bytes is the ceiling on what the tracked intermediates outside of tmpfs may take,
+    None for no ceiling. tmpfs_dir is where small intermediates go, by default the first
+    usable directory of TMPFS_DIRS. If there is none, or tmpfs_dir is '', they go with
+    the rest.
+    """
+    def __init__(self, max_bytes=None, tmpfs_dir=None):
+        self.max_bytes = max_bytes
+        if tmpfs_dir is None:
+            tmpfs_dir = find_tmpfs_dir()
+        self.tmpfs_dir = tmpfs_dir or None
+        self.consumers = {}
+        self.peak_bytes = 0
+        self.lock = threading.Lock()
+
+    def path(self, directory, prefix, suffix='', small=False, consumers=1):
+        """Returns a new tracked path, see temp_path"""
+        if small and self.tmpfs_dir is not None:
+            directory = self.tmpfs_dir
+        fp = os.path.join(directory, f'{prefix}.{str(uuid.uuid4())}{suffix}')
+        self.check()
+        with self.lock:
+            self.consumers[fp] = consumers
+        return fp
+
+    def consumed(self, fp):
+        """Marks one consumer of fp as finished, removing fp if it was the last"""
+        with self.lock:
+            if fp not in self.consumers:
+                return False
+            self.consumers[fp] -= 1
+            if self.consumers[fp] > 0:
+                return False
+            del self.consumers[fp]
+        remove_path(fp)
+        self.check()
+        return True
+
+    def usage(self):
+        """Returns bytes the tracked intermediates take outside of tmpfs"""
+        with self.lock:
+            fps = list(self.consumers)
+        return sum(get_size(fp) for fp in fps
+                if self.tmpfs_dir is None or not fp.startswith(self.tmpfs_dir + os.sep))
+
+    def check(self):
+        """Raises ScratchSpaceError if the intermediates are over the ceiling"""
+        usage = self.usage()
+        self.peak_bytes = max(self.peak_bytes, usage)
+        if self.max_bytes is not None and usage > self.max_bytes:
+            raise ScratchSpaceError(f'intermediates take {usage} bytes, more than the '
+                    f'{self.max_bytes} allowed')
+
+    def cleanup(self):
+        """Removes every intermediate still tracked"""
+        with self.lock:
+            fps = list(self.consumers)
+            self.consumers = {}
+        for fp in fps:
+            remove_path(fp)
+            # samtools sort spills next to -T prefixes it is given
+            for spill_fp in glob.glob(f'{glob.escape(fp)}.*.bam'):
+                os.remove(spill_fp)
+        logging.info(f'removed {len(fps)} intermediates, peak scratch usage '
+                f'{self.peak_bytes} bytes')
+
+def raise_exit(signum, frame):
+    raise SystemExit(128 + signum)
+
+def cleanup_sessions():
+    """Removes the intermediates of every active session"""
+    with SESSIONS_LOCK:
+        sessions = list(SESSIONS)
+    for scratch in sessions:
+        scratch.cleanup()
+
+def cleanup_and_resend(signum, frame):
+    # the threads running the sessions can't be unwound, so rather than waiting on
+    # them let the signal end the process as it would have
+    cleanup_sessions()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+@contextlib.contextmanager
+def cleanup_on_signal():
+    """Removes the intermediates of every active session on SIGTERM or SIGHUP while the
+    block runs, for a main thread whose sessions run in other threads (i.e. a batch of
+    samples). Does nothing outside of the main thread."""
+    handlers = {}
+    if threading.current_thread() is threading.main_thread():
+        for signum in CLEANUP_SIGNALS:
+            handlers[signum] = signal.signal(signum, cleanup_and_resend)
+    try:
+        yield
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+@contextlib.contextmanager
+def session(max_bytes=None, tmpfs_dir=None):
+    """Makes a new Scratch active for everything run inside the block, and removes its
+    intermediates when the block is left. Inside an active session this does nothing,
+    so workflows can be run on their own or from a caller that set a ceiling."""
+    if ACTIVE.get() is not None:
+        yield ACTIVE.get()
+        return
+
+    scratch = Scratch(max_bytes=max_bytes, tmpfs_dir=tmpfs_dir)
+    token = ACTIVE.set(scratch)
+    with SESSIONS_LOCK:
+        SESSIONS.add(scratch)
+    # signal handlers can only be set from the main thread, sessions in other threads
+    # are cleaned up by whoever owns the main thread, see cleanup_on_signal
+    handlers = {}
+    if threading.current_thread() is threading.main_thread():
+        for signum in CLEANUP_SIGNALS:
+            handlers[signum] = signal.signal(signum, raise_exit)
+    try:
+        yield scratch
+    finally:
+        try:
+            scratch.cleanup()
+        finally:
+            with SESSIONS_LOCK:
+                SESSIONS.discard(scratch)
+            ACTIVE.reset(token)
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+def temp_path(directory, prefix, suffix='', small=False, consumers=1):
+    """Returns a new uuid named path in directory for an intermediate, i.e.
+    temp_path(temp_files_dir, 'sorted', '.bam').
+
+    In an active session the path is tracked until consumers calls to consumed, and
+    small intermediates are put on tmpfs.
+    """
+    scratch = ACTIVE.get()
+    if scratch is None:
+        return os.path.join(directory, f'{prefix}.{str(uuid.uuid4())}{suffix}')
+    return scratch.path(directory, prefix, suffix=suffix, small=small, consumers=consumers)
+
+def consumed(fp):
+    """Marks one consumer of an intermediate as finished. The intermediate is removed
+    when it was the last, or straight away when no session is tracking it."""
+    scratch = ACTIVE.get()
+    if scratch is None or fp not in scratch.consumers:
+        remove_path(fp)
+    else:
+        scratch.consumed(fp)
+
+def check():
+    """Raises ScratchSpaceError if the intermediates of the active session are over its
+    ceiling, for when intermediates grow after they were created"""
+    scratch = ACTIVE.get()
+    if scratch is not None:
+        scratch.check()
@@ -5,5 +5,5 @@ setup(name='bam_processing',
       description='bam helper functions',
       author='Erik Storrs',
       author_email='epstorrs@gmail.com',
-      py_modules=['bam_processing']
+      py_modules=['bam_processing', 'bam_chunks', 'bam_filter', 'bam_io', 'bam_markdup', 'bam_merge', 'bam_metadata', 'bam_recal', 'bam_sharding', 'bam_splitn', 'bam_stages', 'batch', 'dag', 'genome_access', 'instrumentation', 'jvm_executor', 'progress', 'reference_cache', 'resource_plan', 'scratch', 'step_cache', 'synthetic_bam', 'benchmark']
      )
@@ -0,0 +1,183 @@
+"""Content addressed cache of workflow step outputs, so failed workflows can resume."""
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import uuid
+
+import instrumentation
+
+VERSION_COMMANDS = {
+    'samtools': ('samtools', '--version'),
+    'picard': ('picard', 'MarkDuplicates', '--version'),
+    'gatk': ('gatk', '--version'),
+    }
+
+@functools.lru_cache(maxsize=None)
+def get_tool_version(tool):
+    """Returns the first line of the tools version output, or 'unknown'"""
+    if tool not in VERSION_COMMANDS:
+        return tool
+    try:
+        result = subprocess.run(VERSION_COMMANDS[tool], stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+    except OSError:
+        return 'unknown'
+    lines = result.stdout.decode('utf-8', errors='replace').strip().split('\n')
+    return lines[0] if lines else 'unknown'
+
+def link_or_copy(source_fp, target_fp):
+    """Hard links source to target, copying instead if they are on different filesystems"""
+    try:
+        os.link(source_fp, target_fp)
+    except OSError:
+        shutil.copyfile(source_fp, target_fp)
+
+class StepCache(object):
+    """Caches step outputs in cache_dir keyed by a hash of the step, its parameters, the
+    versions of the tools it runs and the identity of its inputs.
+
+    Input identity is the key of the step that produced the input if it came from this
+    cache, otherwise (realpath, size, mtime). That way keys stay stable across runs even
+    though intermediates get new uuid filenames every time.
+
+    Entries are committed atomically (written to a temporary directory, then renamed)
+    and once the cache grows past max_size bytes the least recently used entries are
+    evicted. If resume is False outputs are stored but never reused.
+    """
+    def __init__(self, cache_dir, max_size=None, resume=True):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.resume = resume
+        # realpath of files produced or restored by this cache -> their key
+        self.produced = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_input_identity(self, fp):
+        realpath = os.path.realpath(fp)
+        if realpath in self.produced:
+            return self.produced[realpath]
+        stat = os.stat(realpath)
+        return [realpath, stat.st_size, stat.st_mtime_ns]
+
+    def get_key(self, step, input_fps, params=None, tools=()):
+        description = {
+            'step': step,
+            'inputs': [self.get_input_identity(fp) for fp in input_fps],
+            'params': params or {},
+            'tools': [get_tool_version(tool) for tool in tools],
+            }
+        encoded = json.dumps(description, sort_keys=True, default=str).encode('utf-8')
+        return hashlib.sha256(encoded).hexdigest()
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get_entry_fps(self, key, n_extra=0):
+        """Returns the paths of the output and the n_extra other files of an entry"""
+        entry_dir = self.get_entry_dir(key)
+        return [os.path.join(entry_dir, 'output')] + \
+                [os.path.join(entry_dir, f'extra.{i}') for i in range(n_extra)]
+
+    def restore(self, key, output_fp, extra_fps=()):
+        """Materializes the cached output for key at output_fp, and the other files
+        cached with it at extra_fps.
+
+        Returns
+            restored - True if the step was cached
+        """
+        entry_fps = self.get_entry_fps(key, len(extra_fps))
+        if not self.resume or not all(os.path.isfile(fp) for fp in entry_fps):
+            return False
+
+        for entry_fp, fp in zip(entry_fps, [output_fp] + list(extra_fps)):
+            if os.path.exists(fp):
+                os.remove(fp)
+            link_or_copy(entry_fp, fp)
+        # mark as recently used
+        os.utime(self.get_entry_dir(key))
+        self.produced[os.path.realpath(output_fp)] = key
+
+        return True
+
+    def store(self, key, output_fp, extra_fps=()):
+        """Atomically adds output_fp, and the other files extra_fps, to the cache under
+        key"""
+        entry_dir = self.get_entry_dir(key)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        temp_dir = f'{entry_dir}.tmp.{str(uuid.uuid4())}'
+        os.mkdir(temp_dir)
+        entry_fps = self.get_entry_fps(key, len(extra_fps))
+        for entry_fp, fp in zip(entry_fps, [output_fp] + list(extra_fps)):
+            link_or_copy(fp, os.path.join(temp_dir, os.path.basename(entry_fp)))
+        try:
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            if all(os.path.isfile(fp) for fp in entry_fps):
+                # another run committed the same step first
+                shutil.rmtree(temp_dir)
+            else:
+                # an older entry without the extra files
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                os.rename(temp_dir, entry_dir)
+        self.produced[os.path.realpath(output_fp)] = key
+
+        self.evict()
+
+    def list_entries(self):
+        """Returns list of (last_used, size, entry_dir) for committed entries"""
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, name)
+                if '.tmp.' in name:
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry_dir, fp))
+                        for fp in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+        return entries
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_size"""
+        if self.max_size is None:
+            return
+        entries = sorted(self.list_entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total <= self.max_size:
+                break
+            logging.info(f'evicting cached step {os.path.basename(entry_dir)}')
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+def run_cached_step(cache, step, run_step, input_fps, output_fp, params=None, tools=(),
+        extra_fps=()):
+    """Calls run_step() to create output_fp, unless cache already has its output.
+    extra_fps are other files run_step creates, cached and restored with output_fp.
+
+    Returns
+        output - run_step return value, or None if the output came from the cache
+    """
+    with instrumentation.step(step):
+        if cache is None:
+            return run_step()
+
+        key = cache.get_key(step, input_fps, params=params, tools=tools)
+        if cache.restore(key, output_fp, extra_fps=extra_fps):
+            logging.info(f'using cached output for {step}')
+            return None
+
+        # never write through a hard link that may point into the cache
+        for fp in [output_fp] + list(extra_fps):
+            if os.path.exists(fp):
+                os.remove(fp)
+        output = run_step()
+        cache.store(key, output_fp, extra_fps=extra_fps)
+
+        return output
@@ -0,0 +1,222 @@
+"""Generates synthetic references, known sites and bams for benchmarking.
+
+Reads are sampled from the reference (so they align without mismatches) with a
+configurable fraction of properly paired templates, duplicates, spliced (N cigar)
+alignments and STAR style 255 mapping qualities. Every read carries an RG tag.
+"""
+import os
+import random
+import struct
+
+import bam_io
+
+SEQ_CODES = '=ACMGRSVTWYHKDBN'
+SEQ_TABLE = bytes.maketrans(SEQ_CODES.encode('ascii'), bytes(range(len(SEQ_CODES))))
+CIGAR_OPS = 'MIDNSHP=X'
+READ_GROUP = 'synthetic'
+
+def generate_reference(n_contigs=1, contig_length=200000, seed=0):
+    """Returns list of (name, sequence) with uniformly random bases"""
+    rng = random.Random(seed)
+    return [(str(i + 1), ''.join(rng.choice('ACGT') for _ in range(contig_length)))
+            for i in range(n_contigs)]
+
+def read_fasta(reference_fp):
+    """Returns list of (name, sequence), sequences upper cased"""
+    contigs = []
+    with open(reference_fp) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                contigs.append((line[1:].split()[0], []))
+            elif line:
+                contigs[-1][1].append(line.upper())
+    return [(name, ''.join(lines)) for name, lines in contigs]
+
+def write_fasta(contigs, output_fp, line_length=60):
+    with open(output_fp, 'w') as f:
+        for name, sequence in contigs:
+            f.write(f'>{name}\n')
+            for i in range(0, len(sequence), line_length):
+                f.write(sequence[i:i + line_length] + '\n')
+
+def write_known_sites(contigs, output_fp, n_sites=1000, seed=0):
+    """Writes a bgzipped vcf of random snps at non N reference bases"""
+    rng = random.Random(seed)
+    lines = []
+    for name, sequence in contigs:
+        positions = sorted(rng.sample(range(len(sequence)), min(n_sites, len(sequence))))
+        for position in positions:
+            ref = sequence[position]
+            if ref not in 'ACGT':
+                continue
+            alt = rng.choice([base for base in 'ACGT' if base != ref])
+            lines.append(f'{name}\t{position + 1}\tsite{len(lines)}\t{ref}\t{alt}\t.\tPASS\t.')
+
+    header = ['##fileformat=VCFv4.2']
+    header += [f'##contig=<ID={name},length={len(sequence)}>' for name, sequence in contigs]
+    header.append('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO')
+    with bam_io.BgzfWriter(output_fp) as writer:
+        writer.write(('\n'.join(header + lines) + '\n').encode('utf-8'))
+
+def encode_record(name, flag, ref_id, pos, mapping_quality, cigar, seq, next_ref_id=-1,
+        next_pos=-1, template_length=0, read_group=READ_GROUP):
+    """Returns a raw bam record (without the leading block_size field). cigar is a list
+    of (length, op) tuples"""
+    read_name = name.encode('ascii') + b'\x00'
+    reference_length = sum(length for length, op in cigar if op in 'MDN=X')
+    codes = seq.encode('ascii').translate(SEQ_TABLE) + b'\x00'
+    packed_seq = bytes(a << 4 | b for a, b in zip(codes[0::2], codes[1::2]))
+    return b''.join((
+            struct.pack('<iiBBHHHiiii', ref_id, pos, len(read_name), mapping_quality,
+                    bam_io.reg2bin(pos, pos + reference_length), len(cigar), flag, len(seq),
+                    next_ref_id, next_pos, template_length),
+            read_name,
+            b''.join(struct.pack('<I', length << 4 | CIGAR_OPS.index(op))
+                    for length, op in cigar),
+            packed_seq,
+            b'\x1e' * len(seq),
+            b'RGZ' + read_group.encode('ascii') + b'\x00',
+            ))
+
+def get_cigar(rng, read_length, spliced, intron_length):
+    """Returns (cigar, reference_span), spliced reads have an intron at a random offset"""
+    if not spliced:
+        return [(read_length, 'M')], read_length
+    first = rng.randint(1, read_length - 1)
+    return [(first, 'M'), (intron_length, 'N'), (read_length - first, 'M')], \
+            read_length + intron_length
+
+def get_read_seq(sequence, pos, cigar):
+    seq = []
+    for length, op in cigar:
+        if op == 'M':
+            seq.append(sequence[pos:pos + length])
+        pos += length
+    return ''.join(seq)
+
+def generate_records(contigs, n_reads=100000, read_length=100, paired_fraction=0.9,
+        duplicate_rate=0.1, spliced_fraction=0.0, mapq_255_fraction=0.0, insert_size=300,
+        intron_length=1000, seed=0):
+    """Returns list of raw bam records in no particular order.
+
+    Duplicates repeat the contig, positions and strands of an earlier template.
+    """
+    rng = random.Random(seed)
+    width = len(str(n_reads))
+    templates = []
+    records = []
+    n_templates = 0
+    while len(records) < n_reads:
+        remaining = n_reads - len(records)
+        template = None
+        if templates and rng.random() < duplicate_rate:
+            template = rng.choice(templates)
+            if template['paired'] and remaining < 2:
+                template = None
+
+        if template is None:
+            paired = remaining > 1 and rng.random() < paired_fraction
+            ref_id = rng.randrange(len(contigs))
+            contig_length = len(contigs[ref_id][1])
+            cigars, spans = zip(*[get_cigar(rng, read_length, rng.random() < spliced_fraction,
+                    intron_length) for _ in range(2 if paired else 1)])
+            fragment = max(insert_size, spans[0], spans[-1]) if paired else spans[0]
+            pos = rng.randrange(max(1, contig_length - fragment))
+            template = {
+                'paired': paired,
+                'ref_id': ref_id,
+                'positions': [pos, pos + fragment - spans[-1]] if paired else [pos],
+                'cigars': cigars,
+                'reverse': rng.random() < 0.5,
+                'fragment': fragment,
+                'mapping_quality': 255 if rng.random() < mapq_255_fraction else 60,
+                }
+            templates.append(template)
+
+        name = f'read{n_templates:0{width}d}'
+        n_templates += 1
+        ref_id = template['ref_id']
+        sequence = contigs[ref_id][1]
+        seqs = [get_read_seq(sequence, pos, cigar)
+                for pos, cigar in zip(template['positions'], template['cigars'])]
+        if not template['paired']:
+            records.append(encode_record(name, 0x10 if template['reverse'] else 0, ref_id,
+                    template['positions'][0], template['mapping_quality'],
+                    template['cigars'][0], seqs[0]))
+            continue
+
+        # the leftmost read is forward, the rightmost reverse. reverse decides which
+        # of them is read 1
+        left_pos, right_pos = template['positions']
+        first_flags = (0x40, 0x80) if not template['reverse'] else (0x80, 0x40)
+        for i, (pos, mate_pos) in enumerate(((left_pos, right_pos), (right_pos, left_pos))):
+            flag = 0x1 | 0x2 | first_flags[i] | (0x20 if i == 0 else 0x10)
+            template_length = template['fragment'] if i == 0 else -template['fragment']
+            records.append(encode_record(name, flag, ref_id, pos,
+                    template['mapping_quality'], template['cigars'][i], seqs[i],
+                    next_ref_id=ref_id, next_pos=mate_pos, template_length=template_length))
+
+    return records
+
+def get_coordinate_key(record):
+    ref_id, pos = struct.unpack_from('<ii', record, 0)
+    return (ref_id if ref_id >= 0 else float('inf'), pos)
+
+def get_queryname_key(record):
+    # names are zero padded, so plain string order matches samtools natural order
+    name = record[32:32 + record[8] - 1]
+    flag = struct.unpack_from('<H', record, 14)[0]
+    return (name, flag & 0xc0)
+
+def write_bam(records, contigs, output_fp, sort_order='coordinate', threads=1):
+    """Writes records sorted by sort_order ('coordinate', 'queryname' or 'unsorted')"""
+    if sort_order == 'coordinate':
+        records = sorted(records, key=get_coordinate_key)
+    elif sort_order == 'queryname':
+        records = sorted(records, key=get_queryname_key)
+
+    header_lines = [f'@HD\tVN:1.6\tSO:{sort_order}']
+    header_lines += [f'@SQ\tSN:{name}\tLN:{len(sequence)}' for name, sequence in contigs]
+    header_lines.append(f'@RG\tID:{READ_GROUP}\tLB:library\tPL:ILLUMINA\tPU:machine\tSM:sample')
+    header_lines.append('@PG\tID:synthetic_bam\tPN:synthetic_bam')
+    references = [(name, len(sequence)) for name, sequence in contigs]
+    with bam_io.BgzfWriter(output_fp, threads=threads) as writer:
+        bam_io.write_header(writer, '\n'.join(header_lines) + '\n', references)
+        for record in records:
+            bam_io.write_record(writer, record)
+
+def create_dataset(output_dir, n_reads=100000, read_length=100, paired_fraction=0.9,
+        duplicate_rate=0.1, spliced_fraction=0.0, mapq_255_fraction=0.0, reference_fp=None,
+        n_contigs=1, contig_length=200000, n_known_sites=1000, seed=0, threads=1):
+    """Writes a reference, known sites and coordinate and name sorted bams of the same
+    reads to output_dir. If reference_fp isn't given a random reference is generated.
+
+    Returns
+        dict of reference, known_sites, coordinate_bam and queryname_bam filepaths
+            and n_reads
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    contigs = read_fasta(reference_fp) if reference_fp is not None else \
+            generate_reference(n_contigs=n_contigs, contig_length=contig_length, seed=seed)
+
+    dataset = {
+        'reference': os.path.join(output_dir, 'reference.fa'),
+        'known_sites': os.path.join(output_dir, 'known_sites.vcf.gz'),
+        'coordinate_bam': os.path.join(output_dir, 'coordinate.bam'),
+        'queryname_bam': os.path.join(output_dir, 'queryname.bam'),
+        'n_reads': n_reads,
+        }
+    write_fasta(contigs, dataset['reference'])
+    write_known_sites(contigs, dataset['known_sites'], n_sites=n_known_sites, seed=seed)
+
+    records = generate_records(contigs, n_reads=n_reads, read_length=read_length,
+            paired_fraction=paired_fraction, duplicate_rate=duplicate_rate,
+            spliced_fraction=spliced_fraction, mapq_255_fraction=mapq_255_fraction,
+            seed=seed)
+    write_bam(records, contigs, dataset['coordinate_bam'], sort_order='coordinate',
+            threads=threads)
+    write_bam(records, contigs, dataset['queryname_bam'], sort_order='queryname',
+            threads=threads)
+
+    return dataset
@@ -1,10 +1,22 @@
 import pytest
+import json
 import os
 import re
+import socket
 import sys
 import subprocess
+import time
+import urllib.request
 
+import bam_merge
+import bam_metadata
 import bam_processing as bp
+import genome_access
+import jvm_executor
+import progress
+import reference_cache
+import resource_plan
+import synthetic_bam
 
 INPUT_BAM = 'tests/data/test.2.bam'
 REFERENCE_FASTA = 'tests/data/test.fa'
@@ -14,6 +26,51 @@ TEMP_FILES_DIR = os.getcwd()
 def test_create_sorted_bam():
     output_fp = bp.create_sorted_bam(INPUT_BAM)
 
+def test_get_sort_order():
+    assert bp.get_sort_order(INPUT_BAM) == 'coordinate'
+
+def test_scan_sort_order(monkeypatch):
+    contigs = synthetic_bam.generate_reference(contig_length=2000)
+    records = [synthetic_bam.encode_record(f'read{i}', 0x0, 0, 100 + i, 60, [(20, 'M')],
+            contigs[0][1][100 + i:120 + i]) for i in range(100)]
+    os.makedirs('synthetic', exist_ok=True)
+    synthetic_bam.write_bam(records, contigs, 'synthetic/in_order.bam', sort_order='unsorted')
+    synthetic_bam.write_bam(records[::-1], contigs, 'synthetic/out_of_order.bam',
+            sort_order='unsorted')
+
+    assert bp.get_sort_order('synthetic/in_order.bam') == 'coordinate'
+    assert bp.get_sort_order('synthetic/out_of_order.bam') == 'unsorted'
+
+    # past MAX_SCAN_RECORDS samtools decides
+    monkeypatch.setattr(bp, 'MAX_SCAN_RECORDS', 10)
+    bp.SORT_ORDER_CACHE.clear()
+    assert bp.get_sort_order('synthetic/in_order.bam') == 'coordinate'
+    assert bp.get_sort_order('synthetic/out_of_order.bam') == 'unsorted'
+
+def test_split_memory():
+    assert bp.split_memory('10G', 4) == '2560M'
+    assert bp.samtools_thread_args(4) == ('-@', '3')
+    assert bp.samtools_thread_args(1) == ()
+
+def test_resource_plan():
+    plan = resource_plan.make_plan(INPUT_BAM, sort_memory='1G', memory='4G', cpus=2)
+
+    assert plan['sort_memory'] == '1G' and plan['threads'] == 2 and plan['workers'] == 1
+    assert plan['max_records_in_ram'] == resource_plan.MIN_RECORDS_IN_RAM
+    assert bp.parse_memory(plan['max_mem']) <= bp.parse_memory('4G')
+
+def test_bam_file():
+    input_bam = bp.BamFile(INPUT_BAM)
+    fixmates_output = bp.BamFile('fixmates.bam', sort_order='queryname')
+    paired_output = fixmates_output.derive('paired.bam', 'properly_paired')
+    read_group_output = paired_output.derive('read_groups.bam', 'add_or_replace_read_groups')
+
+    # already coordinate sorted, so nothing to do
+    assert bp.prepare_input(input_bam, 'mark_duplicates') is input_bam
+    assert paired_output.sort_order == 'queryname'
+    assert read_group_output.sort_order == 'coordinate'
+    assert read_group_output.provenance == ['properly_paired', 'add_or_replace_read_groups']
+
 def test_index_bam():
     # sort so you can index
     output_fp = bp.create_sorted_bam(INPUT_BAM)
@@ -21,6 +78,16 @@ def test_index_bam():
     bp.index_bam(output_fp)
 
     assert os.path.isfile(INPUT_BAM + '.bai')
+    assert bam_metadata.count_records(INPUT_BAM) == 1077
+
+def test_bam_metadata():
+    metadata = bam_metadata.read_metadata(INPUT_BAM)
+
+    assert metadata['sort_order'] == 'coordinate'
+    assert [rg['ID'] for rg in metadata['read_groups']] == ['SRR077487', 'SRR081241']
+    assert metadata['programs'][0]['ID'] == 'bwa_index'
+    assert metadata['programs'][-1]['ID'] == 'bam_merge.1'
+    assert [(c['name'], c['length']) for c in metadata['contigs']] == [('1', 200000)]
 
 def test_index_reference():
     bp.index_reference(REFERENCE_FASTA)
@@ -32,22 +99,162 @@ def test_create_sequence_dict():
 
     assert os.path.isfile(re.sub(r'.[^.]*$', '.dict', REFERENCE_FASTA))
 
+def test_reference_cache():
+    cache = reference_cache.ReferenceCache(os.path.join(TEMP_FILES_DIR, 'reference_cache'))
+    reference_fp = cache.prepare_reference(REFERENCE_FASTA)
+
+    assert os.path.isfile(reference_fp + '.fai')
+    assert os.path.isfile(re.sub(r'\.fa$', '.dict', reference_fp))
+    assert cache.prepare_reference(REFERENCE_FASTA) == reference_fp
+
 def test_index_vcf():
     bp.index_vcf(KNOWN_SITES_VCF_GZ)
 
     assert os.path.isfile(KNOWN_SITES_VCF_GZ + '.tbi')
 
+def test_genome_access():
+    fasta = genome_access.MappedFasta(REFERENCE_FASTA)
+    with open(REFERENCE_FASTA) as f:
+        sequence = ''.join(line.strip() for line in f if not line.startswith('>'))
+
+    assert fasta.get_lengths() == [('1', len(sequence))]
+    assert fasta.view('1', 55, 130).tobytes().decode('utf-8') == sequence[55:130]
+    assert fasta.fetch('1', len(sequence) - 10, len(sequence) + 10) == \
+            sequence[-10:].upper().encode('utf-8')
+
+    known_sites = genome_access.KnownSites([KNOWN_SITES_VCF_GZ])
+    starts, ends = genome_access.load_known_sites([KNOWN_SITES_VCF_GZ])['1']
+    assert list(known_sites.get('1')[0]) == list(starts)
+    assert list(known_sites.get('1')[1]) == list(ends)
+    assert known_sites.overlaps('1', starts[0], starts[0] + 1)
+    assert not known_sites.overlaps('1', 0, starts[0])
+    assert known_sites.get('2') is None
+
+def test_known_sites_tabix():
+    bp.index_vcf(KNOWN_SITES_VCF_GZ)
+    known_sites = genome_access.KnownSites([KNOWN_SITES_VCF_GZ])
+    starts, ends = genome_access.load_known_sites([KNOWN_SITES_VCF_GZ])['1']
+
+    assert '1' in known_sites.regions[KNOWN_SITES_VCF_GZ]
+    assert list(known_sites.get('1')[0]) == list(starts)
+    assert list(known_sites.get('1')[1]) == list(ends)
+
 def test_add_or_replace_read_groups():
     bp.run_add_or_replace_read_groups(input_fp=INPUT_BAM, output_fp='output.bam')
     output = subprocess.check_output(('samtools', 'view', '-h', 'output.bam')).decode('utf-8')
     assert 'RG:Z:id' in output 
 
+def test_add_read_group():
+    read_group = bp.bam_stages.add_read_group(INPUT_BAM, 'output.bam',
+            read_group={'SM': 'sample_1'}, from_header=True)
+    with bp.bam_io.BgzfReader('output.bam') as reader:
+        header_text, _ = bp.bam_io.read_header(reader)
+
+    assert read_group['ID'] == 'SRR077487' and read_group['SM'] == 'sample_1'
+    assert header_text.count('@RG') == 1 and 'SM:sample_1' in header_text
+
+def test_add_read_group_tags():
+    contigs = synthetic_bam.generate_reference(contig_length=2000)
+    rg_tag = b'RGZ' + synthetic_bam.READ_GROUP.encode('ascii') + b'\x00'
+    # XZ and XB hold the bytes of an RG tag, they must be left alone
+    other_tags = b'XZZRGZfake\x00' + b'XBBC' + bp.bam_io.struct.pack('<i', 4) + b'RGZ\x00' + \
+            b'NMC\x02'
+    records, expected = [], []
+    for i, (before, after) in enumerate(((rg_tag, other_tags), (other_tags, rg_tag),
+            (other_tags, b''), (b'', b''))):
+        record = synthetic_bam.encode_record(f'read{i}', 0x1, 0, 100 + i, 60, [(20, 'M')],
+                contigs[0][1][100 + i:120 + i])[:-len(rg_tag)]
+        records.append(record + before + after)
+        expected.append(record + (other_tags if other_tags in (before, after) else b'') +
+                b'RGZnew\x00')
+    os.makedirs('synthetic', exist_ok=True)
+    synthetic_bam.write_bam(records, contigs, 'synthetic/rg.bam')
+    bp.bam_stages.add_read_group('synthetic/rg.bam', 'output.bam', read_group={'ID': 'new'})
+
+    with bp.bam_io.BgzfReader('output.bam') as reader:
+        bp.bam_io.read_header(reader)
+        assert list(bp.bam_io.iter_records(reader)) == expected
+
 def test_split_n_cigar_reads():
     bp.run_split_n_cigar_reads(input_fp=INPUT_BAM, output_fp='output.bam',
             reference_fp=REFERENCE_FASTA)
     output = subprocess.check_output(('samtools', 'view', '-h', 'output.bam')).decode('utf-8')
     assert True
 
+def test_sharded_split_n_cigar_reads():
+    bp.run_split_n_cigar_reads(input_fp=INPUT_BAM, output_fp='output.bam',
+            reference_fp=REFERENCE_FASTA, workers=2)
+    output = subprocess.check_output(('samtools', 'view', '-h', 'output.bam')).decode('utf-8')
+
+    assert 'SplitNCigarReads' in output
+
+def test_native_split_n_cigar_reads():
+    dataset = synthetic_bam.create_dataset(os.path.join(TEMP_FILES_DIR, 'synthetic'),
+            n_reads=2000, spliced_fraction=0.3, mapq_255_fraction=0.2, contig_length=20000)
+    counts = bp.bam_splitn.split_n_cigar_reads(dataset['coordinate_bam'], 'output.bam',
+            dataset['reference'])
+
+    with bp.bam_io.BgzfReader('output.bam') as reader:
+        header_text, _ = bp.bam_io.read_header(reader)
+        records = list(bp.bam_io.iter_records(reader))
+    fields = [bp.bam_io.struct.unpack_from('<iiBBHHHi', record, 0) for record in records]
+    cigars = [bp.bam_io.struct.unpack_from(f'<{n_cigar_op}I', record, 32 + l_read_name)
+            for record, (_, _, l_read_name, _, _, n_cigar_op, _, _) in zip(records, fields)]
+
+    assert 'PN:bam_splitn' in header_text
+    assert counts['reads'] == 2000 and 0 < counts['split_reads'] < 2000
+    assert len(records) == counts['records'] == 2000 + counts['split_reads']
+    assert not any(c & 0xf == 3 for cigar in cigars for c in cigar)
+    assert sum(1 for field in fields if field[6] & 0x800) == counts['split_reads']
+    assert not any(field[3] == 255 for field in fields)
+    assert [field[:2] for field in fields] == sorted(field[:2] for field in fields)
+
+def test_native_split_n_cigar_reads_mates():
+    contigs = synthetic_bam.generate_reference(n_contigs=2, contig_length=2000)
+    os.makedirs('synthetic', exist_ok=True)
+    synthetic_bam.write_fasta(contigs, 'synthetic/reference.fa')
+    cigar = [(10, 'M'), (200, 'N'), (10, 'M')]
+    # the mate on the same contig and on the other one
+    for mate_ref_id in (0, 1):
+        records = [
+            synthetic_bam.encode_record('pair', 0x41, 0, 100, 60, cigar,
+                    synthetic_bam.get_read_seq(contigs[0][1], 100, cigar),
+                    next_ref_id=mate_ref_id, next_pos=1000),
+            synthetic_bam.encode_record('pair', 0x81, mate_ref_id, 1000, 60, [(20, 'M')],
+                    contigs[mate_ref_id][1][1000:1020], next_ref_id=0, next_pos=100),
+            ]
+        synthetic_bam.write_bam(records, contigs, 'synthetic/mates.bam')
+        bp.bam_splitn.split_n_cigar_reads('synthetic/mates.bam', 'output.bam',
+                'synthetic/reference.fa')
+
+        with bp.bam_io.BgzfReader('output.bam') as reader:
+            bp.bam_io.read_header(reader)
+            mate = [record for record in bp.bam_io.iter_records(reader)
+                    if bp.bam_io.struct.unpack_from('<H', record, 14)[0] & 0x80][0]
+        tags = {tag: mate[offset:offset + size] for tag, _, offset, size
+                in bp.bam_io.iter_aux(mate)}
+        assert tags['MC'] == b'10M10H\x00'
+
+def test_native_split_n_cigar_reads_matches_gatk():
+    dataset = synthetic_bam.create_dataset(os.path.join(TEMP_FILES_DIR, 'synthetic'),
+            n_reads=2000, spliced_fraction=0.3, contig_length=20000)
+    bp.create_reference_sequence_dict(dataset['reference'])
+    outputs = []
+    for splitter in ('gatk', 'native'):
+        bp.run_split_n_cigar_reads(dataset['coordinate_bam'], 'output.bam',
+                dataset['reference'], splitter=splitter)
+        output = subprocess.check_output(('samtools', 'view', 'output.bam')).decode('utf-8')
+        # everything but tags, record for record
+        outputs.append(sorted(tuple(line.split('\t')[:11]) for line in output.splitlines()))
+
+    assert outputs[0] == outputs[1]
+
+def test_create_shards():
+    bp.index_reference(REFERENCE_FASTA)
+    shards = bp.bam_sharding.create_shards(REFERENCE_FASTA, 4)
+
+    assert shards[0] == ['1'] and shards[-1] == ['unmapped']
+
 
 def test_mark_duplicates():
     bp.run_mark_duplicates(input_fp=INPUT_BAM, output_fp='output.bam')
@@ -55,30 +262,353 @@ def test_mark_duplicates():
     
     assert 'PG:Z:MarkDuplicates' in output 
 
+def test_native_mark_duplicates():
+    dataset = synthetic_bam.create_dataset(os.path.join(TEMP_FILES_DIR, 'synthetic'),
+            n_reads=2000, duplicate_rate=0.2, contig_length=20000)
+    bp.run_mark_duplicates(dataset['coordinate_bam'], 'output.bam', duplicate_marker='native',
+            metrics_fp='output.metrics')
+
+    with bp.bam_io.BgzfReader('output.bam') as reader:
+        header_text, _ = bp.bam_io.read_header(reader)
+        flags = [bp.bam_io.struct.unpack_from('<H', record, 14)[0]
+                for record in bp.bam_io.iter_records(reader)]
+    with open('output.metrics') as f:
+        metrics = f.read()
+    os.remove('output.metrics')
+
+    assert len(flags) == 2000
+    assert 'PN:bam_markdup' in header_text
+    assert 0 < sum(1 for flag in flags if flag & 0x400) < 2000
+    assert 'picard.sam.DuplicationMetrics' in metrics
+
+def read_recal_tables(table_fp):
+    """Returns dict of table name -> rows, header first, of a gatk recalibration report"""
+    with open(table_fp) as f:
+        report = f.read()
+    assert report.startswith('#:GATKReport.v1.1:5')
+    tables = {}
+    for table in report.split('\n\n')[:-1]:
+        lines = table.strip().split('\n')
+        name = [line.split(':')[2] for line in lines if line.startswith('#:GATKTable:')][1]
+        tables[name] = [line.split() for line in lines if not line.startswith('#')]
+    return tables
+
+def get_recal_rows(table):
+    """Returns dict of the key columns -> (empirical quality, observations, errors) of
+    the mismatch rows of a RecalTable"""
+    header, rows = table[0], table[1:]
+    values = [header.index(c) for c in ('EmpiricalQuality', 'Observations', 'Errors')]
+    keys = [i for i, c in enumerate(header) if c not in ('EmpiricalQuality',
+            'EstimatedQReported', 'Observations', 'Errors')]
+    return {tuple(row[i] for i in keys): tuple(float(row[i]) for i in values)
+            for row in rows if row[header.index('EventType')] == 'M'}
+
+def read_duplicate_flags(bam_fp):
+    """Returns dict of (name, flag without 0x400, ref_id, pos) -> duplicate bit"""
+    with bp.bam_io.BgzfReader(bam_fp) as reader:
+        bp.bam_io.read_header(reader)
+        fields = [(record[32:32 + record[8] - 1],) + bp.bam_io.struct.unpack_from(
+                '<iiH', record, 0)[:2] + (bp.bam_io.struct.unpack_from('<H', record, 14)[0],)
+                for record in bp.bam_io.iter_records(reader)]
+    return {(name, flag & ~0x400, ref_id, pos): flag & 0x400
+            for name, ref_id, pos, flag in fields}
+
+def read_duplication_metrics(metrics_fp):
+    """Returns list of dicts of the rows of a picard DuplicationMetrics file"""
+    with open(metrics_fp) as f:
+        lines = f.read().split('\n')
+    start = [i for i, line in enumerate(lines) if line.startswith('## METRICS CLASS')][0]
+    columns = lines[start + 1].split('\t')
+    rows = []
+    for line in lines[start + 2:]:
+        if not line.strip():
+            break
+        rows.append(dict(zip(columns, line.split('\t'))))
+    return rows
+
+def get_tied_pairs(contigs, five_prime=10000):
+    """Returns records of two pairs with all reads at the same unclipped 5' position and
+    the same score, whose reads are in crossed file order (a1, b1, b2, a2)"""
+    sequence = contigs[0][1]
+    reads = [
+            ('tied_a', 0x1 | 0x2 | 0x10 | 0x40, five_prime - 99, [(100, 'M')]),
+            ('tied_b', 0x1 | 0x2 | 0x10 | 0x40, five_prime - 99, [(90, 'M'), (10, 'S')]),
+            ('tied_b', 0x1 | 0x2 | 0x20 | 0x80, five_prime, [(100, 'M')]),
+            ('tied_a', 0x1 | 0x2 | 0x20 | 0x80, five_prime + 5, [(5, 'S'), (95, 'M')]),
+            ]
+    mates = {(name, flag & 0xc0): pos for name, flag, pos, _ in reads}
+    return [synthetic_bam.encode_record(name, flag, 0, pos, 60, cigar,
+            sequence[pos:pos + 100], next_ref_id=0, next_pos=mates[name, flag & 0xc0 ^ 0xc0])
+            for name, flag, pos, cigar in reads]
+
+def test_native_mark_duplicates_matches_picard():
+    dataset = synthetic_bam.create_dataset(os.path.join(TEMP_FILES_DIR, 'synthetic'),
+            n_reads=2000, duplicate_rate=0.2, contig_length=20000)
+    # picard keeps the first read of a pair as read 1 when both ends are at the same
+    # position, which decides between pairs of equal score
+    contigs = synthetic_bam.read_fasta(dataset['reference'])
+    tied_bam = os.path.join(TEMP_FILES_DIR, 'synthetic', 'tied.bam')
+    synthetic_bam.write_bam(get_tied_pairs(contigs), contigs, tied_bam)
+    flags, metrics = [], []
+    for duplicate_marker in ('picard', 'native'):
+        bp.run_mark_duplicates(dataset['coordinate_bam'], 'output.bam',
+                duplicate_marker=duplicate_marker, metrics_fp='output.metrics')
+        flags.append(read_duplicate_flags('output.bam'))
+        metrics.append(read_duplication_metrics('output.metrics'))
+        bp.run_mark_duplicates(tied_bam, 'output.bam', duplicate_marker=duplicate_marker)
+        flags.append(read_duplicate_flags('output.bam'))
+    os.remove('output.metrics')
+
+    # record for record
+    assert flags[0] == flags[2] and any(flags[2].values())
+    assert flags[1] == flags[3]
+    assert {name for (name, _, _, _), duplicate in flags[3].items() if duplicate} == \
+            {b'tied_b'}
+    picard_metrics, native_metrics = metrics
+    assert len(picard_metrics) == len(native_metrics) == 1
+    assert native_metrics[0]['LIBRARY'] == picard_metrics[0]['LIBRARY']
+    # picard versions differ in which columns they have
+    columns = [c for c in native_metrics[0] if c in picard_metrics[0] and c != 'LIBRARY']
+    assert 'READ_PAIR_DUPLICATES' in columns and 'ESTIMATED_LIBRARY_SIZE' in columns
+    for column in columns:
+        native_value, picard_value = native_metrics[0][column], picard_metrics[0][column]
+        if '' in (native_value, picard_value):
+            assert native_value == picard_value, column
+        else:
+            assert float(native_value) == pytest.approx(float(picard_value), rel=1e-4), column
+
+def get_cross_contig_pairs(contigs, n_pairs):
+    """Returns records of pairs with their reads on different contigs, every fifth one
+    at the positions of an earlier pair"""
+    records = []
+    for i in range(n_pairs):
+        template = i // 2 if i % 5 == 4 else i
+        refs = (template % len(contigs), (template + 1) % len(contigs))
+        positions = [(template * 7919 + 1000 * j) % (len(contigs[ref][1]) - 100)
+                for j, ref in enumerate(refs)]
+        for j in range(2):
+            flag = 0x1 | (0x40, 0x80)[j] | (0x10 if j else 0x20)
+            records.append(synthetic_bam.encode_record(f'cross{i:06d}', flag, refs[j],
+                    positions[j], 60, [(100, 'M')],
+                    contigs[refs[j]][1][positions[j]:positions[j] + 100],
+                    next_ref_id=refs[1 - j], next_pos=positions[1 - j]))
+    return records
+
+def test_native_mark_duplicates_cross_contig(monkeypatch):
+    contigs = synthetic_bam.generate_reference(n_contigs=3, contig_length=20000)
+    records = synthetic_bam.generate_records(contigs, n_reads=2000, duplicate_rate=0.2)
+    records += get_cross_contig_pairs(contigs, 20000)
+    os.makedirs('synthetic', exist_ok=True)
+    synthetic_bam.write_bam(records, contigs, 'synthetic/cross_contig.bam')
+
+    # the same duplicates whether the reads waiting on a mate are spilled or not
+    flags = []
+    for max_pending in (bp.bam_markdup.MAX_PENDING, 100):
+        monkeypatch.setattr(bp.bam_markdup, 'MAX_PENDING', max_pending)
+        bp.bam_markdup.mark_duplicates('synthetic/cross_contig.bam', 'output.bam',
+                temp_files_dir='synthetic')
+        flags.append(read_duplicate_flags('output.bam'))
+    assert flags[0] == flags[1]
+    assert any(duplicate for (name, _, _, _), duplicate in flags[0].items()
+            if name.startswith(b'cross'))
+    assert not [fp for fp in os.listdir('synthetic') if fp.startswith('markdup.')]
+
+    # and when the contigs are split between processes
+    subprocess.check_call(('samtools', 'index', 'synthetic/cross_contig.bam'))
+    bp.bam_markdup.mark_duplicates('synthetic/cross_contig.bam', 'output.bam', threads=2,
+            index_fp='synthetic/cross_contig.bam.bai', temp_files_dir='synthetic')
+    assert read_duplicate_flags('output.bam') == flags[0]
+    assert not [fp for fp in os.listdir('synthetic') if fp.startswith('markdup.')]
+
+def test_native_mark_duplicates_recal_table():
+    bp.run_mark_duplicates(INPUT_BAM, 'output.bam', duplicate_marker='native',
+            reference_fp=REFERENCE_FASTA, known_sites_fp=KNOWN_SITES_VCF_GZ,
+            recal_table_fp='output.table')
+    tables = read_recal_tables('output.table')
+    os.remove('output.table')
+
+    assert list(tables) == ['Arguments', 'Quantized', 'RecalTable0', 'RecalTable1',
+            'RecalTable2']
+    assert len(tables['Quantized']) == 95
+    read_group_observations = sum(int(row[4]) for row in tables['RecalTable0'][1:])
+    assert read_group_observations > 0
+    assert read_group_observations == sum(int(row[4]) for row in tables['RecalTable1'][1:])
+    assert {row[3] for row in tables['RecalTable2'][1:]} == {'Context', 'Cycle'}
+
+def test_native_recal_table_matches_gatk():
+    bp.index_reference(REFERENCE_FASTA)
+    bp.create_reference_sequence_dict(REFERENCE_FASTA)
+    bp.index_vcf(KNOWN_SITES_VCF_GZ)
+    bp.run_mark_duplicates(INPUT_BAM, 'output.bam', duplicate_marker='native',
+            reference_fp=REFERENCE_FASTA, known_sites_fp=KNOWN_SITES_VCF_GZ,
+            recal_table_fp='native.table')
+    # gatk on the same reads, duplicates flagged
+    bp.instrumentation.execute(bp.base_recalibrator_table('output.bam', 'gatk.table',
+            REFERENCE_FASTA, KNOWN_SITES_VCF_GZ))
+    native, gatk = read_recal_tables('native.table'), read_recal_tables('gatk.table')
+
+    for name in ('RecalTable0', 'RecalTable1', 'RecalTable2'):
+        native_rows, gatk_rows = get_recal_rows(native[name]), get_recal_rows(gatk[name])
+        assert native_rows.keys() == gatk_rows.keys()
+        for key, (quality, observations, errors) in native_rows.items():
+            gatk_quality, gatk_observations, gatk_errors = gatk_rows[key]
+            assert observations == gatk_observations
+            assert abs(errors - gatk_errors) <= max(1.0, 0.01 * gatk_errors)
+            assert abs(quality - gatk_quality) <= 0.5
+
+    # and applyBQSR takes the native table as it is
+    bp.run_base_recalibration('output.bam', 'recalibrated.bam', REFERENCE_FASTA,
+            KNOWN_SITES_VCF_GZ, table_fp='native.table')
+    output = subprocess.check_output(('samtools', 'view', '-h', 'recalibrated.bam')
+            ).decode('utf-8')
+    for fp in ('native.table', 'gatk.table', 'recalibrated.bam'):
+        os.remove(fp)
+
+    assert 'ID:GATK ApplyBQSR' in output and 'PN:bam_markdup' in output
+
+def test_native_preprocessing():
+    bp.run_basic_preprocessing(INPUT_BAM, 'output.bam', REFERENCE_FASTA, KNOWN_SITES_VCF_GZ,
+            duplicate_marker='native')
+    output = subprocess.check_output(('samtools', 'view', '-h', 'output.bam')).decode('utf-8')
+
+    assert 'PN:bam_markdup' in output and 'ID:GATK ApplyBQSR' in output
+
 def test_properly_paired():
     bp.run_properly_paired(INPUT_BAM, 'output.bam')
     output = subprocess.check_output(('samtools', 'view', '-h', 'output.bam')).decode('utf-8')
 
     assert True
 
+def test_read_filter():
+    n_records, n_kept = bp.bam_filter.filter_records(INPUT_BAM, 'output.bam',
+            record_filter='mapped,min_mapping_quality=30')
+
+    assert n_records == 1077 and n_kept == 15
+    assert bp.get_sort_order('output.bam') == 'coordinate'
+
+def test_read_filter_csi():
+    os.makedirs('synthetic', exist_ok=True)
+    subprocess.check_call(('samtools', 'index', '-c', INPUT_BAM, 'synthetic/test.bam.csi'))
+    n_records, n_kept = bp.bam_filter.filter_records(INPUT_BAM, 'output.bam',
+            record_filter='mapped,min_mapping_quality=30', threads=2,
+            index_fp='synthetic/test.bam.csi', temp_files_dir='synthetic')
+
+    assert n_records == 1077 and n_kept == 15
+    assert not [fp for fp in os.listdir('synthetic') if fp.startswith('filter.chunk')]
+
 def test_fixmate():
     bp.run_fixmates(INPUT_BAM, 'output.bam')
     output = subprocess.check_output(('samtools', 'view', '-h', 'output.bam')).decode('utf-8')
 
     assert True
 
+def test_fixmates_and_filter():
+    bp.run_fixmates_and_filter(INPUT_BAM, 'output.bam')
+    output = subprocess.check_output(('samtools', 'view', '-H', 'output.bam')).decode('utf-8')
+
+    assert 'SO:coordinate' in output and 'samtools fixmate' in output
+
 def test_fix_star_mapping_quality():
     bp.run_fix_255_mapping_quality(INPUT_BAM, 'output.bam')
     output = subprocess.check_output(('samtools', 'view', '-h', 'output.bam')).decode('utf-8')
 
     assert '\t60\t' in output
 
+def test_fix_255_mapping_quality_tags():
+    contigs = synthetic_bam.generate_reference(contig_length=2000)
+    # XB is a byte array holding the bytes of an MQ:C:255 tag, it must be left alone
+    other_tags = b'XB' + b'BC' + bp.bam_io.struct.pack('<i', 4) + b'MQC\xff' + b'NMi' + \
+            bp.bam_io.struct.pack('<i', 255)
+    records = []
+    for i, (mapping_quality, mq_tag) in enumerate(((255, b'MQC\xff'), (60, b'MQC\xff'),
+            (255, b'MQS\xff\x00'), (255, b'MQi' + bp.bam_io.struct.pack('<i', 255)),
+            (20, b'MQC\x14'), (255, b''))):
+        record = synthetic_bam.encode_record(f'read{i}', 0x1, 0, 100 + i, mapping_quality,
+                [(20, 'M')], contigs[0][1][100 + i:120 + i], next_ref_id=0, next_pos=300)
+        records.append((record + mq_tag + other_tags, len(record), len(mq_tag)))
+    os.makedirs('synthetic', exist_ok=True)
+    synthetic_bam.write_bam([record for record, _, _ in records], contigs,
+            'synthetic/mapq.bam')
+    n_changed = bp.bam_stages.fix_255_mapping_quality('synthetic/mapq.bam', 'output.bam')
+
+    with bp.bam_io.BgzfReader('output.bam') as reader:
+        bp.bam_io.read_header(reader)
+        fixed = list(bp.bam_io.iter_records(reader))
+    assert n_changed == 5 and len(fixed) == len(records)
+    for (record, mq_offset, mq_size), fixed_record in zip(records, fixed):
+        assert fixed_record[9] == (60 if record[9] == 255 else record[9])
+        # only the MAPQ byte and the MQ value change
+        assert fixed_record[:9] == record[:9]
+        assert fixed_record[10:mq_offset + 3] == record[10:mq_offset + 3]
+        if mq_size:
+            value = int.from_bytes(record[mq_offset + 3:mq_offset + mq_size], 'little')
+            assert int.from_bytes(fixed_record[mq_offset + 3:mq_offset + mq_size],
+                    'little') == (60 if value == 255 else value)
+        assert fixed_record[mq_offset + mq_size:] == other_tags
+
+def test_streaming_read_groups():
+    bp.run_streaming_read_groups(INPUT_BAM, 'output.bam', fixmate=True,
+            properly_paired_only=True, fix_255_mapping_quality=True)
+    output = subprocess.check_output(('samtools', 'view', '-h', 'output.bam')).decode('utf-8')
+
+    assert 'RG:Z:id' in output and 'SO:coordinate' in output
+
 def test_base_recalibration():
     bp.run_base_recalibration(INPUT_BAM, 'output.bam', REFERENCE_FASTA, KNOWN_SITES_VCF_GZ)
     output = subprocess.check_output(('samtools', 'view', '-h', 'output.bam')).decode('utf-8')
     
     assert 'ID:GATK ApplyBQSR' in output and '60' in output
 
+def test_sharded_base_recalibration():
+    bp.run_base_recalibration(INPUT_BAM, 'output.bam', REFERENCE_FASTA, KNOWN_SITES_VCF_GZ,
+            workers=2)
+    output = subprocess.check_output(('samtools', 'view', '-h', 'output.bam')).decode('utf-8')
+
+    assert 'ID:GATK ApplyBQSR' in output
+
+def test_merge_bams():
+    dataset = synthetic_bam.create_dataset(os.path.join(TEMP_FILES_DIR, 'synthetic'),
+            n_reads=2000, n_contigs=3, contig_length=20000)
+    with bp.bam_io.BgzfReader(dataset['coordinate_bam']) as reader:
+        header_text, references = bp.bam_io.read_header(reader)
+        records = list(bp.bam_io.iter_records(reader))
+
+    # shards of whole contigs are concatenated, shards that share contigs merged
+    shards = {'contig.0.bam': [], 'contig.1.bam': [], 'mixed.0.bam': [], 'mixed.1.bam': []}
+    for i, record in enumerate(records):
+        ref_id = bp.bam_io.struct.unpack_from('<i', record, 0)[0]
+        shards[f'contig.{int(ref_id == 1)}.bam'].append(record)
+        shards[f'mixed.{i % 2}.bam'].append(record)
+    for shard_fp, shard_records in shards.items():
+        with bp.bam_io.BgzfWriter(shard_fp) as writer:
+            bp.bam_io.write_header(writer, header_text, references)
+            for record in shard_records:
+                bp.bam_io.write_record(writer, record)
+
+    methods = [bam_merge.merge_bams([f'{name}.0.bam', f'{name}.1.bam'], 'output.bam')
+            for name in ('contig', 'mixed')]
+    with bp.bam_io.BgzfReader('output.bam') as reader:
+        bp.bam_io.read_header(reader)
+        merged = list(bp.bam_io.iter_records(reader))
+    for shard_fp in shards:
+        os.remove(shard_fp)
+
+    assert methods == ['concatenate', 'merge']
+    assert [record[:8] for record in merged] == [record[:8] for record in records]
+    assert sorted(merged) == sorted(records)
+    assert bam_metadata.count_records('output.bam') == 2000
+
+def test_synthetic_bam():
+    dataset = synthetic_bam.create_dataset(os.path.join(TEMP_FILES_DIR, 'synthetic'),
+            n_reads=1000, spliced_fraction=0.5, mapq_255_fraction=0.5, contig_length=20000)
+
+    assert bp.get_sort_order(dataset['coordinate_bam']) == 'coordinate'
+    assert bp.get_sort_order(dataset['queryname_bam']) == 'queryname'
+    with bp.bam_io.BgzfReader(dataset['queryname_bam']) as reader:
+        bp.bam_io.read_header(reader)
+        records = list(bp.bam_io.iter_records(reader))
+    assert len(records) == 1000
+
 def test_cptac3_processing():
     bp.run_cptac3_preprocessing(INPUT_BAM, 'output.bam', REFERENCE_FASTA)
     output = subprocess.check_output(('samtools', 'view', '-h', 'output.bam')).decode('utf-8')
@@ -91,10 +621,195 @@ def test_cptac2_processing():
     
     assert True
 
+def test_scratch_session():
+    with pytest.raises(RuntimeError):
+        with bp.scratch.session(tmpfs_dir=TEMP_FILES_DIR):
+            kept_fp = bp.scratch.temp_path(TEMP_FILES_DIR, 'temp', '.bam', consumers=2)
+            table_fp = bp.scratch.temp_path('/nonexistent', 'output', '.table', small=True)
+            for fp in (kept_fp, table_fp):
+                open(fp, 'w').close()
+            bp.scratch.consumed(kept_fp)
+            assert os.path.isfile(kept_fp)
+            assert os.path.dirname(table_fp) == TEMP_FILES_DIR
+            raise RuntimeError('step failed')
+    assert not os.path.isfile(kept_fp) and not os.path.isfile(table_fp)
+
+    with pytest.raises(bp.scratch.ScratchSpaceError):
+        with bp.scratch.session(max_bytes=10, tmpfs_dir=''):
+            fp = bp.scratch.temp_path(TEMP_FILES_DIR, 'temp', '.bam')
+            with open(fp, 'w') as f:
+                f.write('x' * 100)
+            bp.scratch.temp_path(TEMP_FILES_DIR, 'temp', '.bam')
+    assert not os.path.isfile(fp)
+
+def test_scratch_signal_worker_threads():
+    # sessions in worker threads are cleaned up by the main thread's handler
+    script = '''
+import os, signal, sys, threading, scratch
+started = threading.Event()
+def run():
+    with scratch.session(tmpfs_dir=''):
+        fp = scratch.temp_path(sys.argv[1], 'temp', '.bam')
+        open(fp, 'w').close()
+        print(fp, flush=True)
+        started.set()
+        threading.Event().wait()
+with scratch.cleanup_on_signal():
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    os.kill(os.getpid(), signal.SIGTERM)
+    threading.Event().wait()
+'''
+    env = dict(os.environ, PYTHONPATH=os.path.abspath('bam_processing'))
+    process = subprocess.run((sys.executable, '-c', script, TEMP_FILES_DIR),
+            stdout=subprocess.PIPE, env=env, timeout=60)
+    fp = process.stdout.decode('utf-8').strip()
+
+    assert process.returncode == -15 and fp and not os.path.isfile(fp)
+
+def test_step_cache_extra_outputs(tmp_path):
+    cache = bp.step_cache.StepCache(str(tmp_path / 'cache'))
+    output_fp, table_fp = str(tmp_path / 'output.bam'), str(tmp_path / 'output.table')
+
+    def run_step():
+        for fp in (output_fp, table_fp):
+            with open(fp, 'w') as f:
+                f.write(fp)
+        return 'ran'
+
+    def run_cached(extra_fps):
+        return bp.step_cache.run_cached_step(cache, 'mark_duplicates', run_step,
+                [INPUT_BAM], output_fp, extra_fps=extra_fps)
+
+    # an entry without the table doesn't count, and is replaced by one with it
+    assert run_cached([]) == 'ran'
+    assert run_cached([table_fp]) == 'ran'
+    os.remove(table_fp)
+    # the table comes back with the output
+    assert run_cached([table_fp]) is None
+    with open(table_fp) as f:
+        assert f.read() == table_fp
+    assert run_cached([]) is None
+
+def test_run_dag():
+    steps = [
+        bp.dag.Step('echo', ('echo', 'done')),
+        bp.dag.Step('count', lambda: 1 + 1, after=['echo']),
+        ]
+    with bp.instrumentation.report() as run_report:
+        results = bp.dag.run_dag(steps)
+    assert results == {'echo': b'done\n', 'count': 2}
+    # commands are reaped with their resource usage
+    command, = [r for r in run_report.records if r['type'] == 'command']
+    assert command['step'] == 'echo' and command['max_rss_bytes'] > 0
+
+    # a failed step cancels the one running next to it
+    steps = [
+        bp.dag.Step('sleep', ('sleep', '30')),
+        bp.dag.Step('fail', ('sh', '-c', 'exit 1')),
+        bp.dag.Step('never', ('true',), after=['fail']),
+        ]
+    started = time.time()
+    with pytest.raises(subprocess.CalledProcessError):
+        bp.dag.run_dag(steps)
+    assert time.time() - started < 10
+
+    with pytest.raises(ValueError):
+        bp.dag.run_dag([bp.dag.Step('a', ('true',), after=['b']),
+                bp.dag.Step('b', ('true',), after=['a'])])
+
+    # bam steps wait for the jvm creating the sequence dictionary, not for the others
+    reference = [bp.dag.Step('index_reference', bp.faidx(REFERENCE_FASTA)),
+            bp.dag.Step('create_reference_sequence_dict',
+                    bp.create_sequence_dictionary(REFERENCE_FASTA))]
+    steps, _ = bp.chain_steps([{'step': 'properly_paired', 'run': None}],
+            bp.BamFile(INPUT_BAM), 'output.bam',
+            after=bp.get_jvm_step_names(reference))
+    assert steps[0].after == ('create_reference_sequence_dict',)
+
+def test_run_pipeline_launch_failure():
+    def write_forever(input_f, output_f):
+        while True:
+            output_f.write(b'y' * 65536)
+
+    # the stages already running are stopped instead of waited on forever
+    for first_stage in (('yes',), write_forever):
+        started = time.time()
+        with pytest.raises(FileNotFoundError):
+            bp.run_pipeline([first_stage, ('not-a-command',)])
+        assert time.time() - started < 10
+
+def test_run_pipeline_failure_order():
+    def write_forever(input_f, output_f):
+        while True:
+            output_f.write(b'y' * 65536)
+
+    def fail(input_f, output_f):
+        raise ValueError('failed stage')
+
+    # the failed reader is reported, not the broken pipe of the stage feeding it
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        bp.run_pipeline([write_forever, ('sh', '-c', 'exit 3')], output_fp='output.bam')
+    assert e.value.returncode == 3
+    with pytest.raises(ValueError):
+        bp.run_pipeline([('yes',), fail], output_fp='output.bam')
+    os.remove('output.bam')
+
+def test_progress():
+    line = ('INFO\t2020-01-01 00:00:00\tMarkDuplicates\tRead     1,000,000 records.  '
+            'Elapsed time: 00:00:12s.  Time for last 1,000,000:   12s.  '
+            'Last read position: chr1:12,345')
+    assert progress.parse_progress_line(line) == (1000000, 'chr1', 12345)
+    line = ('10:00:00.000 INFO  ProgressMeter -          chr2:6789              0.5'
+            '                  2000           4000.0')
+    assert progress.parse_progress_line(line) == (2000, 'chr2', 6789)
+
+    # halfway through the input according to the open file descriptor
+    with progress.session(status_fp='status.json', port=0) as board:
+        with open(INPUT_BAM, 'rb') as f:
+            f.seek(os.path.getsize(INPUT_BAM) // 2)
+            tracker = progress.start('read', os.getpid(), input_fp=INPUT_BAM)
+            tracker.progress.sample([os.getpid()])
+            status = tracker.progress.get_status()
+            assert 49 < status['percent'] < 51 and status['eta_seconds'] is not None
+            assert status['total_records'] == bam_metadata.count_records(INPUT_BAM)
+            tracker.stop(0)
+        port = board.server.server_port
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/') as response:
+            served = json.load(response)
+    assert served['commands'][0]['state'] == 'done'
+    with open('status.json') as f:
+        assert json.load(f)['commands'][0]['percent'] == 100.0
+    os.remove('status.json')
+
+    # native stages are followed through the input this process has open
+    with progress.session() as board:
+        bp.run_properly_paired(INPUT_BAM, 'output.bam')
+    status = board.to_dict()['commands'][0]
+    assert status['name'] == 'filter_records' and status['input'] == INPUT_BAM
+    assert status['state'] == 'done'
+
+def test_execute_output_tail():
+    n = bp.instrumentation.OUTPUT_TAIL_LINES + 10
+    output = bp.instrumentation.execute(('seq', str(n)))
+    assert output.split() == [str(i).encode('utf-8') for i in range(11, n + 1)]
+
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        bp.instrumentation.execute(('sh', '-c', f'seq {n}; exit 1'))
+    assert e.value.output == output
+
+    with open('output.txt', 'wb') as f:
+        assert bp.instrumentation.execute(('seq', str(n)), stdout=f) == b''
+    with open('output.txt') as f:
+        assert len(f.read().split()) == n
+    os.remove('output.txt')
+
 def test_cptac3_cli():
     tool_args = ('python', 'bam_processing/bam_processing_cli.py',
             '--workflow-type', 'cptac3',
             '--max-memory', '1g',
+            '--threads', '2',
+            '--sort-memory', '1G',
             '--reference-fasta', REFERENCE_FASTA,
             '--output', 'output.bam',
             INPUT_BAM)
@@ -104,6 +819,95 @@ def test_cptac3_cli():
     
     assert True
 
+def test_cptac3_cli_resume():
+    tool_args = ('python', 'bam_processing/bam_processing_cli.py',
+            '--workflow-type', 'cptac3',
+            '--reference-fasta', REFERENCE_FASTA,
+            '--output', 'output.bam',
+            '--resume',
+            INPUT_BAM)
+    subprocess.check_output(tool_args)
+    # second run gets every step from the cache
+    output = subprocess.check_output(tool_args, stderr=subprocess.STDOUT).decode('utf-8')
+
+    assert 'using cached output for split_n_cigar_reads' in output
+
+def test_cptac3_cli_report():
+    tool_args = ('python', 'bam_processing/bam_processing_cli.py',
+            '--workflow-type', 'cptac3',
+            '--reference-fasta', REFERENCE_FASTA,
+            '--output', 'output.bam',
+            '--report', 'report.json',
+            '--trace', 'trace.json',
+            INPUT_BAM)
+    subprocess.check_output(tool_args)
+
+    with open('report.json') as f:
+        report = json.load(f)
+    with open('trace.json') as f:
+        trace = json.load(f)
+
+    assert 'mark_duplicates' in report['steps'] and trace['traceEvents']
+
+def test_cptac3_cli_jvm_executor():
+    tool_args = ('python', 'bam_processing/bam_processing_cli.py',
+            '--workflow-type', 'cptac3',
+            '--reference-fasta', REFERENCE_FASTA,
+            '--output', 'output.bam',
+            '--jvm-executor',
+            '--report', 'report.json',
+            INPUT_BAM)
+    subprocess.check_output(tool_args)
+
+    with open('report.json') as f:
+        report = json.load(f)
+    output = subprocess.check_output(('samtools', 'view', '-h', 'output.bam')).decode('utf-8')
+
+    assert 'SplitNCigarReads' in output
+    assert any(r.get('jvm_executor') for r in report['records'])
+
+def test_jvm_executor_route(monkeypatch, tmp_path):
+    # stands in for a nailgun server listening on a unix socket
+    address = f'local:{tmp_path / "ng.sock"}'
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(tmp_path / 'ng.sock'))
+    server.listen()
+    monkeypatch.setenv(jvm_executor.ADDRESS_ENV, address)
+    try:
+        routed = jvm_executor.route(('picard', '-Xmx1g', 'MarkDuplicates', 'I=input.bam'))
+    finally:
+        server.close()
+
+    assert routed[:4] == ('ng', '--nailgun-server', address,
+            'picard.cmdline.PicardCommandLine')
+    assert routed[4:] == ('MarkDuplicates', f'I={os.path.abspath("input.bam")}')
+    # nothing listening, so the call runs as it is
+    assert jvm_executor.route(('picard', 'MarkDuplicates'))[0] == 'picard'
+    with pytest.raises(RuntimeError):
+        with socket.create_server(('127.0.0.1', 0)) as tcp_server:
+            port = tcp_server.getsockname()[1]
+            with jvm_executor.executor(address=f'127.0.0.1:{port}'):
+                pass
+
+def test_batch_cli():
+    with open('manifest.tsv', 'w') as f:
+        f.write('sample\tinput\toutput\tworkflow_type\n')
+        f.write(f'a\t{INPUT_BAM}\toutput.a.bam\tcptac3\n')
+        f.write(f'b\t{INPUT_BAM}\toutput.b.bam\tcptac2\n')
+    tool_args = ('python', 'bam_processing/bam_processing_batch_cli.py',
+            '--reference-fasta', REFERENCE_FASTA,
+            '--status-dir', 'batch_status',
+            '--cpus', '2', '--memory', '8G', '--sort-memory', '1G',
+            'manifest.tsv')
+    subprocess.check_output(tool_args)
+    # restarted batch skips finished samples
+    output = subprocess.check_output(tool_args, stderr=subprocess.STDOUT).decode('utf-8')
+
+    with open('batch_status/a.status.json') as f:
+        status = json.load(f)
+
+    assert status['state'] == 'done' and 'skipping finished sample b' in output
+
 def test_cptac2_cli():
     tool_args = ('python', 'bam_processing/bam_processing_cli.py',
             '--workflow-type', 'cptac2',